@@ -0,0 +1,254 @@
+import os
+import gzip
+import pathlib
+import argparse
+import collections
+import multiprocessing
+
+import numpy
+import ujson as json
+
+
+# Writes synthetic `metadata_N.jsonl.gz` and `pdf_parses_N.jsonl.gz` shards
+# that look like the real S2ORC ones to the prep scripts:
+#
+# - MAG fields of study, the number of fields per paper and the rates of
+#   has_pdf_parse/has_pdf_parsed_abstract follow data/metadata/sample.jsonl.
+# - Outbound citation counts are power-law distributed, and the cited papers
+#   are picked in proportion to a power-law "popularity", so inbound
+#   citation counts are heavy-tailed as well. All citations point to papers
+#   within the generated corpus.
+# - Papers are spread over the shards at random, like in S2ORC.
+
+
+WORDS = (
+    'the of and to in a is that for we with as on by this are be from an it which model results data '
+    'method paper using based these our at can two study analysis been also between were not has have '
+    'cells protein patients network learning theory energy system function quantum field temperature').split()
+
+
+def get_sample_statistics(sample_path):
+
+    field_counts = collections.Counter()
+    num_fields_counts = collections.Counter()
+    num_papers = 0
+    num_pdf_parses = 0
+    num_pdf_parsed_abstracts = 0
+    num_outbound_citations = []
+
+    with open(sample_path, 'r') as sample_file:
+        for line in sample_file:
+            paper = json.loads(line)
+
+            num_papers += 1
+
+            fields = paper['mag_field_of_study'] or []
+
+            field_counts.update(fields)
+            num_fields_counts[len(fields)] += 1
+
+            if paper['has_pdf_parse']:
+                num_pdf_parses += 1
+
+                if paper.get('has_pdf_parsed_abstract'):
+                    num_pdf_parsed_abstracts += 1
+
+            if paper['outbound_citations']:
+                num_outbound_citations.append(len(paper['outbound_citations']))
+
+    fields = sorted(field_counts.keys())
+    max_num_fields = max(num_fields_counts.keys())
+
+    return {
+        'fields': fields,
+        'field_probs': numpy.array([field_counts[f] for f in fields], dtype=numpy.float64) / sum(field_counts.values()),
+        'num_fields_probs': numpy.array([num_fields_counts[n] for n in range(max_num_fields + 1)], dtype=numpy.float64) / num_papers,
+        'pdf_parse_rate': num_pdf_parses / num_papers,
+        'pdf_parsed_abstract_rate': num_pdf_parsed_abstracts / max(num_pdf_parses, 1),
+        'outbound_citations_rate': len(num_outbound_citations) / num_papers,
+        'mean_outbound_citations': numpy.mean(num_outbound_citations),
+    }
+
+
+def generate_corpus(num_papers, num_shards, stats, rng, citation_exponent, popularity_exponent):
+
+    # Distinct numeric paper ids, like S2ORC's
+    paper_ids = rng.permutation(10000000 + numpy.arange(num_papers, dtype=numpy.int64) * 20 + rng.integers(0, 20, size=num_papers))
+
+    num_fields = rng.choice(len(stats['num_fields_probs']), size=num_papers, p=stats['num_fields_probs'])
+
+    has_pdf_parse = rng.random(num_papers) < stats['pdf_parse_rate']
+    has_pdf_parsed_abstract = has_pdf_parse & (rng.random(num_papers) < stats['pdf_parsed_abstract_rate'])
+
+    # Zipf-like outbound citation counts, scaled to the sample's mean
+    has_citations = rng.random(num_papers) < stats['outbound_citations_rate']
+    num_citations = rng.pareto(citation_exponent, size=num_papers) + 1
+    num_citations *= stats['mean_outbound_citations'] / numpy.mean(num_citations)
+    num_citations = numpy.where(has_citations, numpy.maximum(num_citations.astype(numpy.int64), 1), 0)
+    num_citations = numpy.minimum(num_citations, num_papers - 1)
+
+    citation_offsets = numpy.zeros(num_papers + 1, dtype=numpy.int64)
+    numpy.cumsum(num_citations, out=citation_offsets[1:])
+
+    # Cited papers are drawn in proportion to their popularity
+    popularity = numpy.cumsum(rng.pareto(popularity_exponent, size=num_papers) + 1)
+    cited = numpy.searchsorted(popularity, rng.random(citation_offsets[-1]) * popularity[-1])
+    cited = numpy.minimum(cited, num_papers - 1)
+
+    # No paper cites itself
+    citing = numpy.repeat(numpy.arange(num_papers), num_citations)
+    cited = numpy.where(cited == citing, (cited + 1) % num_papers, cited)
+
+    # Inbound citations are the same edges, grouped by cited paper
+    order = numpy.argsort(cited, kind='stable')
+    inbound_offsets = numpy.zeros(num_papers + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(cited, minlength=num_papers), out=inbound_offsets[1:])
+
+    return {
+        'paper_ids': paper_ids,
+        'num_fields': num_fields,
+        'has_pdf_parse': has_pdf_parse,
+        'has_pdf_parsed_abstract': has_pdf_parsed_abstract,
+        'citation_offsets': citation_offsets,
+        'cited': cited,
+        'inbound_offsets': inbound_offsets,
+        'citing_by_cited': citing[order],
+        'shard_nums': rng.integers(0, num_shards, size=num_papers),
+    }
+
+
+def make_text(rng, num_words):
+    return ' '.join(WORDS[i] for i in rng.integers(0, len(WORDS), size=num_words).tolist()).capitalize() + '.'
+
+
+def write_shard(shard_num):
+
+    rng = numpy.random.default_rng([args.seed, shard_num])
+
+    fields = stats['fields']
+
+    metadata_path = os.path.join(args.output_dir, 'metadata', 'metadata_{}.jsonl.gz'.format(shard_num))
+    pdf_parses_path = os.path.join(args.output_dir, 'pdf_parses', 'pdf_parses_{}.jsonl.gz'.format(shard_num))
+
+    # Paragraphs are reused across papers to keep generation fast
+    paragraphs = [make_text(rng, int(rng.integers(40, 200))) for _ in range(64)]
+
+    num_written = 0
+
+    with gzip.open(metadata_path, 'wt', compresslevel=args.compresslevel) as metadata_file, \
+         gzip.open(pdf_parses_path, 'wt', compresslevel=args.compresslevel) as pdf_parses_file:
+
+        for i in numpy.flatnonzero(corpus['shard_nums'] == shard_num).tolist():
+            paper_id = str(corpus['paper_ids'][i])
+
+            outbound_citations = corpus['paper_ids'][
+                corpus['cited'][corpus['citation_offsets'][i]:corpus['citation_offsets'][i+1]]].astype(str).tolist()
+            inbound_citations = corpus['paper_ids'][
+                corpus['citing_by_cited'][corpus['inbound_offsets'][i]:corpus['inbound_offsets'][i+1]]].astype(str).tolist()
+
+            num_fields = int(corpus['num_fields'][i])
+
+            if num_fields > 0:
+                mag_field_of_study = [
+                    fields[f] for f in rng.choice(len(fields), size=num_fields, replace=False, p=stats['field_probs']).tolist()]
+            else:
+                mag_field_of_study = None
+
+            has_pdf_parse = bool(corpus['has_pdf_parse'][i])
+
+            paper = {
+                'paper_id': paper_id,
+                'title': make_text(rng, int(rng.integers(4, 16)))[:-1],
+                'authors': [],
+                'abstract': None,
+                'year': int(rng.integers(1950, 2021)),
+                'arxiv_id': None,
+                'acl_id': None,
+                'pmc_id': None,
+                'pubmed_id': None,
+                'doi': None,
+                'venue': None,
+                'journal': None,
+                'mag_id': None,
+                'mag_field_of_study': mag_field_of_study,
+                'outbound_citations': outbound_citations,
+                'inbound_citations': inbound_citations,
+                'has_outbound_citations': len(outbound_citations) > 0,
+                'has_inbound_citations': len(inbound_citations) > 0,
+                'has_pdf_parse': has_pdf_parse,
+                's2_url': 'https://api.semanticscholar.org/CorpusID:' + paper_id,
+            }
+
+            if has_pdf_parse:
+                paper['has_pdf_parsed_abstract'] = bool(corpus['has_pdf_parsed_abstract'][i])
+                paper['has_pdf_parsed_body_text'] = True
+                paper['has_pdf_parsed_bib_entries'] = False
+                paper['has_pdf_parsed_ref_entries'] = False
+
+            metadata_file.write(json.dumps(paper) + '\n')
+
+            if has_pdf_parse:
+                if paper['has_pdf_parsed_abstract']:
+                    abstract = [{'section': 'Abstract', 'text': make_text(rng, int(rng.integers(80, 250))), 'cite_spans': [], 'ref_spans': []}]
+                else:
+                    abstract = []
+
+                body_text = [
+                    {'section': '', 'text': paragraphs[p], 'cite_spans': [], 'ref_spans': []}
+                    for p in rng.integers(0, len(paragraphs), size=args.body_paragraphs).tolist()]
+
+                pdf_parses_file.write(json.dumps({
+                    'paper_id': paper_id,
+                    '_pdf_hash': '',
+                    'abstract': abstract,
+                    'body_text': body_text,
+                    'bib_entries': {},
+                    'ref_entries': {},
+                    'back_matter': [],
+                }) + '\n')
+
+            num_written += 1
+
+    return num_written
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('output_dir', help='directory to write the `metadata` and `pdf_parses` shards to.')
+
+    parser.add_argument('--num_papers', default=100000, type=int, help='total number of papers over all shards.')
+    parser.add_argument('--num_shards', default=100, type=int, help='number of shards.')
+
+    parser.add_argument(
+        '--sample', default=os.path.join(os.path.dirname(__file__), '..', 'data', 'metadata', 'sample.jsonl'),
+        help='metadata jsonl to take the field distribution and the pdf parse rates from.')
+
+    parser.add_argument('--citation_exponent', default=2.0, type=float, help='Pareto exponent of the number of outbound citations.')
+    parser.add_argument('--popularity_exponent', default=1.5, type=float, help='Pareto exponent of how often each paper gets cited.')
+
+    parser.add_argument('--body_paragraphs', default=20, type=int, help='number of body text paragraphs in each pdf parse.')
+    parser.add_argument('--compresslevel', default=6, type=int, help='gzip compression level.')
+
+    parser.add_argument('--num_processes', default=10, type=int, help='Number of processes to use.')
+    parser.add_argument('--seed', default=321, type=int, help='Random seed.')
+
+    args = parser.parse_args()
+
+    stats = get_sample_statistics(args.sample)
+
+    print("Generating the citation graph of {} papers...".format(args.num_papers))
+    corpus = generate_corpus(
+        args.num_papers, args.num_shards, stats, numpy.random.default_rng(args.seed),
+        args.citation_exponent, args.popularity_exponent)
+
+    pathlib.Path(args.output_dir, 'metadata').mkdir(parents=True, exist_ok=True)
+    pathlib.Path(args.output_dir, 'pdf_parses').mkdir(parents=True, exist_ok=True)
+
+    print("Writing {} shards...".format(args.num_shards))
+
+    with multiprocessing.Pool(processes=args.num_processes) as pool:
+        num_written = sum(pool.map(write_shard, range(args.num_shards)))
+
+    print("Wrote {} papers, {} citations.".format(num_written, len(corpus['cited'])))
@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import shlex
+import pathlib
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import ujson as json
+
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+# Every step of both pipelines, in the order they have to run.
+# Each step is (name, script, positional arguments, report file, extra options)
+def get_steps(data_dir, output_dir):
+
+    specter_dir = os.path.join(output_dir, 'specter')
+    cite_dir = os.path.join(output_dir, 'cite')
+    cocite_dir = os.path.join(output_dir, 'cocite')
+
+    def part2_inputs(save_dir):
+        return [os.path.join(save_dir, name) for name in ['paper_ids.json', 'safe_paper_ids.json', 'titles.json']]
+
+    return [
+        ('specter_part1', 'specter_prep_part1.py', [data_dir, specter_dir], 'part1_report.json', []),
+        ('specter_part2', 'specter_prep_part2.py', part2_inputs(specter_dir) + [data_dir, specter_dir], 'part2_report.json', []),
+        ('cite_part1', 'scidocs-cite_prep_part1.py', [data_dir, cite_dir], 'part1_report.json', []),
+        ('cite_part2', 'scidocs-cite_prep_part2.py', [os.path.join(cite_dir, 'data.json')] + part2_inputs(cite_dir) + [data_dir, cite_dir], 'part2_report.json', []),
+        ('cite_part3', 'scidocs-cite_prep_part3.py', [
+            os.path.join(cite_dir, 'data_final.json'), os.path.join(cite_dir, 'paper_ids.json'),
+            os.path.join(cite_dir, 'test.txt'), os.path.join(cite_dir, 'test.qrel')], None, []),
+        ('cocite_part1', 'scidocs-cite_prep_part1.py', [data_dir, cocite_dir], 'part1_report.json', ['--cocite']),
+        ('cocite_part2', 'scidocs-cite_prep_part2.py', [os.path.join(cocite_dir, 'data.json')] + part2_inputs(cocite_dir) + [data_dir, cocite_dir], 'part2_report.json', []),
+        ('cocite_part3', 'scidocs-cite_prep_part3.py', [
+            os.path.join(cocite_dir, 'data_final.json'), os.path.join(cocite_dir, 'paper_ids.json'),
+            os.path.join(cocite_dir, 'test.txt'), os.path.join(cocite_dir, 'test.qrel')], None, ['--cocite']),
+    ]
+
+
+def get_step_options(name):
+
+    if name.endswith('part1'):
+        options = ['--num_processes', str(args.num_processes)] + shlex.split(args.part1_args)
+
+        if args.shards:
+            options += ['--shards'] + [str(s) for s in args.shards]
+    elif name.endswith('part2'):
+        options = ['--num_processes', str(args.num_processes)] + shlex.split(args.part2_args)
+    else:
+        options = ['--num_processes', str(args.num_processes)] + shlex.split(args.part3_args)
+
+    return options
+
+
+def run_step(name, script, positional_args, report_name, extra_options, log_dir):
+
+    command = [sys.executable, os.path.join(REPO_DIR, script)] + positional_args + extra_options + get_step_options(name)
+
+    print("Running {}...".format(name))
+
+    start_time = time.time()
+
+    with open(os.path.join(log_dir, name + '.log'), 'w') as log_file:
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT, cwd=REPO_DIR)
+
+        # wait4() gives the resource usage of this step alone
+        _, status, rusage = os.wait4(process.pid, 0)
+
+    wall_time = time.time() - start_time
+
+    result = {
+        'name': name,
+        'command': command,
+        'returncode': os.waitstatus_to_exitcode(status),
+        'wall_time': wall_time,
+        'user_time': rusage.ru_utime,
+        'system_time': rusage.ru_stime,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss': rusage.ru_maxrss * 1024,
+    }
+
+    if report_name and result['returncode'] == 0:
+        # The last positional argument of the part 1/2 scripts is save_dir
+        with open(os.path.join(positional_args[-1], report_name), 'r') as report_file:
+            result['stages'] = json.load(report_file)['stages']
+    else:
+        # The script doesn't report its stages; count it as a single one
+        result['stages'] = [{'name': name, 'wall_time': wall_time}]
+
+    print("  {:.1f}s{}".format(wall_time, '' if result['returncode'] == 0 else ' (failed, see {}.log)'.format(name)))
+
+    return result
+
+
+def get_commit():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_comparison(baseline, results):
+
+    baseline_steps = {step['name']: step for step in baseline['steps']}
+
+    print("{:<40} {:>10} {:>10} {:>8}".format('step/stage', 'baseline', 'current', 'speedup'))
+
+    for step in results['steps']:
+        if step['name'] not in baseline_steps:
+            continue
+
+        baseline_step = baseline_steps[step['name']]
+        baseline_stages = {stage['name']: stage for stage in baseline_step.get('stages', [])}
+
+        rows = [(step['name'], baseline_step['wall_time'], step['wall_time'])]
+
+        for stage in step.get('stages', []):
+            if stage['name'] in baseline_stages and stage['name'] != step['name']:
+                rows.append(('  ' + stage['name'], baseline_stages[stage['name']]['wall_time'], stage['wall_time']))
+
+        for row_name, baseline_time, current_time in rows:
+            print("{:<40} {:>9.2f}s {:>9.2f}s {:>7.2f}x".format(
+                row_name, baseline_time, current_time, baseline_time / max(current_time, 1e-9)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('data_dir', help='path to a directory containing `metadata` and `pdf_parses` subdirectories, e.g. made by generate_shards.py.')
+    parser.add_argument('output', help='path to the JSON file to write the results to.')
+
+    parser.add_argument('--work_dir', help='directory for the outputs of the scripts. Defaults to a temporary directory that is removed afterwards.')
+
+    parser.add_argument('--steps', nargs='*', help='only run these steps (and whatever they depend on must already be in --work_dir).')
+
+    parser.add_argument('--num_processes', default=10, type=int, help='Number of processes to use.')
+    parser.add_argument('--shards', nargs='*', type=int, help='Specific shards to be used by the part 1 scripts.')
+
+    parser.add_argument('--part1_args', default='', help='extra options for the part 1 scripts, e.g. "--indirect_engine sparse".')
+    parser.add_argument('--part2_args', default='', help='extra options for the part 2 scripts.')
+    parser.add_argument('--part3_args', default='--max_num_positives 5 --max_num_negatives 500', help='options for the part 3 scripts.')
+
+    parser.add_argument('--baseline', help='results of an earlier run to compare against.')
+
+    args = parser.parse_args()
+
+    data_dir = os.path.abspath(args.data_dir)
+
+    if args.work_dir:
+        pathlib.Path(args.work_dir).mkdir(parents=True, exist_ok=True)
+        work_dir = os.path.abspath(args.work_dir)
+    else:
+        temp_dir = tempfile.TemporaryDirectory(prefix='s2orc_prep_benchmark_')
+        work_dir = temp_dir.name
+
+    results = {
+        'commit': get_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'data_dir': data_dir,
+        'num_processes': args.num_processes,
+        'shards': args.shards,
+        'part1_args': args.part1_args,
+        'part2_args': args.part2_args,
+        'part3_args': args.part3_args,
+        'steps': [],
+    }
+
+    failed = False
+
+    for name, script, positional_args, report_name, extra_options in get_steps(data_dir, work_dir):
+        if args.steps and name not in args.steps:
+            continue
+
+        # Later steps of a pipeline need the outputs of the failed one
+        if failed and not name.endswith('part1'):
+            results['steps'].append({'name': name, 'skipped': True})
+            continue
+
+        step_result = run_step(name, script, positional_args, report_name, extra_options, work_dir)
+
+        results['steps'].append(step_result)
+
+        failed = step_result['returncode'] != 0
+
+    pathlib.Path(os.path.dirname(os.path.abspath(args.output))).mkdir(parents=True, exist_ok=True)
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+
+    print("Results written to {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            print_comparison(json.load(baseline_file), results)
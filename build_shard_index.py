@@ -0,0 +1,74 @@
+import pathlib
+import multiprocessing
+import argparse
+
+import tqdm
+
+from s2orc_prep.shard_index import build_shard_index, get_shard_path, get_shard_index_path
+
+
+# One-time conversion of the S2ORC shards into seekable copies plus a
+# paper_id -> (block offset, block length, line #) index for each shard.
+# The output directory has the same layout as `data_dir`, so it can be used
+# in place of it; pass it as `--shard_index_dir` to the part 2 scripts to
+# only read the records of the papers in paper_ids.json.
+def index_shard(kind, shard_num):
+
+    return build_shard_index(
+        get_shard_path(args.data_dir, kind, shard_num),
+        get_shard_path(args.index_dir, kind, shard_num),
+        get_shard_index_path(args.index_dir, kind, shard_num),
+        block_size=args.block_size, compresslevel=args.compresslevel)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('data_dir', help='path to a directory containing `metadata` and `pdf_parses` subdirectories.')
+    parser.add_argument('index_dir', help='path to a directory to save the indexed shards.')
+
+    parser.add_argument(
+        '--kinds', nargs='*', default=['pdf_parses'], choices=['metadata', 'pdf_parses'],
+        help='which parts of S2ORC to index.')
+
+    parser.add_argument('--num_processes', default=10, type=int, help='Number of processes to use.')
+
+    parser.add_argument('--shards', nargs='*', type=int, help='Specific shards to be indexed.')
+
+    parser.add_argument('--block_size', default=1000, type=int, help='Number of records per gzip block.')
+    parser.add_argument('--compresslevel', default=6, type=int, help='gzip compression level of the blocks.')
+
+    args = parser.parse_args()
+
+    # Total number of shards to process
+    SHARDS_TOTAL_NUM = 100
+
+    if args.shards:
+        for n in args.shards:
+            if not (n >= 0 and n < SHARDS_TOTAL_NUM):
+                raise Exception("Invalid value for args.shards: {}".format(n))
+
+        shards_list = args.shards
+    else:
+        shards_list = list(range(SHARDS_TOTAL_NUM))
+
+    index_pool = multiprocessing.Pool(processes=args.num_processes)
+    index_results = []
+
+    for kind in args.kinds:
+        pathlib.Path(args.index_dir, kind).mkdir(parents=True, exist_ok=True)
+
+        for i in shards_list:
+            index_results.append(index_pool.apply_async(index_shard, args=(kind, i)))
+
+    index_pool.close()
+
+    num_records = 0
+
+    for r in tqdm.tqdm(index_results):
+        num_records += r.get()
+
+    index_pool.join()
+
+    print("Indexed {} records.".format(num_records))
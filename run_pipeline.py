@@ -0,0 +1,52 @@
+import shlex
+import argparse
+
+from s2orc_prep.pipeline import run_specter_pipeline, run_scidocs_pipeline
+
+
+# Runs all the parts of the SPECTER or SciDocs cite/co-cite preparation one
+# after the other in this process. paper_ids.json and safe_paper_ids.json are
+# handed from one part to the next in memory, and part 2 reads only the
+# titles it needs from the title store, rather than titles.json (see
+# s2orc_prep/pipeline.py); all the other outputs are the same as when the
+# scripts are run on their own.
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('pipeline', choices=['specter', 'cite', 'cocite'], help='which data set to prepare.')
+
+    parser.add_argument('data_dir', help='path to a directory containing `metadata` and `pdf_parses` subdirectories.')
+    parser.add_argument('save_dir', help='path to a directory to save the processed files.')
+
+    parser.add_argument('--num_processes', default=10, type=int, help='Number of processes to use.')
+
+    parser.add_argument(
+        '--keep_intermediate_files', default=False, action='store_true',
+        help='still write paper_ids.json, safe_paper_ids.json and titles.json, e.g. for debugging or to run a part again on its own.')
+
+    parser.add_argument(
+        '--qrel_path',
+        help='where the cite/cocite pipelines write the qrels of test.txt. Defaults to save_dir/cite/test.qrel or save_dir/cocite/test.qrel.')
+
+    parser.add_argument('--part1_args', default='', help='extra options for the part 1 script, e.g. "--shards 7 --seed 123".')
+    parser.add_argument('--part2_args', default='', help='extra options for the part 2 script.')
+    parser.add_argument('--part3_args', default='--max_num_positives 5 --max_num_negatives 500', help='options for the part 3 script.')
+
+    args = parser.parse_args()
+
+    num_processes_args = ['--num_processes', str(args.num_processes)]
+
+    if args.pipeline == 'specter':
+        run_specter_pipeline(
+            args.data_dir, args.save_dir,
+            part1_args=num_processes_args + shlex.split(args.part1_args),
+            part2_args=num_processes_args + shlex.split(args.part2_args),
+            keep_intermediate=args.keep_intermediate_files)
+    else:
+        run_scidocs_pipeline(
+            args.data_dir, args.save_dir, cocite=args.pipeline == 'cocite', qrel_path=args.qrel_path,
+            part1_args=num_processes_args + shlex.split(args.part1_args),
+            part2_args=num_processes_args + shlex.split(args.part2_args),
+            part3_args=num_processes_args + shlex.split(args.part3_args),
+            keep_intermediate=args.keep_intermediate_files)
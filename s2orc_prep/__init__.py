@@ -0,0 +1 @@
+# Shared helpers for the SPECTER/SciDocs data preparation scripts.
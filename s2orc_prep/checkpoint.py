@@ -0,0 +1,155 @@
+import os
+import shutil
+import pickle
+
+import ujson as json
+
+from s2orc_prep import metrics
+from s2orc_prep.shard_pool import imap_shards
+
+
+# Arguments that change how a script runs, but not what it produces.
+# Resuming with different values for any of the other arguments is refused.
+RUNTIME_ARGS = [
+    'num_processes', 'reader_threads', 'record_decoder', 'metadata_cache_dir', 'shared_graph_dir',
+    'indirect_engine', 'indirect_block_size', 'data_json_format', 'shard_index_dir',
+    'memory_budget', 'spill_dir', 'work_dir', 'resume', 'profile', 'profile_memory']
+
+
+# Keeps the per-shard results of every stage of a script in `work_dir`, so
+# that a run that crashed half-way can be picked up again with --resume.
+#
+# work_dir/manifest.json lists the arguments of the run and, for each stage
+# in the order they were run, the shards whose results have been saved
+# (as work_dir/<stage>/<shard>.pkl), in the order they were merged.
+# Results are replayed in that same order, so that the parent ends up with
+# exactly the same state (e.g. the same integer paper ids) as the first run.
+#
+# Without a work_dir, nothing is saved and every shard is simply computed.
+class Checkpoint:
+
+    def __init__(self, work_dir, config, resume=False):
+
+        self.work_dir = work_dir
+        # As it will read back from manifest.json
+        self.config = json.loads(json.dumps(config))
+
+        if self.work_dir is None:
+            if resume:
+                raise Exception("--resume needs a --work_dir to resume from.")
+
+            return
+
+        self.manifest_path = os.path.join(self.work_dir, 'manifest.json')
+
+        if resume and os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as manifest_file:
+                self.manifest = json.load(manifest_file)
+
+            if self.manifest['config'] != self.config:
+                raise Exception(
+                    "{} was created by a run with different arguments: {}".format(self.work_dir, self.manifest['config']))
+        else:
+            # Start from scratch
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r') as manifest_file:
+                    for stage in json.load(manifest_file)['stages']:
+                        shutil.rmtree(os.path.join(self.work_dir, stage['name']), ignore_errors=True)
+
+            os.makedirs(self.work_dir, exist_ok=True)
+
+            self.manifest = {'config': self.config, 'stages': []}
+
+            self._write_manifest()
+
+    def _write_manifest(self):
+
+        with open(self.manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file)
+
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def _get_stage(self, name):
+
+        for stage in self.manifest['stages']:
+            if stage['name'] == name:
+                return stage
+
+        stage = {'name': name, 'shards': []}
+
+        self.manifest['stages'].append(stage)
+
+        os.makedirs(os.path.join(self.work_dir, name), exist_ok=True)
+
+        return stage
+
+    # Later stages were computed from the earlier stages' results, so they
+    # can't be reused once any of the earlier results change.
+    def _drop_stages_after(self, stage):
+
+        later_stages = self.manifest['stages'][self.manifest['stages'].index(stage)+1:]
+
+        for later_stage in later_stages:
+            self.manifest['stages'].remove(later_stage)
+
+            shutil.rmtree(os.path.join(self.work_dir, later_stage['name']), ignore_errors=True)
+
+        if len(later_stages) > 0:
+            self._write_manifest()
+
+    def _get_shard_path(self, stage, shard_key):
+        return os.path.join(self.work_dir, stage['name'], shard_key + '.pkl')
+
+    # Same as shard_pool.imap_shards(), except that shards already saved by an
+    # earlier run are loaded instead of being computed again, and every newly
+    # computed result is saved before it is handed back.
+    def imap_shards(self, stage_name, pool, func, shards, *args):
+
+        if self.work_dir is None:
+            yield from imap_shards(pool, func, shards, *args)
+
+            return
+
+        stage = self._get_stage(stage_name)
+
+        shards_by_key = {
+            '_'.join(str(s) for s in shard) if isinstance(shard, tuple) else str(shard): shard
+            for shard in shards}
+
+        for shard_key in stage['shards']:
+            if shard_key in shards_by_key:
+                with open(self._get_shard_path(stage, shard_key), 'rb') as shard_file:
+                    result = pickle.load(shard_file)
+
+                metrics.record_resumed_task()
+
+                yield shards_by_key.pop(shard_key), result
+
+        if len(shards_by_key) == 0:
+            return
+
+        self._drop_stages_after(stage)
+
+        shard_keys = {shard: shard_key for shard_key, shard in shards_by_key.items()}
+
+        for shard, result in imap_shards(pool, func, list(shards_by_key.values()), *args):
+            shard_key = shard_keys[shard]
+            shard_path = self._get_shard_path(stage, shard_key)
+
+            with open(shard_path + '.tmp', 'wb') as shard_file:
+                pickle.dump(result, shard_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(shard_path + '.tmp', shard_path)
+
+            stage['shards'].append(shard_key)
+
+            self._write_manifest()
+
+            yield shard, result
+
+
+def open_checkpoint(args):
+
+    config = {k: v for k, v in vars(args).items() if k not in RUNTIME_ARGS}
+
+    return Checkpoint(args.work_dir, config, args.resume)
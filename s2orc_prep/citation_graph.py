@@ -0,0 +1,280 @@
+import numpy
+import scipy.sparse
+
+
+# A block of rows of a citation graph in CSR form: `row_ids[i]` cites
+# `neighbors[offsets[i]:offsets[i+1]]`. This is what the shard workers
+# send back to the parent instead of dicts of dicts.
+def make_row_block(rows):
+
+    row_ids = numpy.fromiter(rows.keys(), dtype=numpy.int64, count=len(rows))
+
+    offsets = numpy.zeros(len(rows) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(cited_ids) for cited_ids in rows.values()], out=offsets[1:])
+
+    neighbors = numpy.concatenate(
+        [numpy.zeros(0, dtype=numpy.int64)]
+        + [numpy.asarray(cited_ids, dtype=numpy.int64) for cited_ids in rows.values()])
+
+    return row_ids, offsets, neighbors
+
+
+def remap_row_block(block, to_global):
+
+    row_ids, offsets, neighbors = block
+
+    return to_global[row_ids], offsets, to_global[neighbors]
+
+
+# Citation graph over the paper indices of a PaperIdRegistry, stored as
+# compressed sparse rows: the papers cited by paper `i` are
+# `neighbors[offsets[i]:offsets[i+1]]`, in the order they were recorded.
+# Papers that are not query papers simply have empty rows.
+class CitationGraph:
+
+    def __init__(self, offsets, neighbors):
+        self.offsets = offsets
+        self.neighbors = neighbors
+
+    @property
+    def num_nodes(self):
+        return len(self.offsets) - 1
+
+    @property
+    def num_edges(self):
+        return len(self.neighbors)
+
+    @classmethod
+    def from_edges(cls, num_nodes, sources, targets):
+
+        # Stable sort keeps the original citation order within each row
+        order = numpy.argsort(sources, kind='stable')
+
+        offsets = numpy.zeros(num_nodes + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(sources, minlength=num_nodes), out=offsets[1:])
+
+        return cls(offsets, targets[order])
+
+    @classmethod
+    def from_row_blocks(cls, num_nodes, blocks, allocate_neighbors=None):
+
+        # If the same row appears in more than one block, the last one wins,
+        # just like dict.update() would do with the shard dicts.
+        row_owner = numpy.full(num_nodes, -1, dtype=numpy.int32)
+
+        for i, (row_ids, _, _) in enumerate(blocks):
+            row_owner[row_ids] = i
+
+        degrees = numpy.zeros(num_nodes, dtype=numpy.int64)
+
+        for i, (row_ids, offsets, _) in enumerate(blocks):
+            owned = row_owner[row_ids] == i
+            degrees[row_ids[owned]] = numpy.diff(offsets)[owned]
+
+        graph_offsets = numpy.zeros(num_nodes + 1, dtype=numpy.int64)
+        numpy.cumsum(degrees, out=graph_offsets[1:])
+
+        del degrees
+
+        # Each block's rows are copied straight to their place in `neighbors`,
+        # so only one block's worth of temporaries is ever needed on top of
+        # the graph. `allocate_neighbors(num_edges)` can return e.g. a
+        # writable memory-mapped array instead of one in memory.
+        if allocate_neighbors is None:
+            neighbors = numpy.empty(graph_offsets[-1], dtype=numpy.int64)
+        else:
+            neighbors = allocate_neighbors(int(graph_offsets[-1]))
+
+        for i, (row_ids, offsets, block_neighbors) in enumerate(blocks):
+            edge_rows = numpy.repeat(numpy.arange(len(row_ids)), numpy.diff(offsets))
+            owned = (row_owner[row_ids] == i)[edge_rows]
+
+            # Row start in the graph + position of the edge within its row
+            destinations = (graph_offsets[row_ids] - offsets[:-1])[edge_rows] + numpy.arange(len(edge_rows))
+
+            neighbors[destinations[owned]] = block_neighbors[owned]
+
+        return cls(graph_offsets, neighbors)
+
+    def degrees(self):
+        return numpy.diff(self.offsets)
+
+    def cited_by(self, paper_id):
+        return self.neighbors[self.offsets[paper_id]:self.offsets[paper_id+1]]
+
+    def cited_by_many(self, paper_ids):
+
+        # Concatenation of the rows of all `paper_ids`, without a Python loop
+        paper_ids = numpy.asarray(paper_ids, dtype=numpy.int64)
+
+        starts = self.offsets[paper_ids]
+        lengths = self.offsets[paper_ids+1] - starts
+
+        if lengths.sum() == 0:
+            return self.neighbors[:0]
+
+        # Position of each gathered edge within its own row
+        row_starts = numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        positions = numpy.arange(lengths.sum()) - row_starts
+
+        return self.neighbors[numpy.repeat(starts, lengths) + positions]
+
+    def to_csr_matrix(self):
+
+        # Adjacency matrix sharing the offsets/neighbors arrays with this graph.
+        return scipy.sparse.csr_matrix(
+            (numpy.ones(self.num_edges, dtype=numpy.int32), self.neighbors, self.offsets),
+            shape=(self.num_nodes, self.num_nodes), copy=False)
+
+    def row_block(self, paper_ids):
+
+        paper_ids = numpy.asarray(paper_ids, dtype=numpy.int64)
+
+        offsets = numpy.zeros(len(paper_ids) + 1, dtype=numpy.int64)
+        numpy.cumsum(self.offsets[paper_ids+1] - self.offsets[paper_ids], out=offsets[1:])
+
+        return paper_ids, offsets, self.cited_by_many(paper_ids)
+
+
+# Bulk version of the "citation of a citation" search: for each paper in
+# `paper_ids`, the safe papers cited by its citations in `final_matrix`
+# (looked up in `direct_matrix`) that it doesn't cite directly.
+# This is (F[paper_ids] . A) masked by F and the safe ids, computed
+# `block_size` rows at a time so that the product never gets too large.
+#
+# Note that a paper can come back as an indirect citation of itself
+# (A cites B, B cites A). This is left in on purpose so that the result is
+# the same as that of the per-paper loop in get_indirect_citations.
+def get_two_hop_citations(direct_matrix, final_matrix, safe_mask, paper_ids, block_size=10000):
+
+    paper_ids = numpy.asarray(paper_ids, dtype=numpy.int64)
+    num_nodes = final_matrix.shape[1]
+
+    row_lengths = []
+    neighbors = []
+
+    for start in range(0, len(paper_ids), block_size):
+        block_ids = paper_ids[start:start+block_size]
+        block_final = final_matrix[block_ids]
+
+        two_hop = block_final @ direct_matrix
+        two_hop.sort_indices()
+
+        two_hop_rows = numpy.repeat(numpy.arange(len(block_ids)), numpy.diff(two_hop.indptr))
+        final_rows = numpy.repeat(numpy.arange(len(block_ids)), numpy.diff(block_final.indptr))
+
+        # (row, column) pairs as single int64 keys, to mask out direct citations
+        keep = safe_mask[two_hop.indices] & numpy.isin(
+            two_hop_rows * num_nodes + two_hop.indices,
+            final_rows * num_nodes + block_final.indices,
+            invert=True)
+
+        row_lengths.append(numpy.bincount(two_hop_rows[keep], minlength=len(block_ids)))
+        neighbors.append(two_hop.indices[keep].astype(numpy.int64))
+
+    offsets = numpy.zeros(len(paper_ids) + 1, dtype=numpy.int64)
+
+    if len(paper_ids) > 0:
+        numpy.cumsum(numpy.concatenate(row_lengths), out=offsets[1:])
+
+    return paper_ids, offsets, numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + neighbors)
+
+
+# Drops the citations for which `keep_mask` is False from a row block, and
+# then the rows left without any citations, all in one vectorized pass.
+def filter_row_block(block, keep_mask):
+
+    row_ids, offsets, neighbors = block
+
+    edge_rows = numpy.repeat(numpy.arange(len(row_ids)), numpy.diff(offsets))
+    kept_edges = keep_mask[neighbors]
+
+    kept_degrees = numpy.bincount(edge_rows[kept_edges], minlength=len(row_ids))
+    kept_rows = kept_degrees > 0
+
+    output_offsets = numpy.zeros(kept_rows.sum() + 1, dtype=numpy.int64)
+    numpy.cumsum(kept_degrees[kept_rows], out=output_offsets[1:])
+
+    return row_ids[kept_rows], output_offsets, neighbors[kept_edges & kept_rows[edge_rows]]
+
+
+# The rows of a row block for which `row_mask` is True
+def select_rows(block, row_mask):
+
+    row_ids, offsets, neighbors = block
+
+    edge_rows = numpy.repeat(numpy.arange(len(row_ids)), numpy.diff(offsets))
+
+    output_offsets = numpy.zeros(row_mask.sum() + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.diff(offsets)[row_mask], out=output_offsets[1:])
+
+    return row_ids[row_mask], output_offsets, neighbors[row_mask[edge_rows]]
+
+
+# Bulk co-citation search: for each paper in `paper_ids`, the papers cited
+# by the papers citing it (its rows in `cited_by_graph`, looked up in
+# `cites_graph`), counted once per citing paper, leaving out the paper
+# itself. Of these, only the `max count` most co-cited ones are kept, ties
+# going to the one that comes first in the citing papers' lists, which is
+# what taking Counter.most_common(max(counter.values())) per paper gives.
+#
+# All the (paper, co-cited paper) pairs of `block_size` papers are counted
+# at once with numpy.unique rather than a Counter per paper. Returns the
+# kept papers as a row block, along with their counts.
+def get_top_cocitations(cites_graph, cited_by_graph, paper_ids, block_size=10000):
+
+    paper_ids = numpy.asarray(paper_ids, dtype=numpy.int64)
+    num_nodes = cites_graph.num_nodes
+    cites_degrees = cites_graph.degrees()
+
+    row_lengths = []
+    neighbors = []
+    counts = []
+
+    for start in range(0, len(paper_ids), block_size):
+        block_ids = paper_ids[start:start+block_size]
+
+        _, citing_offsets, citing_ids = cited_by_graph.row_block(block_ids)
+        citing_rows = numpy.repeat(numpy.arange(len(block_ids)), numpy.diff(citing_offsets))
+
+        cocited = cites_graph.cited_by_many(citing_ids)
+        cocited_rows = numpy.repeat(citing_rows, cites_degrees[citing_ids])
+
+        not_self = cocited != block_ids[cocited_rows]
+
+        # First position and number of occurrences of each (row, paper) pair
+        pairs, first_seen, pair_counts = numpy.unique(
+            cocited_rows[not_self] * num_nodes + cocited[not_self], return_index=True, return_counts=True)
+
+        pair_rows = pairs // num_nodes
+
+        # Within each row: most co-cited first, then in order of appearance
+        order = numpy.lexsort((first_seen, -pair_counts, pair_rows))
+
+        pairs = pairs[order]
+        pair_rows = pair_rows[order]
+        pair_counts = pair_counts[order]
+
+        block_row_lengths = numpy.bincount(pair_rows, minlength=len(block_ids))
+
+        row_starts = numpy.cumsum(block_row_lengths) - block_row_lengths
+        ranks = numpy.arange(len(pairs)) - row_starts[pair_rows]
+
+        # The first pair of each row has the row's highest count
+        max_counts = numpy.zeros(len(block_ids), dtype=numpy.int64)
+        max_counts[block_row_lengths > 0] = pair_counts[row_starts[block_row_lengths > 0]]
+
+        keep = ranks < max_counts[pair_rows]
+
+        row_lengths.append(numpy.bincount(pair_rows[keep], minlength=len(block_ids)))
+        neighbors.append(pairs[keep] % num_nodes)
+        counts.append(pair_counts[keep])
+
+    offsets = numpy.zeros(len(paper_ids) + 1, dtype=numpy.int64)
+
+    if len(paper_ids) > 0:
+        numpy.cumsum(numpy.concatenate(row_lengths), out=offsets[1:])
+
+    empty = [numpy.zeros(0, dtype=numpy.int64)]
+
+    return (paper_ids, offsets, numpy.concatenate(empty + neighbors)), numpy.concatenate(empty + counts)
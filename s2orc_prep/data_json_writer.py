@@ -0,0 +1,102 @@
+import os
+
+import ujson as json
+
+
+DATA_JSON_FORMATS = ['indent', 'compact', 'ndjson']
+
+
+# Writes `data.json` one query paper at a time, so that the whole citation
+# graph never has to be held in memory as a single dict just to be dumped.
+#
+# - 'indent': the same output as json.dump(..., indent=2)
+# - 'compact': the same JSON object without any whitespace
+# - 'ndjson': one {paper_id: citations} object per line
+#
+# The output goes to `path + '.tmp'` and only replaces `path` once it is
+# complete. If the `with` block fails, the partial file is removed instead,
+# so that a failed run never leaves a valid-looking, truncated file behind.
+class DataJsonWriter:
+
+    def __init__(self, path, data_format='indent'):
+        if data_format not in DATA_JSON_FORMATS:
+            raise Exception("Invalid data.json format: {}".format(data_format))
+
+        self.data_format = data_format
+        self.num_written = 0
+
+        self.path = path
+        self.tmp_path = path + '.tmp'
+
+        self.output_file = open(self.tmp_path, 'w+')
+
+        if self.data_format != 'ndjson':
+            self.output_file.write('{')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, paper_id, citations):
+
+        if self.data_format == 'ndjson':
+            self.output_file.write(json.dumps({paper_id: citations}) + '\n')
+        else:
+            if self.num_written > 0:
+                self.output_file.write(',')
+
+            if self.data_format == 'indent':
+                self.output_file.write(
+                    '\n  ' + json.dumps(paper_id) + ': ' + json.dumps(citations, indent=2).replace('\n', '\n  '))
+            else:
+                self.output_file.write(json.dumps(paper_id) + ':' + json.dumps(citations))
+
+        self.num_written += 1
+
+    def close(self):
+
+        if self.output_file.closed:
+            return
+
+        if self.data_format == 'indent' and self.num_written > 0:
+            self.output_file.write('\n}')
+        elif self.data_format != 'ndjson':
+            self.output_file.write('}')
+
+        self.output_file.close()
+
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+
+        if self.output_file.closed:
+            return
+
+        self.output_file.close()
+
+        os.remove(self.tmp_path)
+
+
+# Reads data.json written in any of the formats above.
+def load_data_json(path):
+
+    with open(path, 'r') as data_file:
+        try:
+            return json.load(data_file)
+        except ValueError:
+            # Not a single JSON document: one object per line (ndjson)
+            data_file.seek(0)
+
+            data = {}
+
+            for line in data_file:
+                if line.strip():
+                    data.update(json.loads(line))
+
+            return data
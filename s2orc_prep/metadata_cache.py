@@ -0,0 +1,279 @@
+import os
+import shutil
+
+import numpy
+import ujson as json
+
+from s2orc_prep.paper_id_registry import PaperIdRegistry
+from s2orc_prep.shard_reader import iter_shard_lines
+
+
+# Columnar copy of the parts of a metadata shard that the part 1 scripts use,
+# stored as .npy files that are memory-mapped when read back. Cache
+# directories are named after the size and modification time of the shard
+# file, so a changed shard is never read from a stale cache, without
+# reading the whole shard again to check it.
+#
+# Paper ids are stored once in a shard-local id table; records and their
+# citations refer to them by index.
+FLAG_HAS_PDF_PARSE = 1
+FLAG_HAS_PDF_PARSED_ABSTRACT = 2
+FLAG_HAS_OUTBOUND_CITATIONS = 4
+FLAG_HAS_INBOUND_CITATIONS = 8
+# has_pdf_parsed_abstract is missing from records without a pdf parse
+FLAG_HAS_PDF_PARSED_ABSTRACT_KEY = 16
+FLAG_TITLE_IS_NONE = 32
+
+CACHE_VERSION = 1
+
+
+def get_cache_path(shard_path, cache_dir):
+
+    shard_stat = os.stat(shard_path)
+
+    return os.path.join(
+        cache_dir,
+        '{}.{}-{}.v{}'.format(os.path.basename(shard_path), shard_stat.st_size, shard_stat.st_mtime_ns, CACHE_VERSION))
+
+
+def _save_strings(cache_path, name, strings):
+
+    encoded = [s.encode('utf-8') for s in strings]
+
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(s) for s in encoded], out=offsets[1:])
+
+    numpy.save(os.path.join(cache_path, name + '_offsets.npy'), offsets)
+    numpy.save(os.path.join(cache_path, name + '_blob.npy'), numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8))
+
+
+def _save_lists(cache_path, name, lists, dtype):
+
+    offsets = numpy.zeros(len(lists) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(l) for l in lists], out=offsets[1:])
+
+    numpy.save(os.path.join(cache_path, name + '_offsets.npy'), offsets)
+    numpy.save(
+        os.path.join(cache_path, name + '.npy'),
+        numpy.concatenate([numpy.zeros(0, dtype=dtype)] + [numpy.asarray(l, dtype=dtype) for l in lists]))
+
+
+def build_metadata_cache(shard_path, cache_path):
+
+    shard_registry = PaperIdRegistry()
+    field_codes = PaperIdRegistry()
+
+    record_ids = []
+    flags = []
+    titles = []
+    mag_fields = []
+    outbound_citations = []
+    inbound_citations = []
+
+    for line in iter_shard_lines(shard_path):
+        paper = json.loads(line)
+
+        record_ids.append(shard_registry.intern(paper['paper_id']))
+
+        flag = 0
+
+        if paper['has_pdf_parse']:
+            flag |= FLAG_HAS_PDF_PARSE
+
+        if 'has_pdf_parsed_abstract' in paper:
+            flag |= FLAG_HAS_PDF_PARSED_ABSTRACT_KEY
+
+            if paper['has_pdf_parsed_abstract']:
+                flag |= FLAG_HAS_PDF_PARSED_ABSTRACT
+
+        if paper['has_outbound_citations']:
+            flag |= FLAG_HAS_OUTBOUND_CITATIONS
+
+        if paper['has_inbound_citations']:
+            flag |= FLAG_HAS_INBOUND_CITATIONS
+
+        if paper['title'] is None:
+            flag |= FLAG_TITLE_IS_NONE
+
+        flags.append(flag)
+        titles.append(paper['title'] or '')
+        mag_fields.append([field_codes.intern(f) for f in paper['mag_field_of_study'] or []])
+        outbound_citations.append(shard_registry.intern_many(paper['outbound_citations']))
+        inbound_citations.append(shard_registry.intern_many(paper['inbound_citations']))
+
+    # Write everything to a temporary directory first, so that a crashed run
+    # never leaves a half-written cache behind.
+    tmp_cache_path = cache_path + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp_cache_path)
+
+    numpy.save(os.path.join(tmp_cache_path, 'record_ids.npy'), numpy.array(record_ids, dtype=numpy.int64))
+    numpy.save(os.path.join(tmp_cache_path, 'flags.npy'), numpy.array(flags, dtype=numpy.uint8))
+    _save_strings(tmp_cache_path, 'paper_ids', shard_registry.paper_ids)
+    _save_strings(tmp_cache_path, 'titles', titles)
+    _save_lists(tmp_cache_path, 'mag_fields', mag_fields, numpy.int16)
+    _save_lists(tmp_cache_path, 'outbound_citations', outbound_citations, numpy.int64)
+    _save_lists(tmp_cache_path, 'inbound_citations', inbound_citations, numpy.int64)
+
+    with open(os.path.join(tmp_cache_path, 'info.json'), 'w') as info_file:
+        json.dump({'version': CACHE_VERSION, 'fields': field_codes.paper_ids, 'num_records': len(record_ids)}, info_file)
+
+    try:
+        os.rename(tmp_cache_path, cache_path)
+    except OSError:
+        # Another run has just built the same cache
+        shutil.rmtree(tmp_cache_path)
+
+
+class MetadataCacheShard:
+
+    def __init__(self, cache_path):
+
+        def load(name):
+            return numpy.load(os.path.join(cache_path, name + '.npy'), mmap_mode='r')
+
+        with open(os.path.join(cache_path, 'info.json'), 'r') as info_file:
+            info = json.load(info_file)
+
+        self.fields = info['fields']
+
+        self.record_ids = load('record_ids')
+        self.flags = load('flags')
+        self.paper_ids_offsets = load('paper_ids_offsets')
+        self.paper_ids_blob = load('paper_ids_blob')
+        self.titles_offsets = load('titles_offsets')
+        self.titles_blob = load('titles_blob')
+        self.mag_fields_offsets = load('mag_fields_offsets')
+        self.mag_fields = load('mag_fields')
+        self.outbound_citations_offsets = load('outbound_citations_offsets')
+        self.outbound_citations = load('outbound_citations')
+        self.inbound_citations_offsets = load('inbound_citations_offsets')
+        self.inbound_citations = load('inbound_citations')
+
+    def __len__(self):
+        return len(self.record_ids)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield CachedMetadataRecord(self, i)
+
+    @property
+    def num_paper_ids(self):
+        return len(self.paper_ids_offsets) - 1
+
+    def get_paper_id(self, index):
+        return self.paper_ids_blob[self.paper_ids_offsets[index]:self.paper_ids_offsets[index+1]].tobytes().decode('utf-8')
+
+    def close(self):
+        pass
+
+
+# Looks like the dict returned by json.loads() for the fields the part 1
+# scripts use, but only reads a field from the cache when it is accessed.
+# 'paper_id' and the citation lists are left as indices into the cache's id
+# table, to be interned by a CachedPaperIdRegistry.
+class CachedMetadataRecord(dict):
+
+    def __init__(self, cache_shard, record_num):
+        super().__init__()
+
+        self.cache_shard = cache_shard
+        self.record_num = record_num
+
+    def __missing__(self, field):
+
+        shard = self.cache_shard
+        i = self.record_num
+        flag = int(shard.flags[i])
+
+        if field == 'paper_id':
+            value = int(shard.record_ids[i])
+        elif field == 'title':
+            if flag & FLAG_TITLE_IS_NONE:
+                value = None
+            else:
+                value = shard.titles_blob[shard.titles_offsets[i]:shard.titles_offsets[i+1]].tobytes().decode('utf-8')
+        elif field == 'mag_field_of_study':
+            value = [
+                shard.fields[c]
+                for c in shard.mag_fields[shard.mag_fields_offsets[i]:shard.mag_fields_offsets[i+1]].tolist()]
+        elif field == 'has_pdf_parse':
+            value = bool(flag & FLAG_HAS_PDF_PARSE)
+        elif field == 'has_pdf_parsed_abstract':
+            if not flag & FLAG_HAS_PDF_PARSED_ABSTRACT_KEY:
+                raise KeyError(field)
+
+            value = bool(flag & FLAG_HAS_PDF_PARSED_ABSTRACT)
+        elif field == 'has_outbound_citations':
+            value = bool(flag & FLAG_HAS_OUTBOUND_CITATIONS)
+        elif field == 'has_inbound_citations':
+            value = bool(flag & FLAG_HAS_INBOUND_CITATIONS)
+        elif field == 'outbound_citations':
+            value = shard.outbound_citations[shard.outbound_citations_offsets[i]:shard.outbound_citations_offsets[i+1]]
+        elif field == 'inbound_citations':
+            value = shard.inbound_citations[shard.inbound_citations_offsets[i]:shard.inbound_citations_offsets[i+1]]
+        else:
+            raise KeyError(field)
+
+        self[field] = value
+
+        return value
+
+
+# Shard-local registry for the records of a MetadataCacheShard, interning
+# indices into the cache's id table rather than paper id strings. It gives
+# out the same indices, in the same order, as a PaperIdRegistry fed with the
+# strings would, but a paper id is only decoded when it is looked up.
+class CachedPaperIdRegistry:
+
+    def __init__(self, cache_shard):
+        self.cache_shard = cache_shard
+
+        # Shard-local index of every entry of the id table, -1 until interned
+        self._index = numpy.full(cache_shard.num_paper_ids, -1, dtype=numpy.int64)
+        self._table_ids = []
+
+    def __len__(self):
+        return len(self._table_ids)
+
+    def __getitem__(self, index):
+        return self.cache_shard.get_paper_id(self._table_ids[index])
+
+    @property
+    def paper_ids(self):
+        return [self.cache_shard.get_paper_id(t) for t in self._table_ids]
+
+    def intern(self, table_id):
+        index = int(self._index[table_id])
+
+        if index < 0:
+            index = len(self._table_ids)
+            self._index[table_id] = index
+            self._table_ids.append(table_id)
+
+        return index
+
+    def intern_many(self, table_ids):
+        table_ids = numpy.asarray(table_ids, dtype=numpy.int64)
+
+        # Ids not interned yet, in the order they first come up
+        new_table_ids = table_ids[self._index[table_ids] < 0]
+        _, first_positions = numpy.unique(new_table_ids, return_index=True)
+        new_table_ids = new_table_ids[numpy.sort(first_positions)]
+
+        self._index[new_table_ids] = numpy.arange(len(self._table_ids), len(self._table_ids) + len(new_table_ids))
+        self._table_ids.extend(new_table_ids.tolist())
+
+        return self._index[table_ids]
+
+
+# Returns the cached copy of a metadata shard, building it first if this
+# version of the shard hasn't been cached yet.
+def open_metadata_cache(shard_path, cache_dir):
+
+    cache_path = get_cache_path(shard_path, cache_dir)
+
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        build_metadata_cache(shard_path, cache_path)
+
+    return MetadataCacheShard(cache_path)
@@ -0,0 +1,217 @@
+import time
+import resource
+import collections
+
+import ujson as json
+import tqdm
+
+from s2orc_prep import profiling
+
+
+# Counters of the shard task currently running in this process. Workers
+# bump them with plain dict increments (no locks, no terminal output), and
+# they are sent back to the parent once, along with the task's result.
+_task_counters = collections.Counter()
+
+# The stage the parent is currently running, which receives the counters
+# of every finished task
+_active_stage = None
+
+
+def get_task_counters():
+    return _task_counters
+
+
+def get_peak_rss(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def start_task():
+
+    _task_counters.clear()
+
+    return time.time()
+
+
+def finish_task(start_time, task_profile=None):
+
+    return {
+        'counters': dict(_task_counters),
+        'task_time': time.time() - start_time,
+        'peak_rss': get_peak_rss(),
+        'profile': task_profile,
+    }
+
+
+def record_task(task_stats):
+
+    if _active_stage is not None:
+        _active_stage.add_task(task_stats)
+
+
+def record_resumed_task():
+
+    if _active_stage is not None:
+        _active_stage.resumed_shards += 1
+
+
+def _format_count(n):
+
+    for unit in ['', 'k', 'M', 'G']:
+        if abs(n) < 1000:
+            return '{:.1f}{}'.format(n, unit) if unit else '{:.0f}'.format(n)
+
+        n /= 1000
+
+    return '{:.1f}T'.format(n)
+
+
+class StageMetrics:
+
+    def __init__(self, name):
+
+        self.name = name
+        self.start_time = time.time()
+        self.wall_time = 0
+
+        self.counters = collections.Counter()
+        self.shards = 0
+        self.resumed_shards = 0
+        self.task_time = 0
+        self.workers_peak_rss = 0
+        self.parent_peak_rss = 0
+
+        self.profile = profiling.StageProfile(name) if profiling.is_enabled() else None
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def add_task(self, task_stats):
+
+        self.counters.update(task_stats['counters'])
+        self.shards += 1
+        self.task_time += task_stats['task_time']
+        self.workers_peak_rss = max(self.workers_peak_rss, task_stats['peak_rss'])
+
+        if task_stats['profile'] is not None:
+            self.profile.add_task(task_stats['profile'])
+
+    def get_records_per_sec(self):
+        return self.counters['records'] / max(time.time() - self.start_time, 1e-9)
+
+    def get_progress(self):
+
+        progress = []
+
+        if self.counters['records'] > 0:
+            progress.append('{} records, {}/s'.format(
+                _format_count(self.counters['records']), _format_count(self.get_records_per_sec())))
+
+        if self.counters['bytes_decompressed'] > 0:
+            progress.append('{}B decompressed'.format(_format_count(self.counters['bytes_decompressed'])))
+
+        return ', '.join(progress)
+
+    # Wraps the (shard, result) pairs coming out of imap_shards() in a single
+    # progress bar for the whole stage.
+    def track(self, shard_results, total):
+
+        pbar = tqdm.tqdm(shard_results, total=total, desc=self.name)
+
+        for shard_result in pbar:
+            pbar.set_postfix_str(self.get_progress(), refresh=False)
+
+            yield shard_result
+
+    def to_dict(self):
+
+        filtered = {
+            name[len('filtered_'):]: n for name, n in sorted(self.counters.items()) if name.startswith('filtered_')}
+
+        return {
+            'name': self.name,
+            'wall_time': self.wall_time,
+            'task_time': self.task_time,
+            'shards': self.shards,
+            'resumed_shards': self.resumed_shards,
+            'records': self.counters['records'],
+            'records_per_sec': self.counters['records'] / max(self.wall_time, 1e-9),
+            'bytes_decompressed': self.counters['bytes_decompressed'],
+            'filtered': filtered,
+            'counters': {
+                name: n for name, n in sorted(self.counters.items())
+                if not name.startswith('filtered_') and name not in ('records', 'bytes_decompressed')},
+            'workers_peak_rss': self.workers_peak_rss,
+            'parent_peak_rss': self.parent_peak_rss,
+        }
+
+
+# Collects the metrics of every stage of a script, e.g.
+#
+#     stage = report.start_stage('metadata')
+#
+#     for shard_num, result in stage.track(imap_shards(...), total=...):
+#         ...
+#
+#     stage = report.start_stage('splits')
+#     ...
+#     report.write(path)
+#
+# Starting a stage finishes the previous one.
+class MetricsReport:
+
+    def __init__(self):
+
+        self.start_time = time.time()
+        self.stages = []
+
+    def start_stage(self, name):
+
+        global _active_stage
+
+        self.finish_stage()
+
+        _active_stage = StageMetrics(name)
+
+        return _active_stage
+
+    def finish_stage(self):
+
+        global _active_stage
+
+        stage = _active_stage
+
+        if stage is None:
+            return
+
+        _active_stage = None
+
+        stage.wall_time = time.time() - stage.start_time
+        stage.parent_peak_rss = get_peak_rss()
+
+        if stage.profile is not None:
+            stage.profile.finish()
+
+        self.stages.append(stage)
+
+        if stage.workers_peak_rss > 0:
+            peak_rss = 'peak RSS {}B (workers) / {}B (main)'.format(
+                _format_count(stage.workers_peak_rss), _format_count(stage.parent_peak_rss))
+        else:
+            peak_rss = 'peak RSS {}B'.format(_format_count(stage.parent_peak_rss))
+
+        print("[{}] {}".format(
+            stage.name, ', '.join(filter(None, ['{:.1f}s'.format(stage.wall_time), stage.get_progress(), peak_rss]))))
+
+    def write(self, path):
+
+        self.finish_stage()
+
+        with open(path, 'w') as report_file:
+            json.dump({
+                'wall_time': time.time() - self.start_time,
+                'peak_rss': get_peak_rss(),
+                'children_peak_rss': get_peak_rss(resource.RUSAGE_CHILDREN),
+                'stages': [stage.to_dict() for stage in self.stages],
+            }, report_file, indent=2)
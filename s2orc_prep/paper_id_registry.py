@@ -0,0 +1,48 @@
+import numpy
+
+
+# Interns S2ORC paper id strings into dense integer indices, so that the
+# citation graph and the per-paper tables can be keyed by small ints instead
+# of separate copies of the id strings. Indices are assigned in the order
+# the ids are first seen; the strings are only needed again at output time.
+class PaperIdRegistry:
+
+    def __init__(self, paper_ids=None):
+        self._index = {}
+        self._paper_ids = []
+
+        if paper_ids is not None:
+            self.intern_many(paper_ids)
+
+    def __len__(self):
+        return len(self._paper_ids)
+
+    def __contains__(self, paper_id):
+        return paper_id in self._index
+
+    def __getitem__(self, index):
+        return self._paper_ids[index]
+
+    @property
+    def paper_ids(self):
+        return self._paper_ids
+
+    def intern(self, paper_id):
+        index = self._index.get(paper_id)
+
+        if index is None:
+            index = len(self._paper_ids)
+            self._index[paper_id] = index
+            self._paper_ids.append(paper_id)
+
+        return index
+
+    def intern_many(self, paper_ids):
+        return numpy.fromiter(
+            (self.intern(p_id) for p_id in paper_ids), dtype=numpy.int64, count=len(paper_ids))
+
+    def get(self, paper_id, default=-1):
+        return self._index.get(paper_id, default)
+
+    def to_paper_ids(self, indices):
+        return [self._paper_ids[i] for i in indices]
@@ -0,0 +1,203 @@
+import os
+import shutil
+
+import numpy
+import ujson as json
+
+
+# Binary replacement for paper_ids.json, safe_paper_ids.json and titles.json
+# (--intermediate_format binary in the part 1 scripts): a directory of .npy
+# files that part 2 and part 3 memory-map instead of parsing the JSON.
+#
+# - paper_ids_blob/paper_ids_offsets: every paper of safe_paper_ids.json,
+#   sorted by paper id, so that a paper id can be found by binary search
+# - shards: the shard # of each of these papers (int8, -1 for unsafe ones)
+# - titles_blob/titles_offsets/title_flags: the title of each paper
+# - selected_rows: the rows of the papers of paper_ids.json, in its order
+PAPER_TABLE_VERSION = 1
+
+INTERMEDIATE_FORMATS = ['json', 'binary']
+
+TITLE_MISSING = 1
+TITLE_IS_NONE = 2
+
+
+def _save_offsets(path, name, lengths):
+
+    offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+
+    numpy.save(os.path.join(path, name + '_offsets.npy'), offsets)
+
+    return offsets
+
+
+# `shards` is the shard # of every paper of `registry` (-2 for papers not in
+# safe_paper_ids.json), `titles` is the TitleStore written by the part 1
+# workers, and `selected` is the list of paper indices of paper_ids.json.
+def write_paper_table(path, registry, shards, titles, selected):
+
+    shards = numpy.asarray(shards)
+
+    paper_indices = numpy.flatnonzero(shards > -2)
+    paper_ids = registry.to_paper_ids(paper_indices.tolist())
+
+    order = sorted(range(len(paper_ids)), key=paper_ids.__getitem__)
+    paper_indices = paper_indices[order]
+
+    # Row of every paper index in the table
+    rows = numpy.full(len(registry), -1, dtype=numpy.int64)
+    rows[paper_indices] = numpy.arange(len(paper_indices))
+
+    # Written next to `path` first, so that a crashed run never leaves a
+    # half-written table behind
+    tmp_path = path + '.tmp'
+
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    encoded_ids = [paper_ids[i].encode('utf-8') for i in order]
+
+    _save_offsets(tmp_path, 'paper_ids', [len(p_id) for p_id in encoded_ids])
+    numpy.save(os.path.join(tmp_path, 'paper_ids_blob.npy'), numpy.frombuffer(b''.join(encoded_ids), dtype=numpy.uint8))
+
+    del encoded_ids, paper_ids
+
+    numpy.save(os.path.join(tmp_path, 'shards.npy'), shards[paper_indices].astype(numpy.int8))
+    numpy.save(os.path.join(tmp_path, 'selected_rows.npy'), rows[numpy.asarray(selected, dtype=numpy.int64)])
+
+    # Titles go through twice, first for their lengths and then to copy them
+    # into place, so that they never all have to be in memory at once
+    title_lengths = numpy.zeros(len(paper_indices), dtype=numpy.int64)
+    title_flags = numpy.full(len(paper_indices), TITLE_MISSING, dtype=numpy.uint8)
+
+    for p_id, title in titles.indexed_items(registry):
+        row = rows[p_id]
+
+        if row < 0:
+            continue
+
+        if title is None:
+            title_flags[row] = TITLE_IS_NONE
+        else:
+            title_flags[row] = 0
+            title_lengths[row] = len(title.encode('utf-8'))
+
+    title_offsets = _save_offsets(tmp_path, 'titles', title_lengths)
+    numpy.save(os.path.join(tmp_path, 'title_flags.npy'), title_flags)
+
+    titles_blob = numpy.lib.format.open_memmap(
+        os.path.join(tmp_path, 'titles_blob.npy'), mode='w+', dtype=numpy.uint8, shape=(int(title_offsets[-1]),))
+
+    for p_id, title in titles.indexed_items(registry):
+        row = rows[p_id]
+
+        if row >= 0 and title:
+            titles_blob[title_offsets[row]:title_offsets[row+1]] = numpy.frombuffer(title.encode('utf-8'), dtype=numpy.uint8)
+
+    titles_blob.flush()
+    del titles_blob
+
+    with open(os.path.join(tmp_path, 'info.json'), 'w') as info_file:
+        json.dump({
+            'version': PAPER_TABLE_VERSION,
+            'num_papers': len(paper_indices),
+            'num_selected': len(selected),
+        }, info_file)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+class PaperTable:
+
+    def __init__(self, path):
+
+        def load(name):
+            return numpy.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        with open(os.path.join(path, 'info.json'), 'r') as info_file:
+            info = json.load(info_file)
+
+        if info['version'] != PAPER_TABLE_VERSION:
+            raise Exception("{} was written by a different version of the part 1 scripts; run them again.".format(path))
+
+        self.paper_ids_offsets = load('paper_ids_offsets')
+        self.paper_ids_blob = load('paper_ids_blob')
+        self.shards = load('shards')
+        self.titles_offsets = load('titles_offsets')
+        self.titles_blob = load('titles_blob')
+        self.title_flags = load('title_flags')
+        self.selected_rows = load('selected_rows')
+
+    def __len__(self):
+        return len(self.shards)
+
+    def get_paper_id(self, row):
+        return self.paper_ids_blob[self.paper_ids_offsets[row]:self.paper_ids_offsets[row+1]].tobytes().decode('utf-8')
+
+    # Row of `paper_id`, or -1 if it isn't in the table
+    def find(self, paper_id):
+
+        low, high = 0, len(self)
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.get_paper_id(middle) < paper_id:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(self) and self.get_paper_id(low) == paper_id:
+            return low
+
+        return -1
+
+    def __contains__(self, paper_id):
+        return self.find(paper_id) >= 0
+
+    # Shard # of `paper_id`, as in safe_paper_ids.json
+    def get_shard(self, paper_id):
+
+        row = self.find(paper_id)
+
+        if row < 0:
+            raise KeyError(paper_id)
+
+        return int(self.shards[row])
+
+    # Title of the paper in `row`, as in titles.json
+    def get_title(self, row):
+
+        flag = self.title_flags[row]
+
+        if flag == TITLE_MISSING:
+            raise KeyError(self.get_paper_id(row))
+
+        if flag == TITLE_IS_NONE:
+            return None
+
+        return self.titles_blob[self.titles_offsets[row]:self.titles_offsets[row+1]].tobytes().decode('utf-8')
+
+    # The paper ids of paper_ids.json, in the same order
+    def get_selected_paper_ids(self):
+
+        blob = self.paper_ids_blob.tobytes()
+
+        starts = self.paper_ids_offsets[self.selected_rows].tolist()
+        ends = self.paper_ids_offsets[self.selected_rows + 1].tolist()
+
+        return [blob[start:end].decode('utf-8') for start, end in zip(starts, ends)]
+
+    # {paper_id: title} for the papers of paper_ids.json that have a title,
+    # which is all of titles.json that part 2 looks at
+    def get_selected_titles(self):
+
+        rows = self.selected_rows[self.title_flags[self.selected_rows] != TITLE_MISSING]
+
+        return {self.get_paper_id(row): self.get_title(row) for row in rows.tolist()}
+
+
+def get_paper_table_path(save_dir):
+    return os.path.join(save_dir, 'paper_table')
@@ -0,0 +1,140 @@
+import os
+import gc
+import sys
+import runpy
+import pathlib
+
+from s2orc_prep.shared_graph import remove_shared_dirs
+from s2orc_prep.profiling import disable_profiling
+
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# What the parts of a pipeline run by run_script() hand to the next part in
+# memory, instead of writing it to a file for the next part to load again.
+# None while no pipeline is running, i.e. when the scripts are run on their own.
+_handed_over = None
+
+# Whether the parts should still write the files they hand over
+_keep_intermediate_files = False
+
+
+def in_pipeline():
+    return _handed_over is not None
+
+
+def keep_intermediate_files():
+    return _keep_intermediate_files
+
+
+def hand_over(**values):
+    _handed_over.update(values)
+
+
+# The value handed over by the previous part, or None if there is none (the
+# script was run on its own, or the previous part didn't hand it over)
+def take_over(name):
+
+    if _handed_over is None:
+        return None
+
+    return _handed_over.pop(name, None)
+
+
+# Runs one of the prep scripts in this process, as if it had been run with
+# `python3 script argv...`. The script runs as __main__, so the pool workers
+# it forks find its functions and globals as usual.
+def run_script(script, argv):
+
+    saved_argv = sys.argv
+    sys.argv = [os.path.join(REPO_DIR, script)] + list(argv)
+
+    try:
+        # The script's globals are dropped right away, so that its data is freed
+        # before the next part starts
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    finally:
+        sys.argv = saved_argv
+
+        # Memory-mapped files the script published for its workers
+        remove_shared_dirs()
+
+        # --profile only applies to the script it was given to
+        disable_profiling()
+
+        gc.collect()
+
+
+def run_scripts(steps, keep_intermediate=False):
+
+    global _handed_over, _keep_intermediate_files
+
+    _handed_over = {}
+    _keep_intermediate_files = keep_intermediate
+
+    try:
+        for script, argv in steps:
+            print("Running {} {}".format(script, ' '.join(argv)))
+
+            run_script(script, argv)
+    finally:
+        _handed_over = None
+        _keep_intermediate_files = False
+
+
+# What part 2 would load from paper_ids.json and safe_paper_ids.json, given
+# the paper indices of paper_ids.json and the shard of every paper
+# (safe_paper_ids) of the part 1 scripts, for the papers of paper_ids.json
+# only (part 2 never looks up any others). Part 2 gets the titles from the
+# title store of part 1 instead of titles.json.
+def get_part2_inputs(registry, paper_ids, safe_paper_ids, title_store_dir):
+
+    return {
+        'paper_ids': registry.to_paper_ids(paper_ids),
+        'safe_paper_ids': {
+            registry[p_id]: shard_num for p_id, shard_num in zip(paper_ids, safe_paper_ids[paper_ids].tolist())},
+        'title_store': title_store_dir,
+    }
+
+
+def get_part2_input_paths(save_dir):
+    return [os.path.join(save_dir, name) for name in ['paper_ids.json', 'safe_paper_ids.json', 'titles.json']]
+
+
+# specter_prep_part1.py and specter_prep_part2.py on `data_dir`, writing to
+# `save_dir`. paper_ids.json and safe_paper_ids.json are passed to part 2 in
+# memory, and part 2 reads the titles it needs from part 1's title store;
+# the three files are only written with keep_intermediate.
+def run_specter_pipeline(
+    data_dir, save_dir, part1_args=(), part2_args=(), keep_intermediate=False):
+
+    run_scripts([
+        ('specter_prep_part1.py', [data_dir, save_dir] + list(part1_args)),
+        ('specter_prep_part2.py', get_part2_input_paths(save_dir) + [data_dir, save_dir] + list(part2_args)),
+    ], keep_intermediate)
+
+
+# scidocs-cite_prep_part1.py, part2.py and part3.py on `data_dir`, writing
+# to `save_dir`, and the qrels of test.txt to `qrel_path` (by default
+# save_dir/cite/test.qrel or save_dir/cocite/test.qrel). As in
+# run_specter_pipeline(), the intermediate files are passed on in memory;
+# data.json and data_final.json are outputs, and are still read from disk.
+def run_scidocs_pipeline(
+    data_dir, save_dir, cocite=False, qrel_path=None,
+    part1_args=(), part2_args=(), part3_args=(), keep_intermediate=False):
+
+    cocite_args = ['--cocite'] if cocite else []
+
+    if qrel_path is None:
+        qrel_path = os.path.join(save_dir, 'cocite' if cocite else 'cite', 'test.qrel')
+
+    pathlib.Path(os.path.dirname(os.path.abspath(qrel_path))).mkdir(parents=True, exist_ok=True)
+
+    run_scripts([
+        ('scidocs-cite_prep_part1.py', [data_dir, save_dir] + cocite_args + list(part1_args)),
+        ('scidocs-cite_prep_part2.py', [
+            os.path.join(save_dir, 'data.json')] + get_part2_input_paths(save_dir) + [data_dir, save_dir] + list(part2_args)),
+        ('scidocs-cite_prep_part3.py', [
+            os.path.join(save_dir, 'data_final.json'), os.path.join(save_dir, 'paper_ids.json'),
+            os.path.join(save_dir, 'test.txt'), qrel_path] + cocite_args + list(part3_args)),
+    ], keep_intermediate)
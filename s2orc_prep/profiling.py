@@ -0,0 +1,193 @@
+import os
+import io
+import pstats
+import cProfile
+import pathlib
+import collections
+import tracemalloc
+
+
+# Number of allocation sites kept from each task, and written for each stage
+TASK_ALLOCATION_SITES = 100
+STAGE_ALLOCATION_SITES = 50
+
+# Number of functions in the <stage>.txt summaries
+STAGE_PROFILE_FUNCTIONS = 50
+
+# Set by enable_profiling() in the parent before any pool is started, so
+# that the workers inherit them
+_profile_dir = None
+_trace_memory = False
+
+# The profiler of the stage the parent is currently running. A worker forked
+# during the stage inherits it (still enabled) and has to turn it off.
+_stage_profiler = None
+_parent_pid = None
+
+
+def enable_profiling(profile_dir, trace_memory=False):
+
+    global _profile_dir, _trace_memory, _parent_pid
+
+    pathlib.Path(profile_dir).mkdir(parents=True, exist_ok=True)
+
+    _profile_dir = profile_dir
+    _trace_memory = trace_memory
+    _parent_pid = os.getpid()
+
+
+# Back to not profiling, e.g. before s2orc_prep/pipeline.py runs the next script
+def disable_profiling():
+
+    global _profile_dir, _trace_memory, _parent_pid
+
+    _profile_dir = None
+    _trace_memory = False
+    _parent_pid = None
+
+
+def is_enabled():
+    return _profile_dir is not None
+
+
+def start_task():
+
+    if not is_enabled():
+        return None
+
+    if _stage_profiler is not None and os.getpid() != _parent_pid:
+        _stage_profiler.disable()
+
+    if _trace_memory:
+        tracemalloc.start()
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    return profiler
+
+
+# The raw cProfile stats of the task (only its main thread, not e.g. the
+# --reader_threads) and, with --profile_memory, the lines that allocated the
+# memory still held at the end of the task (mostly its result) and the
+# task's peak traced memory.
+def finish_task(profiler):
+
+    if profiler is None:
+        return None
+
+    profiler.disable()
+
+    task_profile = {}
+
+    if _trace_memory:
+        _, peak_traced = tracemalloc.get_traced_memory()
+
+        # Leave out the memory taken up by the profiler itself
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, cProfile.__file__), tracemalloc.Filter(False, tracemalloc.__file__)])
+
+        tracemalloc.stop()
+
+        task_profile['allocations'] = [
+            ('{}:{}'.format(stat.traceback[0].filename, stat.traceback[0].lineno), stat.size, stat.count)
+            for stat in snapshot.statistics('lineno')[:TASK_ALLOCATION_SITES]]
+        task_profile['peak_traced'] = peak_traced
+
+    profiler.create_stats()
+
+    task_profile['stats'] = profiler.stats
+
+    return task_profile
+
+
+# pstats.Stats only loads files and profiler objects; this passes it the
+# stats a worker sent back.
+class _RawStats:
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+# The profiles of every task of a stage, and of the parent while it ran the
+# stage, merged into one.
+class StageProfile:
+
+    def __init__(self, name):
+
+        global _stage_profiler
+
+        self.name = name
+
+        self.stats = None
+        self.tasks = 0
+
+        self.allocation_sizes = collections.Counter()
+        self.allocation_counts = collections.Counter()
+        self.peak_traced = 0
+
+        self.parent_profiler = cProfile.Profile()
+        self.parent_profiler.enable()
+
+        _stage_profiler = self.parent_profiler
+
+    def add_stats(self, stats):
+
+        if self.stats is None:
+            self.stats = pstats.Stats(stats)
+        else:
+            self.stats.add(stats)
+
+    def add_task(self, task_profile):
+
+        # Merging the profiles is not part of the stage
+        self.parent_profiler.disable()
+
+        self.add_stats(_RawStats(task_profile['stats']))
+        self.tasks += 1
+
+        for site, size, count in task_profile.get('allocations', ()):
+            self.allocation_sizes[site] += size
+            self.allocation_counts[site] += count
+
+        self.peak_traced = max(self.peak_traced, task_profile.get('peak_traced', 0))
+
+        self.parent_profiler.enable()
+
+    # Writes <stage>.prof (for pstats, snakeviz, ...), <stage>.txt with the
+    # functions taking the most cumulative time, and with --profile_memory
+    # <stage>_memory.txt with the top allocation sites.
+    def finish(self):
+
+        global _stage_profiler
+
+        self.parent_profiler.disable()
+        _stage_profiler = None
+
+        self.add_stats(self.parent_profiler)
+
+        self.stats.dump_stats(os.path.join(_profile_dir, self.name + '.prof'))
+
+        summary = io.StringIO()
+        summary.write("{}: main process and {} worker tasks\n".format(self.name, self.tasks))
+
+        self.stats.stream = summary
+        self.stats.sort_stats('cumulative').print_stats(STAGE_PROFILE_FUNCTIONS)
+
+        with open(os.path.join(_profile_dir, self.name + '.txt'), 'w') as summary_file:
+            summary_file.write(summary.getvalue())
+
+        if not _trace_memory or self.tasks == 0:
+            return
+
+        with open(os.path.join(_profile_dir, self.name + '_memory.txt'), 'w') as memory_file:
+            memory_file.write("{}: memory held at the end of {} worker tasks, by line (peak traced in one task: {:.1f} MiB)\n\n".format(
+                self.name, self.tasks, self.peak_traced / (1 << 20)))
+
+            memory_file.write("{:>12} {:>10}  {}\n".format('KiB', 'blocks', 'line'))
+
+            for site, size in self.allocation_sizes.most_common(STAGE_ALLOCATION_SITES):
+                memory_file.write("{:>12.1f} {:>10}  {}\n".format(size / 1024, self.allocation_counts[site], site))
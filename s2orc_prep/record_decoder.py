@@ -0,0 +1,102 @@
+import json as std_json
+
+import ujson as json
+
+
+RECORD_DECODERS = ['ujson', 'projected']
+
+# Top-level fields each of the shard readers needs
+METADATA_FIELDS = [
+    'paper_id', 'title', 'mag_field_of_study',
+    'has_pdf_parse', 'has_pdf_parsed_abstract',
+    'has_outbound_citations', 'has_inbound_citations',
+    'outbound_citations', 'inbound_citations',
+]
+
+PDF_PARSES_FIELDS = ['paper_id', 'abstract']
+
+_raw_decode = std_json.JSONDecoder().raw_decode
+
+
+# A record that only holds the raw jsonl line, and decodes a top-level
+# field the first time it is accessed. Fields are located by searching for
+# their key, which relies on the requested keys not also appearing inside
+# any value that comes before them in the line. This holds for the S2ORC
+# fields listed above, since they all come before the nested parts of the
+# records (authors, body_text, bib_entries, ...) or use different keys.
+class ProjectedRecord(dict):
+
+    def __init__(self, line, fields):
+        super().__init__()
+
+        self.line = line
+        self.fields = fields
+
+    def __missing__(self, field):
+
+        if field not in self.fields:
+            raise KeyError(field)
+
+        key_start = self.line.find('"' + field + '":')
+
+        if key_start < 0:
+            raise KeyError(field)
+
+        value_start = key_start + len(field) + 3
+
+        while self.line[value_start] in ' \t':
+            value_start += 1
+
+        value = _raw_decode(self.line, value_start)[0]
+        self[field] = value
+
+        return value
+
+
+class UjsonRecordDecoder:
+
+    def __init__(self, fields=None):
+        self.fields = fields
+
+    def decode(self, line, paper_ids=None):
+
+        paper = json.loads(line)
+
+        if paper_ids is not None and paper['paper_id'] not in paper_ids:
+            return None
+
+        return paper
+
+
+class ProjectedRecordDecoder:
+
+    def __init__(self, fields):
+        self.fields = frozenset(fields)
+        self.fallback = UjsonRecordDecoder(fields)
+
+    def decode(self, line, paper_ids=None):
+
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+
+        paper = ProjectedRecord(line, self.fields)
+
+        try:
+            # Reject the line before decoding anything other than paper_id
+            if paper_ids is not None and paper['paper_id'] not in paper_ids:
+                return None
+        except (KeyError, ValueError, IndexError):
+            # Not laid out the way we expect; parse the whole line instead.
+            return self.fallback.decode(line, paper_ids)
+
+        return paper
+
+
+def get_record_decoder(name, fields):
+
+    if name == 'projected':
+        return ProjectedRecordDecoder(fields)
+    elif name == 'ujson':
+        return UjsonRecordDecoder(fields)
+    else:
+        raise Exception("Invalid record decoder: {}".format(name))
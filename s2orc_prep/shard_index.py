@@ -0,0 +1,72 @@
+import os
+import gzip
+
+import ujson as json
+
+
+# S2ORC shards are single gzip streams, so finding one paper means
+# decompressing everything before it. build_shard_index() rewrites a shard
+# as a sequence of independent gzip members of `block_size` lines each
+# (which is still a valid .jsonl.gz file for gzip.open()), and records for
+# every paper id the byte offset and length of its member and its line
+# number within the member. Any record can then be read by decompressing a
+# single block.
+def get_shard_path(root_dir, kind, shard_num):
+    return os.path.join(root_dir, kind, '{}_{}.jsonl.gz'.format(kind, shard_num))
+
+
+def get_shard_index_path(root_dir, kind, shard_num):
+    return os.path.join(root_dir, kind, '{}_{}.index.tsv'.format(kind, shard_num))
+
+
+def build_shard_index(input_path, output_path, index_path, block_size=1000, compresslevel=6):
+
+    num_records = 0
+
+    with gzip.open(input_path, 'rb') as input_file, \
+         open(output_path, 'wb') as output_file, \
+         open(index_path, 'w') as index_file:
+
+        block_lines = []
+        block_paper_ids = []
+
+        def write_block():
+            block_offset = output_file.tell()
+            block_data = gzip.compress(b''.join(block_lines), compresslevel=compresslevel, mtime=0)
+
+            output_file.write(block_data)
+
+            for line_num, paper_id in enumerate(block_paper_ids):
+                index_file.write('{}\t{}\t{}\t{}\n'.format(paper_id, block_offset, len(block_data), line_num))
+
+            block_lines.clear()
+            block_paper_ids.clear()
+
+        for line in input_file:
+            if not line.endswith(b'\n'):
+                line += b'\n'
+
+            block_lines.append(line)
+            block_paper_ids.append(json.loads(line)['paper_id'])
+            num_records += 1
+
+            if len(block_lines) == block_size:
+                write_block()
+
+        if len(block_lines) > 0:
+            write_block()
+
+    return num_records
+
+
+def load_shard_index(index_path):
+
+    shard_index = {}
+
+    with open(index_path, 'r') as index_file:
+        for line in index_file:
+            paper_id, block_offset, block_length, line_num = line.rstrip('\n').split('\t')
+            shard_index[paper_id] = (int(block_offset), int(block_length), int(line_num))
+
+    return shard_index
+
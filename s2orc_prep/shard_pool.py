@@ -0,0 +1,37 @@
+from s2orc_prep import metrics, profiling
+
+
+class _ShardTask:
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __call__(self, shard):
+        shard_args = shard if isinstance(shard, tuple) else (shard,)
+
+        start_time = metrics.start_task()
+        profiler = profiling.start_task()
+
+        result = self.func(*shard_args, *self.args)
+
+        task_profile = profiling.finish_task(profiler)
+
+        return shard, result, metrics.finish_task(start_time, task_profile)
+
+
+# Runs func(shard, *args) for every shard in `shards` (a shard can also be
+# a tuple of arguments, e.g. (shard_num, part_num)) and yields
+# (shard, result) pairs in the order the shards finish. The parent can then
+# merge and free each result while the other shards are still running,
+# instead of keeping every pickled result around until the pool is joined.
+#
+# The counters each task recorded (see metrics.py), and its profile with
+# --profile (see profiling.py), are passed on to the stage that is
+# currently running.
+def imap_shards(pool, func, shards, *args):
+
+    for shard, result, task_stats in pool.imap_unordered(_ShardTask(func, *args), shards):
+        metrics.record_task(task_stats)
+
+        yield shard, result
@@ -0,0 +1,201 @@
+import os
+import gzip
+import queue
+import threading
+import collections
+import concurrent.futures
+
+import numpy
+
+from s2orc_prep import metrics
+
+
+# Size of the decompressed chunks read from a plain gzip shard
+READ_CHUNK_SIZE = 1 << 22
+
+_END_OF_SHARD = object()
+
+
+def _read_gzip_batches(shard_path, batch_size):
+
+    task_counters = metrics.get_task_counters()
+
+    with gzip.open(shard_path, 'rb') as shard_file:
+        remainder = b''
+
+        while True:
+            chunk = shard_file.read(READ_CHUNK_SIZE)
+
+            if not chunk:
+                break
+
+            task_counters['bytes_decompressed'] += len(chunk)
+
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+
+            for i in range(0, len(lines), batch_size):
+                yield lines[i:i+batch_size]
+
+        if remainder:
+            yield [remainder]
+
+
+def _read_block_batches(shard_path, index_entries, num_threads):
+
+    line_nums_by_block = collections.defaultdict(list)
+
+    for block_offset, block_length, line_num in index_entries:
+        line_nums_by_block[(block_offset, block_length)].append(line_num)
+
+    blocks = sorted(line_nums_by_block.keys())
+
+    task_counters = metrics.get_task_counters()
+
+    shard_fd = os.open(shard_path, os.O_RDONLY)
+
+    def read_block(block):
+        block_offset, block_length = block
+        block_data = gzip.decompress(os.pread(shard_fd, block_length, block_offset))
+        block_lines = block_data.splitlines()
+
+        # The whole block is decompressed, however few of its lines are kept
+        return len(block_data), [block_lines[line_num] for line_num in sorted(line_nums_by_block[block])]
+
+    # Counted here, on a single thread, rather than in read_block
+    def count(result):
+
+        num_bytes, lines = result
+        task_counters['bytes_decompressed'] += num_bytes
+
+        return lines
+
+    try:
+        if num_threads > 1:
+            # zlib releases the GIL, so blocks really are decompressed in parallel.
+            # They are still returned in file order, and at most
+            # `num_threads * 2` blocks are decompressed ahead of the caller.
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+                pending = collections.deque()
+
+                try:
+                    for block in blocks:
+                        if len(pending) >= num_threads * 2:
+                            yield count(pending.popleft().result())
+
+                        pending.append(executor.submit(read_block, block))
+
+                    while pending:
+                        yield count(pending.popleft().result())
+                finally:
+                    # If the caller stops early
+                    for future in pending:
+                        future.cancel()
+        else:
+            for block in blocks:
+                yield count(read_block(block))
+    finally:
+        os.close(shard_fd)
+
+
+def _prefetch(batches, queue_size):
+
+    # Decompress on a background thread, so that it overlaps with
+    # the JSON parsing done by the caller.
+    batch_queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    # Returns False instead of blocking for good once the caller has stopped
+    def put(item):
+
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if not put(batch):
+                    return
+
+            put(_END_OF_SHARD)
+        except Exception as e:
+            put(e)
+        finally:
+            # Closes the shard file if the caller stopped early
+            batches.close()
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            batch = batch_queue.get()
+
+            if batch is _END_OF_SHARD:
+                break
+            elif isinstance(batch, Exception):
+                raise batch
+
+            yield batch
+    finally:
+        stop.set()
+
+        # Frees the batches already decompressed
+        while True:
+            try:
+                batch_queue.get_nowait()
+            except queue.Empty:
+                break
+
+
+# Yields batches of raw (bytes) jsonl lines of a shard.
+#
+# - index_entries: only read these records from a shard converted by
+#   build_shard_index.py, one gzip block at a time.
+# - num_threads: 0 reads everything on the calling thread. Otherwise the
+#   shard is decompressed on a background thread while the caller parses
+#   the previous batches, and with index_entries, up to `num_threads` blocks
+#   are decompressed at once.
+def iter_shard_batches(shard_path, index_entries=None, num_threads=0, batch_size=1000, queue_size=16):
+
+    if index_entries is not None:
+        batches = _read_block_batches(shard_path, index_entries, num_threads)
+    else:
+        batches = _read_gzip_batches(shard_path, batch_size)
+
+    if num_threads > 0:
+        batches = _prefetch(batches, queue_size)
+
+    return batches
+
+
+def iter_shard_lines(shard_path, index_entries=None, num_threads=0, batch_size=1000):
+
+    for batch in iter_shard_batches(shard_path, index_entries, num_threads, batch_size):
+        yield from batch
+
+
+# Splits the index entries of a shard into `num_parts` groups of whole,
+# consecutive blocks, so that a single shard can be read by several workers.
+def split_index_entries(index_entries, num_parts):
+
+    blocks = sorted(set((block_offset, block_length) for block_offset, block_length, _ in index_entries))
+
+    part_by_block = {}
+
+    for part_num, part_blocks in enumerate(numpy.array_split(numpy.arange(len(blocks)), num_parts)):
+        for b in part_blocks.tolist():
+            part_by_block[blocks[b]] = part_num
+
+    parts = [[] for _ in range(num_parts)]
+
+    for entry in index_entries:
+        parts[part_by_block[(entry[0], entry[1])]].append(entry)
+
+    return parts
@@ -0,0 +1,80 @@
+import os
+import gc
+import atexit
+import shutil
+import tempfile
+
+import numpy
+
+from s2orc_prep.citation_graph import CitationGraph
+
+
+# Pool workers get the parent's data through fork(), but CPython writes to
+# every object it touches (refcounts, GC headers), so pages shared with the
+# parent slowly get copied into each worker. The helpers below publish flat
+# numpy arrays to files (on /dev/shm by default) that the parent and the
+# workers map read-only, so they share a single copy through the page cache.
+def create_shared_dir(parent_dir):
+
+    if parent_dir is not None:
+        os.makedirs(parent_dir, exist_ok=True)
+
+    shared_dir = tempfile.mkdtemp(prefix='s2orc_prep_', dir=parent_dir)
+
+    # Files on /dev/shm take up memory until they are removed
+    atexit.register(shutil.rmtree, shared_dir, ignore_errors=True)
+
+    _shared_dirs.append(shared_dir)
+
+    return shared_dir
+
+
+# Directories made by create_shared_dir() so far
+_shared_dirs = []
+
+
+# Removes the shared directories before the process exits, e.g. once a
+# script run by s2orc_prep/pipeline.py is done with them
+def remove_shared_dirs():
+
+    while _shared_dirs:
+        shutil.rmtree(_shared_dirs.pop(), ignore_errors=True)
+
+
+def share_array(shared_dir, name, array):
+
+    path = os.path.join(shared_dir, name + '.npy')
+
+    numpy.save(path, array)
+
+    return numpy.load(path, mmap_mode='r')
+
+
+def share_citation_graph(shared_dir, name, citation_graph):
+
+    return CitationGraph(
+        share_array(shared_dir, name + '_offsets', citation_graph.offsets),
+        share_array(shared_dir, name + '_neighbors', citation_graph.neighbors))
+
+
+# Names of the arrays of a row block (see citation_graph.py) in file names
+ROW_BLOCK_ARRAYS = ('row_ids', 'offsets', 'neighbors')
+
+
+def share_row_block(shared_dir, name, block):
+
+    return tuple(
+        share_array(shared_dir, '{}_{}'.format(name, array_name), array)
+        for array_name, array in zip(ROW_BLOCK_ARRAYS, block))
+
+
+# Moves everything currently in the parent's heap out of the GC's reach
+# before forking workers, so that garbage collection in the workers doesn't
+# write to (and thereby copy) the pages inherited from the parent.
+def freeze_before_fork():
+    gc.collect()
+    gc.freeze()
+
+
+def unfreeze_after_join():
+    gc.unfreeze()
@@ -0,0 +1,167 @@
+import os
+import pickle
+
+import numpy
+
+from s2orc_prep.citation_graph import CitationGraph
+from s2orc_prep.shared_graph import create_shared_dir, share_array, share_row_block, ROW_BLOCK_ARRAYS
+
+
+# How much memory the large maps of the part 1 scripts may take up in the
+# parent process (--memory_budget, in GB). The budget is divided evenly
+# between `num_parts` maps; a map that outgrows its part is spilled to a
+# temporary directory under `spill_dir` (which should be on a local disk),
+# and read from there for the rest of the run. Without a budget, nothing is
+# ever spilled.
+class MemoryBudget:
+
+    def __init__(self, memory_budget, spill_dir=None, num_parts=1):
+
+        if memory_budget is None:
+            self.part_bytes = None
+        else:
+            self.part_bytes = int(memory_budget * (1 << 30) / num_parts)
+
+            # Rather than failing the first time a shard goes over budget,
+            # halfway through the metadata stage
+            if spill_dir is not None:
+                os.makedirs(spill_dir, exist_ok=True)
+
+        self.spill_parent_dir = spill_dir
+        self.spill_dir = None
+
+    def exceeds(self, num_bytes):
+        return self.part_bytes is not None and num_bytes > self.part_bytes
+
+    def get_spill_dir(self):
+
+        if self.spill_dir is None:
+            self.spill_dir = create_shared_dir(self.spill_parent_dir)
+
+            print("Spilling to {}".format(self.spill_dir))
+
+        return self.spill_dir
+
+
+# Builds a CitationGraph from the shards' row blocks (see
+# CitationGraph.from_row_blocks). If the graph would be too large for the
+# budget, it is never held in memory: the blocks are copied one at a time
+# straight into a memory-mapped `neighbors` file, and the offsets are
+# moved to a file as well once they are done. The graph works the same
+# either way; the OS page cache keeps the parts being read in memory.
+# Returns the graph and whether it was spilled.
+def build_citation_graph(memory_budget, name, num_nodes, blocks):
+
+    # At most this many edges, fewer if some rows appear in several blocks
+    num_bytes = (num_nodes + 1 + sum(len(neighbors) for _, _, neighbors in blocks)) * 8
+
+    if not memory_budget.exceeds(num_bytes):
+        return CitationGraph.from_row_blocks(num_nodes, blocks), False
+
+    neighbors_path = os.path.join(memory_budget.get_spill_dir(), name + '_neighbors.npy')
+
+    def allocate_neighbors(num_edges):
+        return numpy.lib.format.open_memmap(neighbors_path, mode='w+', dtype=numpy.int64, shape=(num_edges,))
+
+    citation_graph = CitationGraph.from_row_blocks(num_nodes, blocks, allocate_neighbors)
+
+    citation_graph.neighbors.flush()
+
+    return CitationGraph(
+        share_array(memory_budget.get_spill_dir(), name + '_offsets', citation_graph.offsets),
+        numpy.load(neighbors_path, mmap_mode='r')), True
+
+
+# {shard_num: value} for per-shard data read back one shard at a time.
+# Once the values held in memory grow past the budget (as measured by
+# `get_size`), further values are pickled to disk and only loaded again
+# when accessed; the last value loaded is kept in memory.
+class ShardStore:
+
+    def __init__(self, memory_budget, name, get_size):
+
+        self.memory_budget = memory_budget
+        self.name = name
+        self.get_size = get_size
+
+        self.values = {}
+        self.values_bytes = 0
+        self.spilled_paths = {}
+
+        self.last_loaded = (None, None)
+
+    def __setitem__(self, shard_num, value):
+
+        if self.memory_budget.part_bytes is not None:
+            value_bytes = self.get_size(value)
+
+            if self.memory_budget.exceeds(self.values_bytes + value_bytes):
+                path = os.path.join(self.memory_budget.get_spill_dir(), '{}_{}'.format(self.name, shard_num))
+
+                self.dump(path, value)
+
+                self.spilled_paths[shard_num] = path
+
+                return
+
+            self.values_bytes += value_bytes
+
+        self.values[shard_num] = value
+
+    def __getitem__(self, shard_num):
+
+        if shard_num in self.values:
+            return self.values[shard_num]
+
+        if self.last_loaded[0] != shard_num:
+            self.last_loaded = (shard_num, self.load(self.spilled_paths[shard_num]))
+
+        return self.last_loaded[1]
+
+    def dump(self, path, value):
+
+        with open(path + '.pkl', 'wb') as value_file:
+            pickle.dump(value, value_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+
+        with open(path + '.pkl', 'rb') as value_file:
+            return pickle.load(value_file)
+
+    def __contains__(self, shard_num):
+        return shard_num in self.values or shard_num in self.spilled_paths
+
+    def keys(self):
+        return list(self.values.keys()) + list(self.spilled_paths.keys())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+# ShardStore of the row blocks sent back by the shard workers. Spilled
+# blocks are written as .npy files and read back memory-mapped, so that
+# e.g. build_citation_graph() only pages them in a block at a time.
+class RowBlockStore(ShardStore):
+
+    def __init__(self, memory_budget, name):
+        super().__init__(memory_budget, name, get_row_block_size)
+
+    def dump(self, path, value):
+
+        for array_name, array in zip(ROW_BLOCK_ARRAYS, value):
+            numpy.save('{}_{}.npy'.format(path, array_name), array)
+
+    def load(self, path):
+        return tuple(numpy.load('{}_{}.npy'.format(path, array_name), mmap_mode='r') for array_name in ROW_BLOCK_ARRAYS)
+
+    # Moves the blocks still held in memory to read-only memory-mapped
+    # files in `shared_dir` (see shared_graph.py), for the pool workers.
+    # Spilled blocks are memory-mapped already.
+    def share(self, shared_dir):
+
+        for shard_num, block in self.values.items():
+            self.values[shard_num] = share_row_block(shared_dir, '{}_{}'.format(self.name, shard_num), block)
+
+
+def get_row_block_size(block):
+    return sum(array.nbytes for array in block)
@@ -0,0 +1,306 @@
+import os
+import shutil
+import bisect
+import hashlib
+
+import numpy
+import ujson as json
+
+from s2orc_prep.data_json_writer import DataJsonWriter
+
+
+SPLITS = ['train', 'val', 'test']
+
+# shuffle: shuffle every field's query papers once all shards are read, and
+#          cut them into the split proportions (see make_splits)
+# hash: put each query paper into a split according to a seeded hash of its
+#       paper id (see get_hash_split), while the shards are being processed
+SPLIT_MODES = ['shuffle', 'hash']
+
+
+def get_split_sizes(num_papers, val_proportion, test_proportion, train_proportion=None):
+
+    val_size = int(num_papers * val_proportion)
+    test_size = int(num_papers * test_proportion)
+
+    if train_proportion:
+        train_size = int(num_papers * train_proportion)
+    else:
+        train_size = num_papers - val_size - test_size
+
+    return train_size, val_size, test_size
+
+
+# --smoothed_weighting: each field gets floor(w * total) papers, where w is
+# proportional to (its share of the papers) ** 0.7, which shrinks the
+# largest fields and grows the smallest ones.
+def get_smoothed_field_sizes(field_counts, exponent=0.7):
+
+    field_counts = numpy.asarray(field_counts, dtype=numpy.float64)
+    total_count = field_counts.sum()
+
+    if total_count == 0:
+        return numpy.zeros(len(field_counts), dtype=numpy.int64)
+
+    weights = (field_counts / total_count) ** exponent
+    weights /= weights.sum()
+
+    return numpy.floor(weights * total_count).astype(numpy.int64)
+
+
+# Brings `paper_ids` to `size` papers: a random subset if it has more, or
+# all of them followed by random permutations of them (the last one cut
+# short) until there are enough.
+def resample_field(rng, paper_ids, size):
+
+    if size < len(paper_ids):
+        return rng.permutation(paper_ids)[:size]
+
+    num_extra = size - len(paper_ids)
+
+    if num_extra == 0:
+        return paper_ids
+
+    num_rounds = -(-num_extra // len(paper_ids))
+
+    # One permutation of paper_ids per row
+    extra = rng.permuted(numpy.tile(paper_ids, (num_rounds, 1)), axis=1)
+
+    # The last round only needs a sample of the papers
+    return numpy.concatenate([paper_ids, extra.ravel()[:num_extra]])
+
+
+# Splits groups of query papers into train/val/test. `groups` is a list of
+# (field, paper ids) pairs, e.g. one per field of every shard; each group
+# is shuffled and cut into consecutive train, val and test parts, so that
+# every field is represented in the same proportions in all splits.
+#
+# With smoothed_weighting, the groups are first merged by field, and every
+# field is resampled to its smoothed size (see above) instead of being
+# shuffled.
+#
+# Returns {split: (paper ids, field indices)}, with one entry per
+# occurrence, in the order they were assigned (a paper can come up more
+# than once, e.g. for every field it has), and the list of fields.
+def make_splits(
+    rng, groups, val_proportion, test_proportion, train_proportion=None, smoothed_weighting=False):
+
+    fields = list(dict.fromkeys(field for field, _ in groups))
+    field_indices = {field: i for i, field in enumerate(fields)}
+
+    groups = [(field_indices[field], numpy.asarray(paper_ids, dtype=numpy.int64)) for field, paper_ids in groups]
+
+    if smoothed_weighting:
+        paper_ids_by_field = [[] for _ in fields]
+
+        for field_index, paper_ids in groups:
+            paper_ids_by_field[field_index].append(paper_ids)
+
+        paper_ids_by_field = [numpy.concatenate(field_paper_ids) for field_paper_ids in paper_ids_by_field]
+
+        field_sizes = get_smoothed_field_sizes([len(field_paper_ids) for field_paper_ids in paper_ids_by_field])
+
+        groups = [
+            (field_index, resample_field(rng, field_paper_ids, size))
+            for field_index, (field_paper_ids, size) in enumerate(zip(paper_ids_by_field, field_sizes.tolist()))]
+    else:
+        groups = [(field_index, rng.permutation(paper_ids)) for field_index, paper_ids in groups]
+
+    split_parts = {split: ([], []) for split in SPLITS}
+
+    for field_index, paper_ids in groups:
+        train_size, val_size, test_size = get_split_sizes(
+            len(paper_ids), val_proportion, test_proportion, train_proportion)
+
+        bounds = numpy.cumsum([0, train_size, val_size, test_size])
+
+        for split, start, end in zip(SPLITS, bounds[:-1], bounds[1:]):
+            split_parts[split][0].append(paper_ids[start:end])
+            split_parts[split][1].append(numpy.full(len(paper_ids[start:end]), field_index, dtype=numpy.int64))
+
+    empty = [numpy.zeros(0, dtype=numpy.int64)]
+
+    splits = {
+        split: (numpy.concatenate(empty + paper_id_parts), numpy.concatenate(empty + field_index_parts))
+        for split, (paper_id_parts, field_index_parts) in split_parts.items()}
+
+    return splits, fields
+
+
+# Paper ids in the order they first come up, without duplicates
+def get_unique_in_order(paper_ids):
+
+    _, first_positions = numpy.unique(paper_ids, return_index=True)
+
+    return paper_ids[numpy.sort(first_positions)]
+
+
+# Writes every split's paper ids to <split>.txt, each one once
+def write_split_files(save_dir, splits, registry):
+
+    for split in SPLITS:
+        split_paper_ids = get_unique_in_order(splits[split][0])
+
+        with open(os.path.join(save_dir, split + '.txt'), 'w+') as split_file:
+            split_file.writelines(p_id + '\n' for p_id in registry.to_paper_ids(split_paper_ids.tolist()))
+
+
+# The fields every paper was assigned to each split under, as
+# {split: {paper_id: [fields]}}, with the papers in the order of <split>.txt
+def get_mag_fields_by_paper_ids(splits, fields, registry):
+
+    mag_fields_by_paper_ids = {}
+
+    for split in SPLITS:
+        paper_ids, field_indices = splits[split]
+
+        unique_paper_ids, first_positions, inverse = numpy.unique(paper_ids, return_index=True, return_inverse=True)
+
+        # The same as get_unique_in_order(paper_ids)
+        first_order = numpy.argsort(first_positions)
+        split_paper_ids = unique_paper_ids[first_order]
+
+        # Position of each occurrence's paper in split_paper_ids
+        rank_of_unique = numpy.empty(len(unique_paper_ids), dtype=numpy.int64)
+        rank_of_unique[first_order] = numpy.arange(len(unique_paper_ids))
+        paper_ranks = rank_of_unique[inverse.reshape(-1)]
+
+        # Group the occurrences by paper, keeping their order within each paper
+        order = numpy.argsort(paper_ranks, kind='stable')
+
+        offsets = numpy.zeros(len(split_paper_ids) + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(paper_ranks, minlength=len(split_paper_ids)), out=offsets[1:])
+
+        paper_fields = [fields[f] for f in field_indices[order].tolist()]
+        offsets = offsets.tolist()
+
+        mag_fields_by_paper_ids[split] = {
+            p_id: paper_fields[offsets[i]:offsets[i+1]]
+            for i, p_id in enumerate(registry.to_paper_ids(split_paper_ids.tolist()))}
+
+    return mag_fields_by_paper_ids
+
+
+def write_mag_fields(path, splits, fields, registry):
+
+    with open(path, 'w+') as mag_fields_file:
+        json.dump(get_mag_fields_by_paper_ids(splits, fields, registry), mag_fields_file)
+
+
+# Upper ends of the train, val and test ranges of [0, 1) for the hash mode
+def get_split_bounds(val_proportion, test_proportion, train_proportion=None):
+
+    if not train_proportion:
+        train_proportion = 1 - val_proportion - test_proportion
+
+    return numpy.cumsum([train_proportion, val_proportion, test_proportion]).tolist()
+
+
+# The split of a paper for the hash mode: a hash of the seed and the paper
+# id, mapped to [0, 1), picks one of the ranges from get_split_bounds. The
+# split of a paper never depends on the other papers, the shards used or
+# the order they are processed in, and papers come out in each field (all
+# fields of a paper go to the same split) in the split proportions on
+# average. Returns None for papers beyond the test range, which only
+# happens with a --train_proportion that doesn't fill up the rest.
+def get_hash_split(seed, paper_id, split_bounds):
+
+    digest = hashlib.blake2b('{}-{}'.format(seed, paper_id).encode(), digest_size=8).digest()
+
+    split_index = bisect.bisect_right(split_bounds, int.from_bytes(digest, 'little') / 2 ** 64)
+
+    return SPLITS[split_index] if split_index < len(SPLITS) else None
+
+
+# Hash mode splits of the query papers of one shard, given as {field:
+# query paper ids}. Returns {split: (paper ids, [fields of each paper])},
+# with the papers in the order they first come up.
+def assign_hash_splits(seed, paper_ids_by_field, registry, split_bounds):
+
+    fields_by_paper_id = {}
+
+    for field, field_paper_ids in paper_ids_by_field.items():
+        for paper_id in numpy.asarray(field_paper_ids, dtype=numpy.int64).tolist():
+            fields_by_paper_id.setdefault(paper_id, []).append(field)
+
+    split_paper_ids = {split: ([], []) for split in SPLITS}
+
+    for paper_id, fields in fields_by_paper_id.items():
+        split = get_hash_split(seed, registry[paper_id], split_bounds)
+
+        if split is not None:
+            split_paper_ids[split][0].append(paper_id)
+            split_paper_ids[split][1].append(fields)
+
+    return {
+        split: (numpy.asarray(paper_ids, dtype=numpy.int64), paper_fields)
+        for split, (paper_ids, paper_fields) in split_paper_ids.items()}
+
+
+# Streams the hash mode splits of each shard to <split>.txt and to
+# `mag_fields_path` as they come in, so that the parent never holds the
+# query papers of all the shards. Shards are written in the order of
+# `shard_order`, whatever order they finish in; a paper that is a query
+# paper in more than one shard is only written the first time.
+class HashSplitWriter:
+
+    def __init__(self, save_dir, mag_fields_path, registry, shard_order):
+
+        self.mag_fields_path = mag_fields_path
+        self.registry = registry
+
+        self.split_files = {split: open(os.path.join(save_dir, split + '.txt'), 'w+') for split in SPLITS}
+
+        # Each split's part of mag_fields_path, put together in close()
+        self.mag_fields_writers = {
+            split: DataJsonWriter(self.get_part_path(split), 'compact') for split in SPLITS}
+
+        self.written = numpy.zeros(len(registry), dtype=bool)
+
+        self.shard_order = list(shard_order)
+        self.next_shard = 0
+        self.pending = {}
+
+    def get_part_path(self, split):
+        return '{}.{}.tmp'.format(self.mag_fields_path, split)
+
+    def add(self, shard, split_paper_ids):
+
+        self.pending[shard] = split_paper_ids
+
+        while self.next_shard < len(self.shard_order) and self.shard_order[self.next_shard] in self.pending:
+            self.write(self.pending.pop(self.shard_order[self.next_shard]))
+            self.next_shard += 1
+
+    def write(self, split_paper_ids):
+
+        for split, (paper_ids, paper_fields) in split_paper_ids.items():
+            for paper_id, fields in zip(paper_ids.tolist(), paper_fields):
+                if self.written[paper_id]:
+                    continue
+
+                self.written[paper_id] = True
+
+                self.split_files[split].write(self.registry[paper_id] + '\n')
+                self.mag_fields_writers[split].write(self.registry[paper_id], fields)
+
+    def close(self):
+
+        for split_file in self.split_files.values():
+            split_file.close()
+
+        # {split: {paper_id: [fields]}}, the same as write_mag_fields()
+        with open(self.mag_fields_path, 'w+') as mag_fields_file:
+            mag_fields_file.write('{')
+
+            for i, split in enumerate(SPLITS):
+                self.mag_fields_writers[split].close()
+
+                mag_fields_file.write((',' if i > 0 else '') + json.dumps(split) + ':')
+
+                with open(self.get_part_path(split), 'r') as part_file:
+                    shutil.copyfileobj(part_file, mag_fields_file)
+
+                os.remove(self.get_part_path(split))
+
+            mag_fields_file.write('}')
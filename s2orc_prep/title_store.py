@@ -0,0 +1,146 @@
+import os
+import sqlite3
+
+import numpy
+
+from s2orc_prep.shared_graph import create_shared_dir
+
+
+# Titles of the safe papers, written by the part 1 workers while they read
+# the metadata shards: one sqlite database per shard, keyed by paper id, in
+# a title_store directory. The titles never pass through the parent of
+# part 1, which writes titles.json or the paper table from the store. With
+# --title_store, part 1 keeps the store in its output directory instead of
+# writing titles.json, and part 2 looks up only the titles of the papers it
+# writes out, in the database of the shard it is reading.
+
+# Paper ids looked up per query
+LOOKUP_BATCH_SIZE = 500
+
+
+def get_title_store_dir(save_dir):
+    return os.path.join(save_dir, 'title_store')
+
+
+# Where the part 1 workers write the title store: the output directory if
+# the store is one of the outputs, or else `work_dir`, for --resume to find
+# the titles of the shards it doesn't read again, or else a temporary
+# directory that is removed when the script exits.
+def get_part1_title_store_dir(save_dir, is_output, work_dir=None):
+
+    if is_output:
+        return get_title_store_dir(save_dir)
+    elif work_dir:
+        return get_title_store_dir(work_dir)
+    else:
+        return get_title_store_dir(create_shared_dir(None))
+
+
+def get_shard_title_path(title_store_dir, shard_num):
+    return os.path.join(title_store_dir, 'titles_{}.sqlite'.format(shard_num))
+
+
+# Writes the (paper_id, title) pairs of one shard. The database is put in
+# place only once it is complete, so that a crashed worker never leaves a
+# half-written one behind.
+def write_shard_titles(title_store_dir, shard_num, titles):
+
+    os.makedirs(title_store_dir, exist_ok=True)
+
+    path = get_shard_title_path(title_store_dir, shard_num)
+    tmp_path = path + '.tmp{}'.format(os.getpid())
+
+    db = sqlite3.connect(tmp_path)
+
+    # Nothing to recover if the worker dies; the shard is just written again
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('CREATE TABLE titles (paper_id TEXT PRIMARY KEY, title TEXT)')
+
+    db.executemany('INSERT OR REPLACE INTO titles VALUES (?, ?)', titles)
+    db.commit()
+    db.close()
+
+    os.replace(tmp_path, path)
+
+
+class TitleStore:
+
+    def __init__(self, title_store_dir, num_shards=100):
+
+        self.title_store_dir = title_store_dir
+        self.num_shards = num_shards
+
+    # Part 1 writes a database for every shard, even one without any safe
+    # papers, so a missing one means the store is incomplete
+    def connect(self, shard_num):
+
+        path = get_shard_title_path(self.title_store_dir, shard_num)
+
+        if not os.path.exists(path):
+            raise Exception("Title store {} has no database for shard {}. Check that part 1 finished reading every metadata shard.".format(
+                self.title_store_dir, shard_num))
+
+        return sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+
+    # {paper_id: title} for the papers of `paper_ids` that are in the shard
+    def get_shard_titles(self, shard_num, paper_ids):
+
+        db = self.connect(shard_num)
+
+        paper_ids = list(paper_ids)
+        titles = {}
+
+        for start in range(0, len(paper_ids), LOOKUP_BATCH_SIZE):
+            batch = paper_ids[start:start + LOOKUP_BATCH_SIZE]
+
+            titles.update(db.execute(
+                'SELECT paper_id, title FROM titles WHERE paper_id IN ({})'.format(','.join('?' * len(batch))), batch))
+
+        db.close()
+
+        return titles
+
+    # (paper index, title) of the papers of `registry`, each paper once, as
+    # in titles.json: in the order the shards first have them, but with the
+    # title of the last shard that has them, just like dict.update() with
+    # the shards' titles one after the other would give.
+    def indexed_items(self, registry):
+
+        # The last shard of each paper, found by going through the shards
+        # backwards and keeping the first one
+        title_shards = numpy.full(len(registry), -1, dtype=numpy.int16)
+
+        for shard_num in reversed(range(self.num_shards)):
+            db = self.connect(shard_num)
+
+            indices = numpy.asarray(
+                [registry.get(paper_id) for paper_id, in db.execute('SELECT paper_id FROM titles')], dtype=numpy.int64)
+
+            db.close()
+
+            indices = indices[indices >= 0]
+            indices = indices[title_shards[indices] < 0]
+
+            title_shards[indices] = shard_num
+
+        seen = numpy.zeros(len(registry), dtype=bool)
+
+        for shard_num in range(self.num_shards):
+            db = self.connect(shard_num)
+
+            for paper_id, title in db.execute('SELECT paper_id, title FROM titles ORDER BY rowid'):
+                index = registry.get(paper_id)
+
+                if index < 0 or seen[index]:
+                    continue
+
+                seen[index] = True
+
+                # Papers in more than one shard are rare enough to look up one by one
+                if title_shards[index] != shard_num:
+                    title = self.get_shard_titles(int(title_shards[index]), [paper_id])[paper_id]
+
+                yield index, title
+
+            db.close()
@@ -2,214 +2,227 @@ import os
 import pathlib
 import multiprocessing
 import argparse
-import gzip
-import random
-import copy
 import gc
 import collections
 
+import numpy
 import ujson as json
 import tqdm
 
+from s2orc_prep.paper_id_registry import PaperIdRegistry
+from s2orc_prep.citation_graph import make_row_block, remap_row_block, filter_row_block, select_rows
+from s2orc_prep.shared_graph import create_shared_dir, share_array, freeze_before_fork, unfreeze_after_join
+from s2orc_prep.data_json_writer import DataJsonWriter, DATA_JSON_FORMATS
+from s2orc_prep.shard_reader import iter_shard_lines
+from s2orc_prep.record_decoder import get_record_decoder, RECORD_DECODERS, METADATA_FIELDS
+from s2orc_prep.metadata_cache import open_metadata_cache, CachedPaperIdRegistry
+from s2orc_prep.checkpoint import open_checkpoint
+from s2orc_prep.spill import MemoryBudget, RowBlockStore
+from s2orc_prep.metrics import MetricsReport, get_task_counters
+from s2orc_prep.splits import make_splits, write_split_files, write_mag_fields, SPLIT_MODES, get_split_bounds, assign_hash_splits, HashSplitWriter
+from s2orc_prep.profiling import enable_profiling
+from s2orc_prep.paper_table import INTERMEDIATE_FORMATS, write_paper_table, get_paper_table_path
+from s2orc_prep.title_store import TitleStore, write_shard_titles, get_part1_title_store_dir
+from s2orc_prep.pipeline import in_pipeline, keep_intermediate_files, hand_over, get_part2_inputs
+
+
+# Returns the opened metadata shard, an iterator over its papers, read
+# either from the columnar cache or by decoding the jsonl lines, and the
+# shard-local registry to intern their paper ids with. Papers read from the
+# cache hold indices into the cache's own id table, which are interned as
+# they are, without going through the id strings.
+def open_metadata_shard(shard_num, fields):
+
+    shard_path = os.path.join(args.data_dir, 'metadata', 'metadata_{}.jsonl.gz'.format(shard_num))
+
+    if args.metadata_cache_dir:
+        metadata_file = open_metadata_cache(shard_path, args.metadata_cache_dir)
+
+        return metadata_file, iter(metadata_file), CachedPaperIdRegistry(metadata_file)
+
+    metadata_file = iter_shard_lines(shard_path, num_threads=args.reader_threads)
+    record_decoder = get_record_decoder(args.record_decoder, fields)
+
+    return metadata_file, (record_decoder.decode(line) for line in metadata_file), PaperIdRegistry()
+
 
 # Process metadata jsonl into `data.json` as required by SPECTER.
 # Need to get all the citation information.
 def parse_metadata_shard(shard_num, fields=None):
 
-    output_citation_data = collections.defaultdict(dict)
+    # Shard-local registry of the MAG field names, mapped onto the global
+    # one by the parent like the paper ids below
+    shard_mag_field_names = PaperIdRegistry()
+
+    output_cites = {}
+    output_cited_by = {}
     output_query_paper_ids = []
     output_query_paper_ids_by_field = collections.defaultdict(list)
     output_safe_paper_ids = {}
     output_titles = {}
+    output_mag_fields = {}
 
-    metadata_file = gzip.open(
-        os.path.join(args.data_dir, 'metadata', 'metadata_{}.jsonl.gz'.format(shard_num)), 'rt')
+    # All the paper ids below are indices into this shard-local registry.
+    # The parent maps them onto the global registry when combining the shards.
+    metadata_file, papers, shard_registry = open_metadata_shard(shard_num, METADATA_FIELDS)
 
-    print("Reading metadata shard {}".format(shard_num))
+    # Number of records read, and dropped by each of the checks below
+    counters = get_task_counters()
 
-    pbar = tqdm.tqdm(
-        desc="#" + "{}".format(shard_num).zfill(3),
-        position=shard_num+1)
+    for paper in papers:
+        paper_id = shard_registry.intern(paper['paper_id'])
 
-    for line in metadata_file:
-        paper = json.loads(line)
+        counters['records'] += 1
 
         # Only consider papers that
         # have MAG field of study specified, and
         # PDF parse is available & abstract is included in PDF parse
-        if not paper['mag_field_of_study'] \
-           or not paper['has_pdf_parse']:
-            output_safe_paper_ids[paper['paper_id']] = -1
-            pbar.update(1)
+        if not paper['mag_field_of_study']:
+            output_safe_paper_ids[paper_id] = -1
+            counters['filtered_no_field'] += 1
+            continue
+
+        if not paper['has_pdf_parse']:
+            output_safe_paper_ids[paper_id] = -1
+            counters['filtered_no_pdf_parse'] += 1
             continue
 
         if not paper['has_pdf_parsed_abstract']:
-            output_safe_paper_ids[paper['paper_id']] = -1
-            pbar.update(1)
+            output_safe_paper_ids[paper_id] = -1
+            counters['filtered_no_abstract'] += 1
             continue
 
         # Since SPECTER requires all papers in the graph to have titles and abstract,
         # Once the conditions listed above has been met,
         # record the paper id in safe_paper_ids
-        output_safe_paper_ids[paper['paper_id']] = shard_num
+        output_safe_paper_ids[paper_id] = shard_num
+
+        # Written to this shard's title store below
+        output_titles[paper_id] = paper['title']
 
-        output_titles[paper['paper_id']] = paper['title']
+        # MAG fields of every safe paper, for mag_fields_by_all_paper_ids.json
+        output_mag_fields[paper_id] = [shard_mag_field_names.intern(f) for f in paper['mag_field_of_study']]
 
         # Query papers should have outbound citations
         if not paper['has_outbound_citations']:
-            pbar.update(1)
+            counters['filtered_no_outbound_citations'] += 1
             continue
 
         if args.cocite:
             if not paper['has_inbound_citations']:
-                pbar.update(1)
+                counters['filtered_no_inbound_citations'] += 1
                 continue
 
-        if paper['paper_id'] in output_citation_data.keys():
-            print("Metadata shard {} Duplicate paper id {} found. Please check.".format(shard_num, paper['paper_id']))
+        if paper_id in output_cites.keys():
+            print("Metadata shard {} Duplicate paper id {} found. Please check.".format(shard_num, shard_registry[paper_id]))
+            counters['filtered_duplicate'] += 1
         else:
             # if args.fields_of_study is specified, only consider the papers from
             # those fields
             if fields and set(fields).isdisjoint(set(paper['mag_field_of_study'])):
-                pbar.update(1)
+                counters['filtered_field'] += 1
                 continue
 
             # Record paper_id
-            output_query_paper_ids.append(paper['paper_id'])
+            output_query_paper_ids.append(paper_id)
 
             # Record paper_id based on mag_field_of_study
             for paper_field in paper['mag_field_of_study']:
                 if fields and paper_field not in fields:
                     continue
 
-                output_query_paper_ids_by_field[paper_field].append(paper['paper_id'])
+                output_query_paper_ids_by_field[paper_field].append(paper_id)
 
             # Iterate through paper ids of outbound citations
-            output_citation_data[paper['paper_id']]['cites'] = paper['outbound_citations']
+            output_cites[paper_id] = shard_registry.intern_many(paper['outbound_citations']).tolist()
 
             if args.cocite:
-                output_citation_data[paper['paper_id']]['cited_by'] = paper['inbound_citations']
-
-        pbar.update(1)
+                output_cited_by[paper_id] = shard_registry.intern_many(paper['inbound_citations']).tolist()
 
     metadata_file.close()
 
-    return output_citation_data, output_query_paper_ids, output_query_paper_ids_by_field, output_safe_paper_ids, output_titles
+    # Kept on disk for part 2, rather than sent back to the parent
+    write_shard_titles(
+        title_store_dir, shard_num,
+        ((shard_registry[p_id], title) for p_id, title in output_titles.items()))
 
+    # Outbound (and with --cocite, inbound) citations as row blocks with the same rows
+    output_citation_data = (make_row_block(output_cites), make_row_block(output_cited_by) if args.cocite else None)
 
-def parse_metadata_get_mag_shard(shard_num):
+    return output_citation_data, output_query_paper_ids, output_query_paper_ids_by_field, output_safe_paper_ids, make_row_block(output_mag_fields), shard_registry.paper_ids, shard_mag_field_names.paper_ids
 
-    mag_fields_shard = {}
 
-    pbar = tqdm.tqdm(position=shard_num+1)
+def sanitize_citation_data_direct(shard_num):
 
-    metadata_file = gzip.open(
-        os.path.join(args.data_dir, 'metadata', 'metadata_{}.jsonl.gz'.format(shard_num)), 'rt')
+    # Remove all the "unsafe" papers from the shard's citation_data_direct,
+    # while avoiding iterating again through all the metadata shards.
+    # The shard's row blocks are filtered in one vectorized pass each,
+    # rather than copying the shard's data and deleting entries one by one.
+    counters = get_task_counters()
 
-    for line in metadata_file:
-        paper = json.loads(line)
+    num_papers = len(citation_data_cites_by_shard[shard_num][0])
 
-        try:
-            if safe_paper_ids[str(paper['paper_id'])] == shard_num:
-                mag_fields_shard[str(paper['paper_id'])] = paper["mag_field_of_study"]
-        except:
-            pbar.update(1)
-            continue
+    cites_block = filter_row_block(citation_data_cites_by_shard[shard_num], safe_paper_mask)
 
-        pbar.update(1)
+    counters['records'] += num_papers
 
-    metadata_file.close()
+    if len(cites_block[0]) < num_papers:
+        counters['filtered_no_safe_citations'] += num_papers - len(cites_block[0])
 
-    return mag_fields_shard
+    if args.cocite:
+        cited_by_block = filter_row_block(citation_data_cited_by_by_shard[shard_num], safe_paper_mask)
 
+        # Both blocks have the shard's papers in the same order, so once
+        # both only have the papers left in the other, their rows line up
+        kept_rows = numpy.isin(cites_block[0], cited_by_block[0])
 
-def sanitize_citation_data_direct(shard_num):
+        if not kept_rows.all():
+            counters['filtered_no_safe_inbound_citations'] += int(len(kept_rows) - kept_rows.sum())
 
-    # Remove all the "unsafe" papers from the shard's citation_data_direct,
-    # while avoiding iterating again through all the metadata shards
-    print("Removing invalid direct citations...")
+        cites_block = select_rows(cites_block, kept_rows)
+        cited_by_block = select_rows(cited_by_block, numpy.isin(cited_by_block[0], cites_block[0]))
+    else:
+        cited_by_block = None
 
-    output_citation_data_direct = copy.deepcopy(citation_data_direct_by_shard[shard_num])
-    output_query_paper_ids = copy.deepcopy(query_paper_ids_all_shard[shard_num])
-    output_query_paper_ids_by_field = copy.deepcopy(query_paper_ids_by_field_all_shard[shard_num])
+    sanitized_paper_ids = set(cites_block[0].tolist())
 
-    # Outbound citations
-    pbar = tqdm.tqdm(
-        desc="#" + "{}".format(shard_num).zfill(3),
-        total=len(citation_data_direct_by_shard[shard_num].keys()),
-        position=shard_num+1)
+    output_query_paper_ids = [
+        p_id for p_id in query_paper_ids_all_shard[shard_num] if p_id in sanitized_paper_ids]
 
-    for paper_id in citation_data_direct_by_shard[shard_num].keys():
-        for i, cited_id in enumerate(citation_data_direct_by_shard[shard_num][paper_id]["cites"]):
-            if safe_paper_ids[cited_id] == -1:
-                output_citation_data_direct[paper_id]["cites"].remove(cited_id)
+    output_query_paper_ids_by_field = {
+        field: [p_id for p_id in field_paper_ids if p_id in sanitized_paper_ids]
+        for field, field_paper_ids in query_paper_ids_by_field_all_shard[shard_num].items()}
 
-        pbar.update(1)
+    # With --split_mode hash, the shard's query papers are put into splits right here
+    if args.split_mode == 'hash':
+        output_query_paper_ids_by_field = assign_hash_splits(args.seed, output_query_paper_ids_by_field, registry, split_bounds)
 
-    # Inbound citations
-    if args.cocite:
-        pbar = tqdm.tqdm(
-            desc="#" + "{}".format(shard_num).zfill(3),
-            total=len(citation_data_direct_by_shard[shard_num].keys()),
-            position=shard_num+1)
-
-        for paper_id in citation_data_direct_by_shard[shard_num].keys():
-            for i, cited_id in enumerate(citation_data_direct_by_shard[shard_num][paper_id]["cited_by"]):
-                if safe_paper_ids[cited_id] == -1:
-                    output_citation_data_direct[paper_id]["cited_by"].remove(cited_id)
-
-            pbar.update(1)
-
-    print("Removing query ids that no longer have any citations.")
-    query_ids_to_remove = []
-
-    pbar = tqdm.tqdm(
-        desc="#" + "{}".format(shard_num).zfill(3),
-        total=len(output_citation_data_direct.keys()),
-        position=shard_num+1)
-
-    for paper_id in output_citation_data_direct.keys():
-        if len(output_citation_data_direct[paper_id]["cites"]) == 0:
-            query_ids_to_remove.append(paper_id)
-        elif args.cocite and len(output_citation_data_direct[paper_id]["cited_by"]) == 0:
-            query_ids_to_remove.append(paper_id)
-
-        pbar.update(1)
-
-    pbar = tqdm.tqdm(
-        desc="#" + "{}".format(shard_num).zfill(3),
-        total=len(query_ids_to_remove),
-        position=shard_num+1)
-
-    for id_to_delete in query_ids_to_remove:
-        del output_citation_data_direct[id_to_delete]
-        output_query_paper_ids.remove(id_to_delete)
-
-        for field in output_query_paper_ids_by_field.keys():
-            try:
-                output_query_paper_ids_by_field[field].remove(id_to_delete)
-            except:
-                continue
+    return (cites_block, cited_by_block), output_query_paper_ids, output_query_paper_ids_by_field
 
-        pbar.update(1)
 
-    return output_citation_data_direct, output_query_paper_ids, output_query_paper_ids_by_field
+# {paper_id: {'cites': [...], 'cited_by': [...]}} of a shard's sanitized
+# row blocks, one query paper at a time, for data.json
+def iter_citation_data(citation_data):
 
-def get_all_paper_ids(citation_data):
+    cites_block, cited_by_block = citation_data
 
-    all_ids = set()
+    row_ids, cites_offsets, cites = cites_block
 
-    for paper_id in tqdm.tqdm(citation_data.keys()):
-        all_ids.add(paper_id)
+    for j, paper_id in enumerate(row_ids.tolist()):
+        citations = {"cites": cites[cites_offsets[j]:cites_offsets[j+1]].tolist()}
 
-        for cited_id in citation_data[paper_id]['cites']:
-            all_ids.add(cited_id)
+        if cited_by_block is not None:
+            _, cited_by_offsets, cited_by = cited_by_block
+            citations["cited_by"] = cited_by[cited_by_offsets[j]:cited_by_offsets[j+1]].tolist()
 
-        if args.cocite:
-            for cited_id in citation_data[paper_id]['cited_by']:
-                all_ids.add(cited_id)
+        yield paper_id, citations
 
-    return list(all_ids)
+
+def get_all_paper_ids(citation_data):
+
+    return numpy.unique(numpy.concatenate(
+        [block[0] for block in citation_data if block is not None]
+        + [block[2] for block in citation_data if block is not None])).tolist()
 
 
 if __name__ == '__main__':
@@ -226,6 +239,18 @@ if __name__ == '__main__':
 
     parser.add_argument('--shards', nargs='*', type=int, help='Specific shards to be used.')
 
+    parser.add_argument(
+        '--reader_threads', default=0, type=int,
+        help='Number of threads decompressing each shard in the background. 0 decompresses on the worker itself.')
+
+    parser.add_argument(
+        '--metadata_cache_dir',
+        help='path to a directory for the columnar cache of the metadata shards. Built on first use and shared by the part 1 scripts.')
+
+    parser.add_argument(
+        '--record_decoder', default='ujson', choices=RECORD_DECODERS,
+        help='parse every shard line in full (ujson), or only decode the fields that are actually used (projected).')
+
     parser.add_argument(
         '--val_proportion',
         default=0.4, type=float, help='proportion of the generated dataset to be reserved for validation.')
@@ -240,11 +265,77 @@ if __name__ == '__main__':
 
     parser.add_argument('--cocite', default=False, action='store_true')
 
+    parser.add_argument(
+        '--shared_graph_dir',
+        help='publish the citation data and the safe-id table as read-only memory-mapped files in this directory (e.g. /dev/shm) for the workers.')
+
+    parser.add_argument(
+        '--split_mode', default='shuffle', choices=SPLIT_MODES,
+        help='shuffle the query papers of each field once all shards are read (shuffle), or put each one in a split by a seeded hash of its paper id, '
+             'which streams the splits out shard by shard and keeps a paper in the same split whatever --shards are used (hash).')
+
+    parser.add_argument(
+        '--data_json_format', default='indent', choices=DATA_JSON_FORMATS,
+        help='write data.json pretty-printed (indent), without whitespace (compact), or one query paper per line (ndjson).')
+
+    parser.add_argument(
+        '--intermediate_format', default='json', choices=INTERMEDIATE_FORMATS,
+        help='write paper_ids.json, safe_paper_ids.json and titles.json for part 2 (json), or a single memory-mapped paper_table directory instead (binary).')
+
+    parser.add_argument(
+        '--title_store', default=False, action='store_true',
+        help='keep the titles in a title_store directory of per-shard sqlite databases in save_dir, for the --title_store option of part 2, instead of writing titles.json.')
+
+    parser.add_argument(
+        '--memory_budget', type=float,
+        help='memory (in GB) that the citation data may take up in the main process. Whatever does not fit is spilled to disk.')
+
+    parser.add_argument(
+        '--spill_dir',
+        help='directory to spill to when --memory_budget is exceeded (preferably on a local disk). Defaults to the system temporary directory.')
+
+    parser.add_argument(
+        '--work_dir',
+        help='keep the results of every stage and shard in this directory, so that a failed run can be picked up again with --resume.')
+
+    parser.add_argument(
+        '--resume', default=False, action='store_true',
+        help='reuse the stages and shards already completed in --work_dir instead of computing them again.')
+
+    parser.add_argument(
+        '--profile', default=False, action='store_true',
+        help='profile every stage with cProfile, in the main process and in the workers, and write the merged profiles to save_dir/profile.')
+
+    parser.add_argument(
+        '--profile_memory', default=False, action='store_true',
+        help='with --profile, also trace the memory allocated by the workers with tracemalloc (slow).')
+
     args = parser.parse_args()
 
-    # Random seed fix for Python random
-    # Will be used for train/val splitting
-    random.seed(args.seed)
+    # Results of the stages completed so far, see s2orc_prep/checkpoint.py
+    checkpoint = open_checkpoint(args)
+
+    # cProfile/tracemalloc results of each stage, see s2orc_prep/profiling.py
+    if args.profile:
+        enable_profiling(os.path.join(args.save_dir, 'profile'), args.profile_memory)
+
+    # Time, record counts and memory use of each stage, written to part1_report.json
+    report = MetricsReport()
+
+    # Where the workers write the titles (see s2orc_prep/title_store.py). The
+    # store is only kept in save_dir with --title_store, or for part 2 when
+    # run by run_pipeline.py.
+    title_store_dir = get_part1_title_store_dir(args.save_dir, args.title_store or in_pipeline(), args.work_dir)
+
+    # citation_data_cites_by_shard and citation_data_cited_by_by_shard (the
+    # titles are kept on disk by the workers, see s2orc_prep/title_store.py)
+    memory_budget = MemoryBudget(args.memory_budget, args.spill_dir, num_parts=2)
+
+    # Random number generator for the train/val splitting
+    split_rng = numpy.random.default_rng(args.seed)
+
+    # Ranges of the hash for each split with --split_mode hash
+    split_bounds = get_split_bounds(args.val_proportion, args.test_proportion, args.train_proportion)
 
     # Total number of shards to process
     SHARDS_TOTAL_NUM = 100
@@ -256,193 +347,213 @@ if __name__ == '__main__':
                 raise Exception("Invalid value for args.query_shard: {}".format(n))
 
     # Parse `metadata` from s2orc to create `data.json` for SPECTER
+    stage = report.start_stage('metadata')
+
     metadata_read_pool = multiprocessing.Pool(processes=args.num_processes)
-    metadata_read_results = []
 
-    for i in range(SHARDS_TOTAL_NUM):
-        metadata_read_results.append(
-            metadata_read_pool.apply_async(
-                parse_metadata_shard, args=(i, args.fields_of_study)))
+    # Every paper id from here on is an index into `registry`;
+    # the id strings are only looked up again when writing the outputs.
+    registry = PaperIdRegistry()
+    citation_data_cites_by_shard = RowBlockStore(memory_budget, 'citation_data_cites')
+    citation_data_cited_by_by_shard = RowBlockStore(memory_budget, 'citation_data_cited_by')
+    safe_paper_ids_all_shard = {}
+    query_paper_ids_all_shard = {}
+    query_paper_ids_by_field_all_shard = {}
+
+    # Filled in by the workers, one sqlite database per shard
+    paper_titles = TitleStore(title_store_dir)
+    mag_field_names = PaperIdRegistry()
+    mag_fields_all_shard = {}
+
+    # Each shard's results are merged as soon as the shard is done, and then dropped.
+    for i, r in stage.track(
+        checkpoint.imap_shards('metadata', metadata_read_pool, parse_metadata_shard, range(SHARDS_TOTAL_NUM), args.fields_of_study),
+        total=SHARDS_TOTAL_NUM):
+
+        citation_data_by_shard, query_paper_ids, query_paper_ids_by_field, safe_ids, mag_fields, shard_paper_ids, shard_mag_field_names = r
+
+        del r
+
+        # Shard-local index -> global index
+        to_global = registry.intern_many(shard_paper_ids)
+
+        # MAG fields are kept as small integer codes into mag_field_names
+        mag_field_row_ids, mag_field_offsets, mag_field_codes = mag_fields
+
+        mag_fields_all_shard[i] = (
+            to_global[mag_field_row_ids],
+            mag_field_offsets,
+            mag_field_names.intern_many(shard_mag_field_names)[mag_field_codes].astype(numpy.int8))
+
+        cites_block, cited_by_block = citation_data_by_shard
+
+        citation_data_cites_by_shard[i] = remap_row_block(cites_block, to_global)
+
+        if args.cocite:
+            citation_data_cited_by_by_shard[i] = remap_row_block(cited_by_block, to_global)
+
+        to_global = to_global.tolist()
+
+        query_paper_ids_all_shard[i] = [to_global[p_id] for p_id in query_paper_ids]
+
+        query_paper_ids_by_field_all_shard[i] = {
+            field: [to_global[p_id] for p_id in field_paper_ids]
+            for field, field_paper_ids in query_paper_ids_by_field.items()}
+
+        safe_paper_ids_all_shard[i] = ([to_global[p_id] for p_id in safe_ids.keys()], list(safe_ids.values()))
+
+        del citation_data_by_shard, cites_block, cited_by_block, query_paper_ids, query_paper_ids_by_field, safe_ids, mag_fields
 
     metadata_read_pool.close()
     metadata_read_pool.join()
 
-    print("Combining all the metadata from all the shards...")
-    citation_data_direct = {}
-    citation_data_direct_by_shard = []
-    safe_paper_ids = {}
-    query_paper_ids_all_shard = []
-    query_paper_ids_by_field_all_shard = []
-    paper_titles = {}
-
-    for r in tqdm.tqdm(metadata_read_results):
-        citation_data_by_shard, query_paper_ids, query_paper_ids_by_field, safe_ids, titles = r.get()
+    # safe_paper_ids[i] is the shard # of paper i, -1 if it is unsafe, and
+    # -2 if it was only ever seen as a citation and never as a metadata record.
+    safe_paper_ids = numpy.full(len(registry), -2, dtype=numpy.int8)
 
-        citation_data_direct.update(citation_data_by_shard)
+    for i in sorted(safe_paper_ids_all_shard):
+        safe_ids, shard_nums = safe_paper_ids_all_shard[i]
+        safe_paper_ids[safe_ids] = shard_nums
 
-        citation_data_direct_by_shard.append(citation_data_by_shard)
+    del safe_paper_ids_all_shard
 
-        query_paper_ids_all_shard.append(query_paper_ids)
+    safe_paper_mask = safe_paper_ids > -1
 
-        query_paper_ids_by_field_all_shard.append(query_paper_ids_by_field)
+    if args.shared_graph_dir:
+        # Workers read the citation data and the safe-id table from
+        # read-only memory-mapped files instead of fork-inherited copies.
+        shared_dir = create_shared_dir(args.shared_graph_dir)
 
-        safe_paper_ids.update(safe_ids)
+        citation_data_cites_by_shard.share(shared_dir)
+        citation_data_cited_by_by_shard.share(shared_dir)
 
-        paper_titles.update(titles)
+        safe_paper_ids = share_array(shared_dir, 'safe_paper_ids', safe_paper_ids)
+        safe_paper_mask = share_array(shared_dir, 'safe_paper_mask', safe_paper_mask)
 
     # Call Python GC in between steps to mitigate any potential OOM craashes
     gc.collect()
 
     # Remove invalid papers from citation_data_direct
     print("Remove invalid papers from citation_data_direct...")
+    stage = report.start_stage('sanitize')
     query_paper_ids_all_shard_sanitized = {}
     query_paper_ids_by_field_all_shard_sanitized = {}
 
-    citation_data_final = {}
+    freeze_before_fork()
 
     sanitize_direct_pool = multiprocessing.Pool(processes=args.num_processes)
-    sanitize_direct_results = {}
 
     if args.shards:
         sanitize_direct_shards_list = args.shards
     else:
         sanitize_direct_shards_list = list(range(SHARDS_TOTAL_NUM))
 
-    for i in sanitize_direct_shards_list:
-        sanitize_direct_results[i] = sanitize_direct_pool.apply_async(sanitize_citation_data_direct, args=(i,))
+    # Write citation_data_final to a file, one shard at a time in whichever order
+    # the sanitized results come in, instead of combining all of them into a single dict first.
+    print("Writing data.json to a file.")
 
-    sanitize_direct_pool.close()
-    sanitize_direct_pool.join()
+    pathlib.Path(args.save_dir).mkdir(exist_ok=True)
 
-    for i in tqdm.tqdm(sanitize_direct_shards_list):
-        citation_data_by_shard_sanitized, query_paper_ids_sanitized, query_paper_ids_by_field_sanitized = sanitize_direct_results[i].get()
+    if args.split_mode == 'hash':
+        split_writer = HashSplitWriter(
+            args.save_dir, os.path.join(args.save_dir, "mag_fields_by_query_paper_ids.json"), registry, sanitize_direct_shards_list)
 
-        citation_data_final.update(citation_data_by_shard_sanitized)
+    all_paper_ids = set()
 
-        query_paper_ids_all_shard_sanitized[i] = query_paper_ids_sanitized
+    with DataJsonWriter(os.path.join(args.save_dir, "data.json"), args.data_json_format) as data_json_writer:
+        for i, (citation_data_by_shard_sanitized, query_paper_ids_sanitized, query_paper_ids_by_field_sanitized) in stage.track(
+            checkpoint.imap_shards('sanitize', sanitize_direct_pool, sanitize_citation_data_direct, sanitize_direct_shards_list),
+            total=len(sanitize_direct_shards_list)):
 
-        query_paper_ids_by_field_all_shard_sanitized[i] = query_paper_ids_by_field_sanitized
+            for paper_id, citations in iter_citation_data(citation_data_by_shard_sanitized):
+                data_json_writer.write(
+                    registry[paper_id],
+                    {key: registry.to_paper_ids(cited_ids) for key, cited_ids in citations.items()})
 
-    # Call Python GC in between steps to mitigate any potential OOM craashes
-    gc.collect()
+            # Keep track of all paper ids ever appearing in data.json
+            all_paper_ids.update(get_all_paper_ids(citation_data_by_shard_sanitized))
 
-    # Write citation_data_final to a file.
-    print("Writing data.json to a file.")
+            query_paper_ids_all_shard_sanitized[i] = query_paper_ids_sanitized
 
-    pathlib.Path(args.save_dir).mkdir(exist_ok=True)
-
-    output_file = open(os.path.join(args.save_dir, "data.json"), 'w+')
+            if args.split_mode == 'hash':
+                # Already split by the worker
+                split_writer.add(i, query_paper_ids_by_field_sanitized)
+            else:
+                query_paper_ids_by_field_all_shard_sanitized[i] = query_paper_ids_by_field_sanitized
 
-    json.dump(citation_data_final, output_file, indent=2)
+    sanitize_direct_pool.close()
+    sanitize_direct_pool.join()
 
-    output_file.close()
+    unfreeze_after_join()
 
     # Call Python GC in between steps to mitigate any potential OOM craashes
     gc.collect()
 
     # Train-validation-test split
     print("Creating train-validation-test splits.")
+    stage = report.start_stage('splits')
 
-    train_file = open(os.path.join(args.save_dir, "train.txt"), 'w+')
-    val_file = open(os.path.join(args.save_dir, "val.txt"), 'w+')
-    test_file = open(os.path.join(args.save_dir, "test.txt"), 'w+')
-
-    train_file_ids_written = collections.defaultdict(bool)
-    val_file_ids_written = collections.defaultdict(bool)
-    test_file_ids_written = collections.defaultdict(bool)
-
-    if args.shards:
-        query_paper_ids_by_field_shards_list = args.shards
-    else:
-        query_paper_ids_by_field_shards_list = list(range(SHARDS_TOTAL_NUM))
-
-    # dictionary mapping s2orc id to mag field list
-    mag_fields_by_query_paper_ids = {}
-    mag_fields_by_query_paper_ids['train'] = collections.defaultdict(list)
-    mag_fields_by_query_paper_ids['val'] = collections.defaultdict(list)
-    mag_fields_by_query_paper_ids['test'] = collections.defaultdict(list)
-
-    for s in tqdm.tqdm(query_paper_ids_by_field_shards_list):
-        for field in query_paper_ids_by_field_all_shard_sanitized[s].keys():
-            field_paper_ids = query_paper_ids_by_field_all_shard_sanitized[s][field]
+    if args.split_mode == 'shuffle':
+        if args.shards:
+            query_paper_ids_by_field_shards_list = args.shards
+        else:
+            query_paper_ids_by_field_shards_list = list(range(SHARDS_TOTAL_NUM))
 
-            random.shuffle(field_paper_ids)
+        # (field, query paper ids) of every shard, split in that order
+        split_groups = [
+            (field, field_paper_ids)
+            for s in query_paper_ids_by_field_shards_list
+            for field, field_paper_ids in query_paper_ids_by_field_all_shard_sanitized[s].items()]
 
-            val_size = int(len(field_paper_ids) * args.val_proportion)
-            test_size = int(len(field_paper_ids) * args.test_proportion)
+        splits, split_fields = make_splits(
+            split_rng, split_groups, args.val_proportion, args.test_proportion, args.train_proportion)
 
-            if args.train_proportion:
-                train_size = int(len(field_paper_ids) * args.train_proportion)
-            else:
-                train_size = len(field_paper_ids) - val_size - test_size
-
-            for paper_id in field_paper_ids[0:train_size]:
-                if not train_file_ids_written[paper_id]:
-                    train_file.write(paper_id + '\n')
-                    train_file_ids_written[paper_id] = True
-                mag_fields_by_query_paper_ids['train'][paper_id].append(field)
-
-            for paper_id in field_paper_ids[train_size:train_size+val_size]:
-                if not val_file_ids_written[paper_id]:
-                    val_file.write(paper_id + '\n')
-                    val_file_ids_written[paper_id] = True
-                mag_fields_by_query_paper_ids['val'][paper_id].append(field)
-
-            for paper_id in field_paper_ids[train_size+val_size:train_size+val_size+test_size]:
-                if not test_file_ids_written[paper_id]:
-                    test_file.write(paper_id + '\n')
-                    test_file_ids_written[paper_id] = True
-                mag_fields_by_query_paper_ids['test'][paper_id].append(field)
-
-    train_file.close()
-    val_file.close()
-    test_file.close()
+        write_split_files(args.save_dir, splits, registry)
 
     print("Writing mag_fields_by_paper_ids to a file.")
-    mag_fields_by_query_paper_ids_output_file = open(os.path.join(args.save_dir, "mag_fields_by_query_paper_ids.json"), 'w+')
+    stage = report.start_stage('write_outputs')
 
-    json.dump(mag_fields_by_query_paper_ids, mag_fields_by_query_paper_ids_output_file)
-
-    mag_fields_by_query_paper_ids_output_file.close()
+    # dictionary mapping s2orc id to mag field list
+    if args.split_mode == 'hash':
+        # Written out while sanitizing; this puts the parts together
+        split_writer.close()
+    else:
+        write_mag_fields(os.path.join(args.save_dir, "mag_fields_by_query_paper_ids.json"), splits, split_fields, registry)
 
     # Call Python GC in between steps to mitigate any potential OOM craashes
     gc.collect()
 
-    # Get all paper ids and dump them to a file as well.
-    print("Getting all paper ids ever appearing in data.json.")
-    all_paper_ids = get_all_paper_ids(citation_data_final)
+    all_paper_ids = list(all_paper_ids)
 
-    # Call Python GC in between steps to mitigate any potential OOM craashes
-    gc.collect()
+    # When run by run_pipeline.py, paper_ids.json, safe_paper_ids.json and
+    # titles.json go to parts 2 and 3 in memory instead, and are only written
+    # to files with --keep_intermediate_files
+    write_intermediate_files = not in_pipeline() or keep_intermediate_files()
 
-    print("Writing all paper ids to a file.")
-    all_paper_ids_output_file = open(os.path.join(args.save_dir, "paper_ids.json"), 'w+')
+    if write_intermediate_files and args.intermediate_format == 'json':
+        # Dump all paper ids ever appearing in data.json to a file as well.
+        print("Writing all paper ids to a file.")
+        all_paper_ids_output_file = open(os.path.join(args.save_dir, "paper_ids.json"), 'w+')
 
-    json.dump(all_paper_ids, all_paper_ids_output_file)
+        json.dump(registry.to_paper_ids(all_paper_ids), all_paper_ids_output_file)
 
-    all_paper_ids_output_file.close()
+        all_paper_ids_output_file.close()
 
-    # Call Python GC in between steps to mitigate any potential OOM craashes
-    gc.collect()
+        # Call Python GC in between steps to mitigate any potential OOM craashes
+        gc.collect()
 
+    # The MAG fields of all (safe) paper ids were already collected while reading the metadata.
     print("Getting MAG fields information for all (safe) paper ids.")
-    metadata_mag_field_pool = multiprocessing.Pool(processes=args.num_processes)
-    metadata_mag_field_results = []
-
-    for i in range(SHARDS_TOTAL_NUM):
-        metadata_mag_field_results.append(
-            metadata_mag_field_pool.apply_async(
-                parse_metadata_get_mag_shard, args=(i,)
-            )
-        )
-
-    metadata_mag_field_pool.close()
-    metadata_mag_field_pool.join()
-
     metadata_mag_fields = {}
 
-    for r in tqdm.tqdm(metadata_mag_field_results):
-        metadata_mag_fields.update(r.get())
+    for shard_num in tqdm.tqdm(sorted(mag_fields_all_shard)):
+        mag_field_row_ids, mag_field_offsets, mag_field_codes = mag_fields_all_shard[shard_num]
+
+        for j, paper_id in enumerate(mag_field_row_ids.tolist()):
+            # A paper only counts for the shard recorded in safe_paper_ids
+            if safe_paper_ids[paper_id] == shard_num:
+                metadata_mag_fields[registry[paper_id]] = [
+                    mag_field_names[c] for c in mag_field_codes[mag_field_offsets[j]:mag_field_offsets[j+1]].tolist()]
 
     # Write metadata to a file.
     print("Writing the MAG field information...")
@@ -453,19 +564,32 @@ if __name__ == '__main__':
 
     metadata_mag_fields_output_file.close()
 
-    print("Writing safe paper ids to a file.")
-    safe_paper_ids_output_file = open(os.path.join(args.save_dir, "safe_paper_ids.json"), 'w+')
+    if write_intermediate_files and args.intermediate_format == 'binary':
+        print("Writing all paper ids, safe paper ids and titles to the paper table.")
+        write_paper_table(get_paper_table_path(args.save_dir), registry, safe_paper_ids, paper_titles, all_paper_ids)
+    elif write_intermediate_files:
+        print("Writing safe paper ids to a file.")
+        safe_paper_ids_output_file = open(os.path.join(args.save_dir, "safe_paper_ids.json"), 'w+')
 
-    json.dump(safe_paper_ids, safe_paper_ids_output_file)
+        json.dump(
+            {registry[p_id]: shard_num for p_id, shard_num in enumerate(safe_paper_ids.tolist()) if shard_num > -2},
+            safe_paper_ids_output_file)
 
-    safe_paper_ids_output_file.close()
+        safe_paper_ids_output_file.close()
 
-    # Call Python GC in between steps to mitigate any potential OOM craashes
-    gc.collect()
+        # Call Python GC in between steps to mitigate any potential OOM craashes
+        gc.collect()
+
+        # With --title_store, part 2 reads the titles from the store instead
+        if not args.title_store:
+            print("Writing all paper titles to a file.")
 
-    print("Writing all paper titles to a file.")
-    all_titles_output_file = open(os.path.join(args.save_dir, "titles.json"), 'w+')
+            with DataJsonWriter(os.path.join(args.save_dir, "titles.json"), 'indent') as all_titles_writer:
+                for p_id, title in paper_titles.indexed_items(registry):
+                    all_titles_writer.write(registry[p_id], title)
 
-    json.dump(paper_titles, all_titles_output_file, indent=2)
+    if in_pipeline():
+        print("Handing the paper ids and their shards over to part 2.")
+        hand_over(**get_part2_inputs(registry, all_paper_ids, safe_paper_ids, title_store_dir))
 
-    all_titles_output_file.close()
+    report.write(os.path.join(args.save_dir, "part1_report.json"))
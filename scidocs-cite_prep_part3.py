@@ -1,9 +1,137 @@
 import argparse
 import random
+import multiprocessing
 
+import numpy
 import ujson as json
 import tqdm
-import collections
+
+from s2orc_prep.paper_id_registry import PaperIdRegistry
+from s2orc_prep.citation_graph import CitationGraph, get_top_cocitations
+from s2orc_prep.paper_table import PaperTable
+from s2orc_prep.pipeline import in_pipeline, take_over
+
+
+# Draws k distinct ids from `paper_ids` (a list) that are not in `excluded`,
+# by picking random indices and rejecting the excluded and repeated ones.
+# As the excluded ids are usually a tiny part of the corpus, this takes
+# O(k) draws per query instead of copying all of paper_ids for every query.
+def sample_negatives(rng, paper_ids, paper_ids_set, excluded, k):
+
+    num_candidates = len(paper_ids) - sum(1 for i in excluded if i in paper_ids_set)
+
+    # Too few candidates for rejection sampling to be quick
+    if num_candidates < 2 * k:
+        negative_candidates = [i for i in paper_ids if i not in excluded]
+
+        if len(negative_candidates) <= k:
+            return negative_candidates
+
+        return rng.sample(negative_candidates, k=k)
+
+    negatives = []
+    negatives_set = set()
+
+    while len(negatives) < k:
+        negative = paper_ids[rng.randrange(len(paper_ids))]
+
+        if negative in excluded or negative in negatives_set:
+            continue
+
+        negatives.append(negative)
+        negatives_set.add(negative)
+
+    return negatives
+
+
+# The `cited_by` lists of the query papers and the `cites` lists
+# (deduplicated, in order) of the papers in them, as citation graphs over
+# the indices of a PaperIdRegistry.
+def build_cocitation_graphs(data, query_paper_ids):
+
+    registry = PaperIdRegistry()
+
+    def build_graph(rows):
+
+        sources = []
+        targets = []
+
+        for p_id, cited_ids in tqdm.tqdm(rows):
+            targets.append(registry.intern_many(cited_ids))
+            sources.append(numpy.full(len(cited_ids), registry.intern(p_id), dtype=numpy.int64))
+
+        return numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + sources), \
+            numpy.concatenate([numpy.zeros(0, dtype=numpy.int64)] + targets)
+
+    cited_by_edges = build_graph((p_id, data[p_id]['cited_by']) for p_id in query_paper_ids)
+
+    # Papers citing any of the query papers, in the order they were interned
+    citing_paper_ids = registry.paper_ids[:]
+
+    cites_edges = build_graph(
+        (p_id, list(dict.fromkeys(data[p_id]['cites'])))
+        for p_id in citing_paper_ids if 'cites' in data.get(p_id, ()))
+
+    cites_graph = CitationGraph.from_edges(len(registry), *cites_edges)
+    cited_by_graph = CitationGraph.from_edges(len(registry), *cited_by_edges)
+
+    return registry, cites_graph, cited_by_graph
+
+
+# The qrel lines of a chunk of query papers, query_paper_ids[start:end],
+# as a single string.
+# Each query paper gets its own random number generator, seeded with
+# --seed and its id, so that the sampled papers don't depend on which
+# worker processes it or in what order.
+def get_qrel_lines(chunk):
+
+    start, end = chunk
+
+    qrel_lines = []
+    empty_cocite_count = 0
+
+    for i in range(start, end):
+        p_id = query_paper_ids[i]
+
+        rng = random.Random('{}-{}'.format(args.seed, p_id))
+
+        if args.cocite:
+            positive_candidates = registry.to_paper_ids(cocited[cocited_offsets[i]:cocited_offsets[i+1]].tolist())
+
+            if len(positive_candidates) == 0:
+                empty_cocite_count += 1
+                continue
+        else:
+            # Outbound citations
+            positive_candidates = data[p_id]["cites"]
+
+        positive_candidates = set(positive_candidates)
+
+        try:
+            # Just in case the query paper itself is among the candidates...
+            positive_candidates.remove(p_id)
+        except:
+            pass
+
+        # Randomly select max_num_positives positive papers
+        # (sorted, as the order of a set changes from run to run)
+        if len(positive_candidates) < args.max_num_positives:
+            positives = sorted(positive_candidates)
+        else:
+            positives = rng.sample(sorted(positive_candidates), k=args.max_num_positives)
+
+        # Randomly select max_num_negatives papers among the non-cited ones
+        # (and not the query paper itself)
+        negatives = sample_negatives(
+            rng, all_paper_ids, all_paper_ids_set, positive_candidates | {p_id}, args.max_num_negatives)
+
+        for pos_id in positives:
+            qrel_lines.append(str(p_id) + " 0 " + str(pos_id) + " 1\n")
+
+        for neg_id in negatives:
+            qrel_lines.append(str(p_id) + " 0 " + str(neg_id) + " 0\n")
+
+    return ''.join(qrel_lines), empty_cocite_count
 
 
 if __name__ == '__main__':
@@ -11,7 +139,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('data_json', help='path to data.json.')
-    parser.add_argument('paper_ids_json', help='path to paper_ids.json.')
+    parser.add_argument('paper_ids_json', nargs='?', help='path to paper_ids.json (leave out with --paper_table).')
     parser.add_argument('query_paper_ids_txt', help='path to the txt file containing query paper ids.')
 
     parser.add_argument('save_qrel', help='path to a directory to save the processed files.')
@@ -23,92 +151,86 @@ if __name__ == '__main__':
 
     parser.add_argument('--cocite', default=False, action='store_true')
 
+    parser.add_argument(
+        '--cocite_block_size', default=10000, type=int,
+        help='number of query papers whose co-citations are counted at once with --cocite.')
+
+    parser.add_argument('--num_processes', default=1, type=int, help='Number of processes to use.')
+
+    parser.add_argument(
+        '--chunk_size', default=1000, type=int,
+        help='number of query papers handed to a worker at a time.')
+
+    parser.add_argument(
+        '--paper_table',
+        help='path to the paper_table directory written by part 1 with --intermediate_format binary, to read the paper ids from instead of paper_ids.json.')
+
     args = parser.parse_args()
 
-    # Random seed fix for Python random
-    random.seed(args.seed)
+    if not args.paper_table and not args.paper_ids_json and not in_pipeline():
+        raise Exception("Either pass paper_ids.json or --paper_table.")
 
     data_file = open(args.data_json, 'r')
     data = json.load(data_file)
     data_file.close()
 
-    # Load paper_ids.json
-    print("Loading paper_ids.json...")
-    all_paper_ids_file = open(args.paper_ids_json, 'r') 
-    all_paper_ids = set(json.load(all_paper_ids_file))
-    all_paper_ids_file.close()
+    if in_pipeline():
+        # Handed over by part 2 when run by run_pipeline.py
+        all_paper_ids = take_over('paper_ids')
+    elif args.paper_table:
+        print("Loading the paper ids from the paper table...")
+        all_paper_ids = PaperTable(args.paper_table).get_selected_paper_ids()
+    else:
+        # Load paper_ids.json
+        print("Loading paper_ids.json...")
+        all_paper_ids_file = open(args.paper_ids_json, 'r') 
+        all_paper_ids = json.load(all_paper_ids_file)
+        all_paper_ids_file.close()
+
+    # The list is what the negatives are drawn from, the set for lookups.
+    # Like data and the co-citations, these are inherited by the workers.
+    # The order of paper_ids.json depends on which part 1 shards finished
+    # first, so the list is sorted to make --seed give the same qrels on
+    # every run.
+    all_paper_ids = sorted(all_paper_ids)
+    all_paper_ids_set = set(all_paper_ids)
 
     query_paper_ids_file = open(args.query_paper_ids_txt, 'r')
     query_paper_ids = query_paper_ids_file.readlines()
     query_paper_ids = [i.rstrip() for i in query_paper_ids]
     query_paper_ids_file.close()
 
+    if args.cocite:
+        # Most co-cited papers of every query paper, computed in bulk
+        print("Counting co-citations...")
+        registry, cites_graph, cited_by_graph = build_cocitation_graphs(data, query_paper_ids)
+
+        (_, cocited_offsets, cocited), _ = get_top_cocitations(
+            cites_graph, cited_by_graph, [registry.get(p_id) for p_id in query_paper_ids], args.cocite_block_size)
+
+    # Queries are handed out to the workers in chunks, and the qrel lines of
+    # each chunk are written in query order
+    chunks = [
+        (start, min(start + args.chunk_size, len(query_paper_ids)))
+        for start in range(0, len(query_paper_ids), args.chunk_size)]
+
     empty_cocite_count = 0
 
+    if args.num_processes > 1:
+        qrel_pool = multiprocessing.Pool(processes=args.num_processes)
+        chunk_results = qrel_pool.imap(get_qrel_lines, chunks)
+    else:
+        qrel_pool = None
+        chunk_results = map(get_qrel_lines, chunks)
+
     with open(args.save_qrel, 'w') as qrel_file:
-        for p_id in tqdm.tqdm(query_paper_ids):
-            if args.cocite:
-                counter = collections.Counter()
-
-                cited_by = data[p_id]["cited_by"]
-
-                for cited_by_p_id in cited_by:
-                    try:
-                        cited_by_p_id_cites = set(data[cited_by_p_id]["cites"])
-                        counter.update(cited_by_p_id_cites)
-                        del counter[p_id]
-                    except KeyError:
-                        continue
-
-                if len(counter.values()) == 0:
-                    empty_cocite_count += 1
-                    continue
-
-                # Get the paper ids until there are at least 5 papers
-                frequency = max(counter.values())
-                positive_candidates = []
-                
-                while len(positive_candidates) < args.max_num_positives and frequency > 0:
-                    positive_candidates += [x[0] for x in counter.most_common(frequency)]
-                    frequency -= 1
-            else:
-                # Outbound citations
-                positive_candidates = data[p_id]["cites"]
-
-            positive_candidates = set(positive_candidates)
-
-            try:
-                # Just in case the query paper itself is among the candidates...
-                positive_candidates.remove(p_id)
-            except:
-                pass
-
-            # Randomly select max_num_positives positive papers
-            if len(positive_candidates) < args.max_num_positives:
-                positives = positive_candidates
-            else:
-                positives = random.sample(positive_candidates, k=args.max_num_positives)
-            
-            # Sample from the non-cited papers
-            negative_candidates = all_paper_ids - positive_candidates
-
-            try:
-                # Just in case the query paper itself is among the candidates...
-                negative_candidates.remove(p_id)
-            except:
-                pass
-
-
-            # Randomly select 50 negative papers
-            if len(negative_candidates) < args.max_num_negatives:
-                negatives = negative_candidates
-            else:
-                negatives = random.sample(negative_candidates, k=args.max_num_negatives)
-
-            for pos_id in positives:
-                qrel_file.write(str(p_id) + " 0 " + str(pos_id) + " 1\n")
-
-            for neg_id in negatives:
-                qrel_file.write(str(p_id) + " 0 " + str(neg_id) + " 0\n")
+        for qrel_lines, chunk_empty_cocite_count in tqdm.tqdm(chunk_results, total=len(chunks)):
+            qrel_file.write(qrel_lines)
+
+            empty_cocite_count += chunk_empty_cocite_count
+
+    if qrel_pool is not None:
+        qrel_pool.close()
+        qrel_pool.join()
 
     print("empty_cocite_count = ", str(empty_cocite_count))
@@ -2,16 +2,48 @@ import os
 import pathlib
 import multiprocessing
 import argparse
-import gzip
-import random
-import math
-import copy
 import gc
-import collections
 
+import numpy
 import ujson as json
 import tqdm
 
+from s2orc_prep.paper_id_registry import PaperIdRegistry
+from s2orc_prep.citation_graph import make_row_block, remap_row_block, filter_row_block, get_two_hop_citations
+from s2orc_prep.shared_graph import create_shared_dir, share_array, share_citation_graph, freeze_before_fork, unfreeze_after_join
+from s2orc_prep.data_json_writer import DataJsonWriter, DATA_JSON_FORMATS
+from s2orc_prep.shard_reader import iter_shard_lines
+from s2orc_prep.record_decoder import get_record_decoder, RECORD_DECODERS, METADATA_FIELDS
+from s2orc_prep.metadata_cache import open_metadata_cache, CachedPaperIdRegistry
+from s2orc_prep.checkpoint import open_checkpoint
+from s2orc_prep.spill import MemoryBudget, RowBlockStore, build_citation_graph
+from s2orc_prep.metrics import MetricsReport, get_task_counters
+from s2orc_prep.splits import make_splits, write_split_files, write_mag_fields, SPLIT_MODES, get_split_bounds, assign_hash_splits, HashSplitWriter
+from s2orc_prep.profiling import enable_profiling
+from s2orc_prep.paper_table import INTERMEDIATE_FORMATS, write_paper_table, get_paper_table_path
+from s2orc_prep.title_store import TitleStore, write_shard_titles, get_part1_title_store_dir
+from s2orc_prep.pipeline import in_pipeline, keep_intermediate_files, hand_over, get_part2_inputs
+
+
+# Returns the opened metadata shard, an iterator over its papers, read
+# either from the columnar cache or by decoding the jsonl lines, and the
+# shard-local registry to intern their paper ids with. Papers read from the
+# cache hold indices into the cache's own id table, which are interned as
+# they are, without going through the id strings.
+def open_metadata_shard(shard_num, fields):
+
+    shard_path = os.path.join(args.data_dir, 'metadata', 'metadata_{}.jsonl.gz'.format(shard_num))
+
+    if args.metadata_cache_dir:
+        metadata_file = open_metadata_cache(shard_path, args.metadata_cache_dir)
+
+        return metadata_file, iter(metadata_file), CachedPaperIdRegistry(metadata_file)
+
+    metadata_file = iter_shard_lines(shard_path, num_threads=args.reader_threads)
+    record_decoder = get_record_decoder(args.record_decoder, fields)
+
+    return metadata_file, (record_decoder.decode(line) for line in metadata_file), PaperIdRegistry()
+
 
 # Process metadata jsonl into `data.json` as required by SPECTER.
 # Need to get all the citation information.
@@ -23,61 +55,66 @@ def parse_metadata_shard(shard_num, fields=None):
     output_safe_paper_ids = {}
     output_titles = {}
 
-    metadata_file = gzip.open(
-        os.path.join(args.data_dir, 'metadata', 'metadata_{}.jsonl.gz'.format(shard_num)), 'rt')
+    # All the paper ids below are indices into this shard-local registry.
+    # The parent maps them onto the global registry when combining the shards.
+    metadata_file, papers, shard_registry = open_metadata_shard(shard_num, METADATA_FIELDS)
 
-    print("Reading metadata shard {}".format(shard_num))
+    # Number of records read, and dropped by each of the checks below
+    counters = get_task_counters()
 
-    pbar = tqdm.tqdm(
-        desc="#" + "{}".format(shard_num).zfill(3),
-        position=shard_num+1)
+    for paper in papers:
+        paper_id = shard_registry.intern(paper['paper_id'])
 
-    for line in metadata_file:
-        paper = json.loads(line)
+        counters['records'] += 1
 
         # Only consider papers that
         # have MAG field of study specified, and
         # PDF parse is available & abstract is included in PDF parse
-        if not paper['mag_field_of_study'] \
-           or not paper['has_pdf_parse']:
-            output_safe_paper_ids[paper['paper_id']] = -1
-            pbar.update(1)
+        if not paper['mag_field_of_study']:
+            output_safe_paper_ids[paper_id] = -1
+            counters['filtered_no_field'] += 1
+            continue
+
+        if not paper['has_pdf_parse']:
+            output_safe_paper_ids[paper_id] = -1
+            counters['filtered_no_pdf_parse'] += 1
             continue
 
         if not paper['has_pdf_parsed_abstract']:
-            output_safe_paper_ids[paper['paper_id']] = -1
-            pbar.update(1)
+            output_safe_paper_ids[paper_id] = -1
+            counters['filtered_no_abstract'] += 1
             continue
 
         # Since SPECTER requires all papers in the graph to have titles and abstract,
         # Once the conditions listed above has been met,
         # record the paper id in safe_paper_ids
-        output_safe_paper_ids[paper['paper_id']] = shard_num
+        output_safe_paper_ids[paper_id] = shard_num
 
-        # Fetch titles
-        output_titles[paper['paper_id']] = paper['title']
+        # Fetch titles (written to this shard's title store below)
+        output_titles[paper_id] = paper['title']
 
         # Query papers should have outbound citations
         if not paper['has_outbound_citations']:
-            pbar.update(1)
+            counters['filtered_no_outbound_citations'] += 1
             continue
 
-        if paper['paper_id'] in output_citation_data.keys():
-            print("Metadata shard {} Duplicate paper id {} found. Please check.".format(shard_num, paper['paper_id']))
+        if paper_id in output_citation_data.keys():
+            print("Metadata shard {} Duplicate paper id {} found. Please check.".format(shard_num, shard_registry[paper_id]))
+            counters['filtered_duplicate'] += 1
         else:
             
             if args.cross_domain and len(paper['mag_field_of_study']) < 2:
-                pbar.update(1)
+                counters['filtered_cross_domain'] += 1
                 continue
             
             # if args.fields_of_study is specified, only consider the papers from
             # those fields
             if fields and set(fields).isdisjoint(set(paper['mag_field_of_study'])):
-                pbar.update(1)
+                counters['filtered_field'] += 1
                 continue
 
             # Record paper_id
-            output_query_paper_ids.append(paper['paper_id'])
+            output_query_paper_ids.append(paper_id)
 
             # Record paper_id based on mag_field_of_study
             for paper_field in paper['mag_field_of_study']:
@@ -87,132 +124,99 @@ def parse_metadata_shard(shard_num, fields=None):
                 if paper_field not in output_query_paper_ids_by_field.keys():
                     output_query_paper_ids_by_field[paper_field] = []
 
-                output_query_paper_ids_by_field[paper_field].append(paper['paper_id'])
-
-            # Iterate through paper ids of outbound citations
-            citations = {}
-
-            for out_id in paper['outbound_citations']:
-                citations[out_id] = {"count": 5} # 5 = direct citation
+                output_query_paper_ids_by_field[paper_field].append(paper_id)
 
-            output_citation_data[paper['paper_id']] = citations
-
-        pbar.update(1)
+            # Paper ids of outbound citations, without duplicates
+            output_citation_data[paper_id] = list(dict.fromkeys(
+                shard_registry.intern_many(paper['outbound_citations']).tolist()))
 
     metadata_file.close()
 
-    return output_citation_data, output_query_paper_ids, output_query_paper_ids_by_field, output_safe_paper_ids, output_titles
+    # Kept on disk for part 2, rather than sent back to the parent
+    write_shard_titles(
+        title_store_dir, shard_num,
+        ((shard_registry[p_id], title) for p_id, title in output_titles.items()))
+
+    return make_row_block(output_citation_data), output_query_paper_ids, output_query_paper_ids_by_field, output_safe_paper_ids, shard_registry.paper_ids
 
 def get_indirect_citations(shard_num):
 
-    citation_data_indirect = {}
+    get_task_counters()['records'] += len(query_paper_ids_all_shard_sanitized[shard_num])
 
-    pbar = tqdm.tqdm(
-        desc="#" + "{}".format(shard_num).zfill(3), position=shard_num+1)
+    if args.indirect_engine == 'sparse':
+        return get_two_hop_citations(
+            citation_data_direct_matrix, citation_data_final_matrix, safe_paper_mask,
+            query_paper_ids_all_shard_sanitized[shard_num], block_size=args.indirect_block_size)
 
-    for paper_id in query_paper_ids_all_shard_sanitized[shard_num]:
-        directly_cited_ids = citation_data_final[paper_id].keys()
+    citation_data_indirect = {}
 
-        citation_data_indirect[paper_id] = {}
+    for paper_id in query_paper_ids_all_shard_sanitized[shard_num].tolist():
+        directly_cited_ids = citation_data_final.cited_by(paper_id)
 
         # Search each shards
-        indirect_citations = get_citations_by_ids(directly_cited_ids)
-
-        for indirect_id in indirect_citations:
-            # This indirect citation would serve as a hard negative only if the paper_id
-            # doesn't cite it in the first place.
-            # Also, check whether it is in the safe_paper_ids as decided
-            # by the metadata parse result (have all the necessary values populated)
-            if indirect_id not in directly_cited_ids and safe_paper_ids[indirect_id] > -1:
-                citation_data_indirect[paper_id][indirect_id] = {"count": 1} # 1 = "a citation of a citation"
+        # this should be accessing citation_data_direct and
+        # not citation_data_final, as cited ids may or may not be
+        # part of citation_data_final
+        indirect_citations = numpy.unique(citation_data_direct.cited_by_many(directly_cited_ids))
 
-        pbar.update(1)
+        # This indirect citation would serve as a hard negative only if the paper_id
+        # doesn't cite it in the first place.
+        # Also, check whether it is in the safe_paper_ids as decided
+        # by the metadata parse result (have all the necessary values populated)
+        citation_data_indirect[paper_id] = indirect_citations[
+            numpy.isin(indirect_citations, directly_cited_ids, invert=True)
+            & (safe_paper_ids[indirect_citations] > -1)]
 
-    return citation_data_indirect
+    return make_row_block(citation_data_indirect)
 
 def sanitize_citation_data_direct(shard_num):
 
     # Remove all the "unsafe" papers from the shard's citation_data_direct,
-    # while avoiding iterating again through all the metadata shards
-    print("Removing invalid direct citations...")
-
-    output_citation_data_direct = copy.deepcopy(citation_data_direct_by_shard[shard_num])
-    output_query_paper_ids = copy.deepcopy(query_paper_ids_all_shard[shard_num])
-    output_query_paper_ids_by_field = copy.deepcopy(query_paper_ids_by_field_all_shard[shard_num])
-
-    pbar = tqdm.tqdm(
-        desc="#" + "{}".format(shard_num).zfill(3),
-        total=len(citation_data_direct_by_shard[shard_num].keys()),
-        position=shard_num+1)
+    # while avoiding iterating again through all the metadata shards.
+    # The sanitized outputs are built in a single pass, rather than copying
+    # the shard's data and deleting entries from the copies one by one.
+    # This is the shard's own block: a query paper that also appears in
+    # another shard keeps this shard's citations here, not the merged graph's.
+    output_citation_data_direct = filter_row_block(citation_data_direct_blocks[shard_num], safe_paper_mask)
 
-    for paper_id in citation_data_direct_by_shard[shard_num].keys():
-        for cited_id in citation_data_direct_by_shard[shard_num][paper_id].keys():
-            if safe_paper_ids[cited_id] == -1:
-                del output_citation_data_direct[paper_id][cited_id]
+    counters = get_task_counters()
+    counters['records'] += len(query_paper_ids_all_shard[shard_num])
+    counters['filtered_no_safe_citations'] += len(query_paper_ids_all_shard[shard_num]) - len(output_citation_data_direct[0])
 
-        pbar.update(1)
+    # The remaining query ids (the rows of the block) come out in their original order
+    remaining_query_paper_ids = output_citation_data_direct[0]
 
-    print("Removing query ids that no longer have any direct citations.")
-    query_ids_to_remove = []
+    output_query_paper_ids_by_field = {
+        field: field_paper_ids[numpy.isin(field_paper_ids, remaining_query_paper_ids)]
+        for field, field_paper_ids in query_paper_ids_by_field_all_shard[shard_num].items()}
 
-    pbar = tqdm.tqdm(
-        desc="#" + "{}".format(shard_num).zfill(3),
-        total=len(output_citation_data_direct.keys()),
-        position=shard_num+1)
+    # With --split_mode hash, the shard's query papers are put into splits right here
+    if args.split_mode == 'hash':
+        return output_citation_data_direct, assign_hash_splits(args.seed, output_query_paper_ids_by_field, registry, split_bounds)
 
-    for paper_id in tqdm.tqdm(output_citation_data_direct.keys()):
-        if len(output_citation_data_direct[paper_id].keys()) == 0:
-            query_ids_to_remove.append(paper_id)
+    return output_citation_data_direct, output_query_paper_ids_by_field
 
-        pbar.update(1)
-
-    pbar = tqdm.tqdm(
-        desc="#" + "{}".format(shard_num).zfill(3),
-        total=len(query_ids_to_remove),
-        position=shard_num+1)
-
-    for id_to_delete in query_ids_to_remove:
-        del output_citation_data_direct[id_to_delete]
-        output_query_paper_ids.remove(id_to_delete)
-
-        for field in output_query_paper_ids_by_field.keys():
-            try:
-                output_query_paper_ids_by_field[field].remove(id_to_delete)
-            except:
-                continue
+def get_final_citations(paper_id, indirect_ids):
 
-        pbar.update(1)
+    # Edge weights are only materialized here, when the output is written.
+    citations = {}
 
-    return output_citation_data_direct, output_query_paper_ids, output_query_paper_ids_by_field
+    for cited_id in citation_data_final.cited_by(paper_id).tolist():
+        citations[registry[cited_id]] = {"count": 5} # 5 = direct citation
 
-def get_citations_by_ids(ids):
-
-    citations = set()
-
-    for paper_id in ids:
-        try:
-            # this should be accessing citation_data_direct and
-            # not citation_data_final, as cited ids may or may not be
-            # part of citation_data_final
-            for cited_id in citation_data_direct[paper_id].keys():
-                citations.add(cited_id)
-        except:
-            continue
+    for indirect_id in indirect_ids.tolist():
+        citations[registry[indirect_id]] = {"count": 1} # 1 = "a citation of a citation"
 
     return citations
 
-def get_all_paper_ids(citation_data):
-
-    all_ids = set()
+def get_all_paper_ids(citation_graph, other_paper_ids):
 
-    for paper_id in tqdm.tqdm(citation_data.keys()):
-        all_ids.add(paper_id)
+    all_ids = [numpy.flatnonzero(citation_graph.degrees()), citation_graph.neighbors]
 
-        for cited_id in citation_data[paper_id].keys():
-            all_ids.add(cited_id)
-
-    return list(all_ids)
+    for paper_ids in tqdm.tqdm(other_paper_ids):
+        all_ids.append(paper_ids)
 
+    return numpy.unique(numpy.concatenate(all_ids)).tolist()
 
 if __name__ == '__main__':
 
@@ -228,6 +232,18 @@ if __name__ == '__main__':
 
     parser.add_argument('--shards', nargs='*', type=int, help='Specific shards to be used.')
 
+    parser.add_argument(
+        '--reader_threads', default=0, type=int,
+        help='Number of threads decompressing each shard in the background. 0 decompresses on the worker itself.')
+
+    parser.add_argument(
+        '--metadata_cache_dir',
+        help='path to a directory for the columnar cache of the metadata shards. Built on first use and shared by the part 1 scripts.')
+
+    parser.add_argument(
+        '--record_decoder', default='ujson', choices=RECORD_DECODERS,
+        help='parse every shard line in full (ujson), or only decode the fields that are actually used (projected).')
+
     parser.add_argument(
         '--val_proportion',
         default=0.2, type=float, help='proportion of the generated dataset to be reserved for validation.')
@@ -244,11 +260,88 @@ if __name__ == '__main__':
 
     parser.add_argument('--smoothed_weighting', default=False, action='store_true')
 
+    parser.add_argument(
+        '--indirect_engine', default='loop', choices=['loop', 'sparse'],
+        help='compute indirect citations paper by paper (loop) or in bulk with sparse matrix products (sparse).')
+
+    parser.add_argument(
+        '--indirect_block_size', default=10000, type=int,
+        help='number of query papers per sparse matrix product when --indirect_engine is sparse.')
+
+    parser.add_argument(
+        '--shared_graph_dir',
+        help='publish the citation graph and the safe-id table as read-only memory-mapped files in this directory (e.g. /dev/shm) for the workers.')
+
+    parser.add_argument(
+        '--split_mode', default='shuffle', choices=SPLIT_MODES,
+        help='shuffle the query papers of each field once all shards are read (shuffle), or put each one in a split by a seeded hash of its paper id, '
+             'which streams the splits out shard by shard and keeps a paper in the same split whatever --shards are used (hash).')
+
+    parser.add_argument(
+        '--data_json_format', default='indent', choices=DATA_JSON_FORMATS,
+        help='write data.json pretty-printed (indent), without whitespace (compact), or one query paper per line (ndjson).')
+
+    parser.add_argument(
+        '--intermediate_format', default='json', choices=INTERMEDIATE_FORMATS,
+        help='write paper_ids.json, safe_paper_ids.json and titles.json for part 2 (json), or a single memory-mapped paper_table directory instead (binary).')
+
+    parser.add_argument(
+        '--title_store', default=False, action='store_true',
+        help='keep the titles in a title_store directory of per-shard sqlite databases in save_dir, for the --title_store option of part 2, instead of writing titles.json.')
+
+    parser.add_argument(
+        '--memory_budget', type=float,
+        help='memory (in GB) that the citation graphs may take up in the main process. Whatever does not fit is spilled to disk.')
+
+    parser.add_argument(
+        '--spill_dir',
+        help='directory to spill to when --memory_budget is exceeded (preferably on a local disk). Defaults to the system temporary directory.')
+
+    parser.add_argument(
+        '--work_dir',
+        help='keep the results of every stage and shard in this directory, so that a failed run can be picked up again with --resume.')
+
+    parser.add_argument(
+        '--resume', default=False, action='store_true',
+        help='reuse the stages and shards already completed in --work_dir instead of computing them again.')
+
+    parser.add_argument(
+        '--profile', default=False, action='store_true',
+        help='profile every stage with cProfile, in the main process and in the workers, and write the merged profiles to save_dir/profile.')
+
+    parser.add_argument(
+        '--profile_memory', default=False, action='store_true',
+        help='with --profile, also trace the memory allocated by the workers with tracemalloc (slow).')
+
     args = parser.parse_args()
 
-    # Random seed fix for Python random
-    # Will be used for train/val splitting
-    random.seed(args.seed)
+    # Results of the stages completed so far, see s2orc_prep/checkpoint.py
+    checkpoint = open_checkpoint(args)
+
+    # cProfile/tracemalloc results of each stage, see s2orc_prep/profiling.py
+    if args.profile:
+        enable_profiling(os.path.join(args.save_dir, 'profile'), args.profile_memory)
+
+    # Time, record counts and memory use of each stage, written to part1_report.json
+    report = MetricsReport()
+
+    # Where the workers write the titles (see s2orc_prep/title_store.py). The
+    # store is only kept in save_dir with --title_store, or for part 2 when
+    # run by run_pipeline.py.
+    title_store_dir = get_part1_title_store_dir(args.save_dir, args.title_store or in_pipeline(), args.work_dir)
+
+    # citation_data_direct, its per-shard blocks and citation_data_final (the
+    # titles are kept on disk by the workers, see s2orc_prep/title_store.py)
+    memory_budget = MemoryBudget(args.memory_budget, args.spill_dir, num_parts=3)
+
+    # Random number generator for the train/val splitting
+    split_rng = numpy.random.default_rng(args.seed)
+
+    if args.split_mode == 'hash' and args.smoothed_weighting:
+        raise Exception("--smoothed_weighting needs the per-field counts of all shards, so it only works with --split_mode shuffle.")
+
+    # Ranges of the hash for each split with --split_mode hash
+    split_bounds = get_split_bounds(args.val_proportion, args.test_proportion, args.train_proportion)
 
     # Total number of shards to process
     SHARDS_TOTAL_NUM = 100
@@ -260,285 +353,271 @@ if __name__ == '__main__':
                 raise Exception("Invalid value for args.query_shard: {}".format(n))
 
     # Parse `metadata` from s2orc to create `data.json` for SPECTER
+    stage = report.start_stage('metadata')
+
     metadata_read_pool = multiprocessing.Pool(processes=args.num_processes)
-    metadata_read_results = []
 
-    for i in range(SHARDS_TOTAL_NUM):
-        metadata_read_results.append(
-            metadata_read_pool.apply_async(
-                parse_metadata_shard, args=(i, args.fields_of_study)))
+    # Every paper id from here on is an index into `registry`;
+    # the id strings are only looked up again when writing the outputs.
+    registry = PaperIdRegistry()
+    # Spilled to disk as they arrive once past the budget. Kept until each
+    # shard has been sanitized.
+    citation_data_direct_blocks = RowBlockStore(memory_budget, 'citation_data_direct_blocks')
+    safe_paper_ids_all_shard = {}
+    query_paper_ids_all_shard = {}
+    query_paper_ids_by_field_all_shard = {}
+
+    # Filled in by the workers, one sqlite database per shard
+    paper_titles = TitleStore(title_store_dir)
+
+    # Each shard's results are merged as soon as the shard is done, and then dropped.
+    for i, r in stage.track(
+        checkpoint.imap_shards('metadata', metadata_read_pool, parse_metadata_shard, range(SHARDS_TOTAL_NUM), args.fields_of_study),
+        total=SHARDS_TOTAL_NUM):
+
+        citation_data_by_shard, query_paper_ids, query_paper_ids_by_field, safe_ids, shard_paper_ids = r
+
+        del r
+
+        # Shard-local index -> global index
+        to_global = registry.intern_many(shard_paper_ids)
+
+        citation_data_direct_blocks[i] = remap_row_block(citation_data_by_shard, to_global)
+
+        # Kept as flat arrays rather than lists of ints, see shared_graph.py
+        query_paper_ids_all_shard[i] = to_global[query_paper_ids]
+
+        query_paper_ids_by_field_all_shard[i] = {
+            field: to_global[field_paper_ids]
+            for field, field_paper_ids in query_paper_ids_by_field.items()}
+
+        safe_paper_ids_all_shard[i] = (to_global[list(safe_ids.keys())], list(safe_ids.values()))
+
+        del citation_data_by_shard, query_paper_ids, query_paper_ids_by_field, safe_ids, shard_paper_ids
 
     metadata_read_pool.close()
     metadata_read_pool.join()
 
-    print("Combining all the metadata from all the shards...")
-    citation_data_direct = {}
-    citation_data_direct_by_shard = []
-    safe_paper_ids = {}
-    query_paper_ids_all_shard = []
-    query_paper_ids_by_field_all_shard = []
-    paper_titles = {}
+    # Shards finish in any order, but a paper appearing in several shards
+    # should still be resolved the same way on every run: the last shard wins.
+    citation_data_direct, citation_data_direct_spilled = build_citation_graph(
+        memory_budget, 'citation_data_direct', len(registry),
+        [citation_data_direct_blocks[i] for i in sorted(citation_data_direct_blocks)])
 
-    for r in tqdm.tqdm(metadata_read_results):
-        citation_data_by_shard, query_paper_ids, query_paper_ids_by_field, safe_ids, titles = r.get()
+    # safe_paper_ids[i] is the shard # of paper i, -1 if it is unsafe, and
+    # -2 if it was only ever seen as a citation and never as a metadata record.
+    safe_paper_ids = numpy.full(len(registry), -2, dtype=numpy.int8)
 
-        citation_data_direct.update(citation_data_by_shard)
+    for i in sorted(safe_paper_ids_all_shard):
+        safe_ids, shard_nums = safe_paper_ids_all_shard[i]
+        safe_paper_ids[safe_ids] = shard_nums
 
-        citation_data_direct_by_shard.append(citation_data_by_shard)
+    del safe_paper_ids_all_shard
 
-        query_paper_ids_all_shard.append(query_paper_ids)
+    safe_paper_mask = safe_paper_ids > -1
 
-        query_paper_ids_by_field_all_shard.append(query_paper_ids_by_field)
+    if args.shared_graph_dir:
+        # Workers read the graph and the safe-id table from read-only
+        # memory-mapped files instead of fork-inherited copies.
+        shared_dir = create_shared_dir(args.shared_graph_dir)
 
-        safe_paper_ids.update(safe_ids)
+        # A spilled graph is already memory-mapped
+        if not citation_data_direct_spilled:
+            citation_data_direct = share_citation_graph(shared_dir, 'citation_data_direct', citation_data_direct)
 
-        paper_titles.update(titles)
+        citation_data_direct_blocks.share(shared_dir)
+
+        safe_paper_ids = share_array(shared_dir, 'safe_paper_ids', safe_paper_ids)
+        safe_paper_mask = share_array(shared_dir, 'safe_paper_mask', safe_paper_mask)
 
     # Call Python GC in between steps to mitigate any potential OOM craashes
     gc.collect()
 
     # Remove invalid papers from citation_data_direct
     print("Remove invalid papers from citation_data_direct...")
+    stage = report.start_stage('sanitize')
     query_paper_ids_all_shard_sanitized = {}
     query_paper_ids_by_field_all_shard_sanitized = {}
 
-    citation_data_final = {}
+    citation_data_final_blocks = RowBlockStore(memory_budget, 'citation_data_final_blocks')
+
+    freeze_before_fork()
 
     sanitize_direct_pool = multiprocessing.Pool(processes=args.num_processes)
-    sanitize_direct_results = {}
 
     if args.shards:
         sanitize_direct_shards_list = args.shards
     else:
         sanitize_direct_shards_list = list(range(SHARDS_TOTAL_NUM))
 
-    for i in sanitize_direct_shards_list:
-        sanitize_direct_results[i] = sanitize_direct_pool.apply_async(sanitize_citation_data_direct, args=(i,))
+    if args.split_mode == 'hash':
+        pathlib.Path(args.save_dir).mkdir(exist_ok=True)
+
+        split_writer = HashSplitWriter(
+            args.save_dir, os.path.join(args.save_dir, "mag_fields_by_paper_ids.json"), registry, sanitize_direct_shards_list)
+
+    for i, (citation_data_by_shard_sanitized, query_paper_ids_by_field_sanitized) in stage.track(
+        checkpoint.imap_shards('sanitize', sanitize_direct_pool, sanitize_citation_data_direct, sanitize_direct_shards_list),
+        total=len(sanitize_direct_shards_list)):
+
+        citation_data_final_blocks[i] = citation_data_by_shard_sanitized
+
+        query_paper_ids_all_shard_sanitized[i] = citation_data_by_shard_sanitized[0]
+
+        if args.split_mode == 'hash':
+            # Already split by the worker
+            split_writer.add(i, query_paper_ids_by_field_sanitized)
+        else:
+            query_paper_ids_by_field_all_shard_sanitized[i] = query_paper_ids_by_field_sanitized
 
     sanitize_direct_pool.close()
     sanitize_direct_pool.join()
 
-    for i in tqdm.tqdm(sanitize_direct_shards_list):
-        citation_data_by_shard_sanitized, query_paper_ids_sanitized, query_paper_ids_by_field_sanitized = sanitize_direct_results[i].get()
+    unfreeze_after_join()
+
+    del citation_data_direct_blocks
 
-        citation_data_final.update(citation_data_by_shard_sanitized)
+    citation_data_final, citation_data_final_spilled = build_citation_graph(
+        memory_budget, 'citation_data_final', len(registry),
+        [citation_data_final_blocks[i] for i in sanitize_direct_shards_list])
 
-        query_paper_ids_all_shard_sanitized[i] = query_paper_ids_sanitized
+    del citation_data_final_blocks
 
-        query_paper_ids_by_field_all_shard_sanitized[i] = query_paper_ids_by_field_sanitized
+    if args.shared_graph_dir and not citation_data_final_spilled:
+        citation_data_final = share_citation_graph(shared_dir, 'citation_data_final', citation_data_final)
 
     # Call Python GC in between steps to mitigate any potential OOM craashes
     gc.collect()
 
     # Add indirect citations (citations by each direct citation)
     print("Adding indirect citations...")
+    stage = report.start_stage('indirect')
+
+    if args.indirect_engine == 'sparse':
+        citation_data_direct_matrix = citation_data_direct.to_csr_matrix()
+        citation_data_final_matrix = citation_data_final.to_csr_matrix()
+
+    freeze_before_fork()
+
     indirect_citations_pool = multiprocessing.Pool(processes=args.num_processes)
-    indirect_citations_results = []
 
     if args.shards:
         indirect_citations_shards_list = args.shards
     else:
         indirect_citations_shards_list = list(range(SHARDS_TOTAL_NUM))
 
-    for i in indirect_citations_shards_list:
-        indirect_citations_results.append(
-            indirect_citations_pool.apply_async(get_indirect_citations, args=(i,)))
-
-    indirect_citations_pool.close()
-    indirect_citations_pool.join()
-
-    # Combine citation_data_direct and citation_data_indirect into a single json file.
-    print("Merging direct and indirect citations...")
-
-    for r in tqdm.tqdm(indirect_citations_results):
-        indirect = r.get()
+    # Combine citation_data_final and the indirect citations into a single json file.
+    # Each shard's query papers are written as soon as its indirect citations are ready,
+    # in whichever order the shards finish, so the combined graph is never held in memory.
+    print("Writing data.json to a file.")
 
-        for paper_id in indirect.keys():
-            citation_data_final[paper_id].update(indirect[paper_id])
+    pathlib.Path(args.save_dir).mkdir(exist_ok=True)
 
-    # Call Python GC in between steps to mitigate any potential OOM craashes
-    gc.collect()
+    indirect_paper_ids = []
 
-    # Write citation_data_final to a file.
-    print("Writing data.json to a file.")
+    with DataJsonWriter(os.path.join(args.save_dir, "data.json"), args.data_json_format) as data_json_writer:
+        for _, (indirect_row_ids, indirect_offsets, indirect_neighbors) in stage.track(
+            checkpoint.imap_shards('indirect', indirect_citations_pool, get_indirect_citations, indirect_citations_shards_list),
+            total=len(indirect_citations_shards_list)):
 
-    pathlib.Path(args.save_dir).mkdir(exist_ok=True)
+            for j, paper_id in enumerate(indirect_row_ids.tolist()):
+                data_json_writer.write(
+                    registry[paper_id],
+                    get_final_citations(paper_id, indirect_neighbors[indirect_offsets[j]:indirect_offsets[j+1]]))
 
-    output_file = open(os.path.join(args.save_dir, "data.json"), 'w+')
+            indirect_paper_ids.append(numpy.unique(indirect_neighbors))
 
-    json.dump(citation_data_final, output_file, indent=2)
+    indirect_citations_pool.close()
+    indirect_citations_pool.join()
 
-    output_file.close()
+    unfreeze_after_join()
 
     # Call Python GC in between steps to mitigate any potential OOM craashes
     gc.collect()
 
     # Train-validation-test split
     print("Creating train-validation-test splits.")
+    stage = report.start_stage('splits')
 
-    train_file = open(os.path.join(args.save_dir, "train.txt"), 'w+')
-    val_file = open(os.path.join(args.save_dir, "val.txt"), 'w+')
-    test_file = open(os.path.join(args.save_dir, "test.txt"), 'w+')
+    if args.split_mode == 'shuffle':
+        if args.shards:
+            query_paper_ids_by_field_shards_list = args.shards
+        else:
+            query_paper_ids_by_field_shards_list = list(range(SHARDS_TOTAL_NUM))
 
-    train_file_ids_written = collections.defaultdict(bool)
-    val_file_ids_written = collections.defaultdict(bool)
-    test_file_ids_written = collections.defaultdict(bool)
+        # (field, query paper ids) of every shard, split in that order
+        split_groups = [
+            (field, field_paper_ids)
+            for s in query_paper_ids_by_field_shards_list
+            for field, field_paper_ids in query_paper_ids_by_field_all_shard_sanitized[s].items()]
 
-    if args.shards:
-        query_paper_ids_by_field_shards_list = args.shards
-    else:
-        query_paper_ids_by_field_shards_list = list(range(SHARDS_TOTAL_NUM))
+        splits, split_fields = make_splits(
+            split_rng, split_groups, args.val_proportion, args.test_proportion, args.train_proportion,
+            smoothed_weighting=args.smoothed_weighting)
 
-    # dictionary mapping s2orc id to mag field list
-    mag_fields_by_paper_ids = {}
-    mag_fields_by_paper_ids['train'] = collections.defaultdict(list)
-    mag_fields_by_paper_ids['val'] = collections.defaultdict(list)
-    mag_fields_by_paper_ids['test'] = collections.defaultdict(list)
-
-    if args.smoothed_weighting:
-        paper_ids_by_field = collections.defaultdict(list)
-        paper_counts_by_field = collections.defaultdict(int)
-        total_paper_count = 0
-
-        for s in query_paper_ids_by_field_shards_list:
-            for field in query_paper_ids_by_field_all_shard_sanitized[s].keys():
-                field_paper_ids = query_paper_ids_by_field_all_shard_sanitized[s][field]
-
-                paper_ids_by_field[field] += field_paper_ids
-                paper_counts_by_field[field] += len(field_paper_ids)
-                total_paper_count += len(field_paper_ids)
-
-        weights_by_field = collections.defaultdict(lambda: 1)
-        weights_sum = 0
-
-        for field in paper_counts_by_field.keys():
-            weights_by_field[field] = (paper_counts_by_field[field] / total_paper_count) ** 0.7
-            weights_sum += weights_by_field[field]
-
-        for field in paper_counts_by_field.keys():
-            weights_by_field[field] /= weights_sum
-
-        for field in paper_ids_by_field.keys():
-            field_paper_ids = paper_ids_by_field[field]
-
-            adjusted_field_paper_ids_size = math.floor(weights_by_field[field] * total_paper_count)
-
-            if adjusted_field_paper_ids_size < len(field_paper_ids):
-                adjusted_field_paper_ids = random.sample(field_paper_ids, adjusted_field_paper_ids_size)
-            else:
-                adjusted_field_paper_ids = field_paper_ids
-
-                if adjusted_field_paper_ids_size - len(field_paper_ids) > 0:
-                    oversample_count = adjusted_field_paper_ids_size - len(field_paper_ids)
-
-                    while oversample_count > 0:
-                        num_to_sample = min(oversample_count, len(field_paper_ids))
-                        oversampled_papers = random.sample(field_paper_ids, num_to_sample)
-                        adjusted_field_paper_ids += oversampled_papers
-                        oversample_count -= len(oversampled_papers)
-
-            val_size = int(len(adjusted_field_paper_ids) * args.val_proportion)
-            test_size = int(len(adjusted_field_paper_ids) * args.test_proportion)
-
-            if args.train_proportion:
-                train_size = int(len(adjusted_field_paper_ids) * args.train_proportion)
-            else:
-                train_size = len(adjusted_field_paper_ids) - val_size - test_size
-
-            for paper_id in adjusted_field_paper_ids[0:train_size]:
-                if not train_file_ids_written[paper_id]:
-                    train_file.write(paper_id + '\n')
-                    train_file_ids_written[paper_id] = True
-                mag_fields_by_paper_ids['train'][paper_id].append(field)
-
-            for paper_id in adjusted_field_paper_ids[train_size:train_size+val_size]:
-                if not val_file_ids_written[paper_id]:
-                    val_file.write(paper_id + '\n')
-                    val_file_ids_written[paper_id] = True
-                mag_fields_by_paper_ids['val'][paper_id].append(field)
-
-            for paper_id in adjusted_field_paper_ids[train_size+val_size:train_size+val_size+test_size]:
-                if not test_file_ids_written[paper_id]:
-                    test_file.write(paper_id + '\n')
-                    test_file_ids_written[paper_id] = True
-                mag_fields_by_paper_ids['test'][paper_id].append(field)
-    else:
-        for s in tqdm.tqdm(query_paper_ids_by_field_shards_list):
-            for field in query_paper_ids_by_field_all_shard_sanitized[s].keys():
-                field_paper_ids = query_paper_ids_by_field_all_shard_sanitized[s][field]
-
-                random.shuffle(field_paper_ids)
-
-                val_size = int(len(field_paper_ids) * args.val_proportion)
-                test_size = int(len(field_paper_ids) * args.test_proportion)
-
-                if args.train_proportion:
-                    train_size = int(len(field_paper_ids) * args.train_proportion)
-                else:
-                    train_size = len(field_paper_ids) - val_size - test_size
-
-                for paper_id in field_paper_ids[0:train_size]:
-                    if not train_file_ids_written[paper_id]:
-                        train_file.write(paper_id + '\n')
-                        train_file_ids_written[paper_id] = True
-                    mag_fields_by_paper_ids['train'][paper_id].append(field)
-
-                for paper_id in field_paper_ids[train_size:train_size+val_size]:
-                    if not val_file_ids_written[paper_id]:
-                        val_file.write(paper_id + '\n')
-                        val_file_ids_written[paper_id] = True
-                    mag_fields_by_paper_ids['val'][paper_id].append(field)
-
-                for paper_id in field_paper_ids[train_size+val_size:train_size+val_size+test_size]:
-                    if not test_file_ids_written[paper_id]:
-                        test_file.write(paper_id + '\n')
-                        test_file_ids_written[paper_id] = True
-                    mag_fields_by_paper_ids['test'][paper_id].append(field)
-
-    train_file.close()
-    val_file.close()
-    test_file.close()
+        write_split_files(args.save_dir, splits, registry)
 
     print("Writing mag_fields_by_paper_ids to a file.")
-    mag_fields_by_paper_ids_output_file = open(os.path.join(args.save_dir, "mag_fields_by_paper_ids.json"), 'w+')
-
-    json.dump(mag_fields_by_paper_ids, mag_fields_by_paper_ids_output_file)
+    stage = report.start_stage('write_outputs')
 
-    mag_fields_by_paper_ids_output_file.close()
+    # dictionary mapping s2orc id to mag field list
+    if args.split_mode == 'hash':
+        # Written out while sanitizing; this puts the parts together
+        split_writer.close()
+    else:
+        write_mag_fields(os.path.join(args.save_dir, "mag_fields_by_paper_ids.json"), splits, split_fields, registry)
 
     # Call Python GC in between steps to mitigate any potential OOM craashes
     gc.collect()
 
     # Get all paper ids and dump them to a file as well.
     print("Getting all paper ids ever appearing in data.json.")
-    all_paper_ids = get_all_paper_ids(citation_data_final)
+    all_paper_ids = get_all_paper_ids(citation_data_final, indirect_paper_ids)
 
     # Call Python GC in between steps to mitigate any potential OOM craashes
     gc.collect()
 
-    print("Writing all paper ids to a file.")
-    all_paper_ids_output_file = open(os.path.join(args.save_dir, "paper_ids.json"), 'w+')
+    # When run by run_pipeline.py, paper_ids.json, safe_paper_ids.json and
+    # titles.json go to part 2 in memory instead, and are only written to
+    # files with --keep_intermediate_files
+    write_intermediate_files = not in_pipeline() or keep_intermediate_files()
 
-    json.dump(all_paper_ids, all_paper_ids_output_file)
+    if write_intermediate_files and args.intermediate_format == 'binary':
+        print("Writing all paper ids, safe paper ids and titles to the paper table.")
+        write_paper_table(get_paper_table_path(args.save_dir), registry, safe_paper_ids, paper_titles, all_paper_ids)
+    elif write_intermediate_files:
+        print("Writing all paper ids to a file.")
+        all_paper_ids_output_file = open(os.path.join(args.save_dir, "paper_ids.json"), 'w+')
 
-    all_paper_ids_output_file.close()
+        json.dump(registry.to_paper_ids(all_paper_ids), all_paper_ids_output_file)
 
-    # Call Python GC in between steps to mitigate any potential OOM craashes
-    gc.collect()
+        all_paper_ids_output_file.close()
 
-    print("Writing safe paper ids to a file.")
-    safe_paper_ids_output_file = open(os.path.join(args.save_dir, "safe_paper_ids.json"), 'w+')
+        # Call Python GC in between steps to mitigate any potential OOM craashes
+        gc.collect()
 
-    json.dump(safe_paper_ids, safe_paper_ids_output_file)
+        print("Writing safe paper ids to a file.")
+        safe_paper_ids_output_file = open(os.path.join(args.save_dir, "safe_paper_ids.json"), 'w+')
 
-    safe_paper_ids_output_file.close()
+        json.dump(
+            {registry[p_id]: shard_num for p_id, shard_num in enumerate(safe_paper_ids.tolist()) if shard_num > -2},
+            safe_paper_ids_output_file)
 
-    # Call Python GC in between steps to mitigate any potential OOM craashes
-    gc.collect()
+        safe_paper_ids_output_file.close()
+
+        # Call Python GC in between steps to mitigate any potential OOM craashes
+        gc.collect()
+
+        # With --title_store, part 2 reads the titles from the store instead
+        if not args.title_store:
+            print("Writing all paper titles to a file.")
 
-    print("Writing all paper titles to a file.")
-    all_titles_output_file = open(os.path.join(args.save_dir, "titles.json"), 'w+')
+            with DataJsonWriter(os.path.join(args.save_dir, "titles.json"), 'indent') as all_titles_writer:
+                for p_id, title in paper_titles.indexed_items(registry):
+                    all_titles_writer.write(registry[p_id], title)
 
-    json.dump(paper_titles, all_titles_output_file, indent=2)
+    if in_pipeline():
+        print("Handing the paper ids and their shards over to part 2.")
+        hand_over(**get_part2_inputs(registry, all_paper_ids, safe_paper_ids, title_store_dir))
 
-    all_titles_output_file.close()
+    report.write(os.path.join(args.save_dir, "part1_report.json"))
@@ -2,38 +2,81 @@ import os
 import pathlib
 import multiprocessing
 import argparse
-import gzip
 import warnings
 
 import ujson as json
 import tqdm
 
+from s2orc_prep.shard_index import load_shard_index, get_shard_path, get_shard_index_path
+from s2orc_prep.shard_reader import iter_shard_lines, split_index_entries
+from s2orc_prep.record_decoder import get_record_decoder, RECORD_DECODERS, PDF_PARSES_FIELDS
+from s2orc_prep.data_json_writer import DataJsonWriter
+from s2orc_prep.checkpoint import open_checkpoint
+from s2orc_prep.metrics import MetricsReport, get_task_counters
+from s2orc_prep.profiling import enable_profiling
+from s2orc_prep.paper_table import PaperTable
+from s2orc_prep.title_store import TitleStore
+from s2orc_prep.pipeline import in_pipeline, take_over
 
-def parse_pdf_parses_shard(shard_num):
+
+def parse_pdf_parses_shard(shard_num, part_num=0):
 
     output_metadata = {}
 
-    pbar = tqdm.tqdm(position=shard_num+1)
+    counters = get_task_counters()
+
+    if args.shard_index_dir:
+        # Only decompress the blocks holding the papers we are looking for
+        shard_index = load_shard_index(get_shard_index_path(args.shard_index_dir, 'pdf_parses', shard_num))
+
+        index_entries = [shard_index[p_id] for p_id in all_paper_ids_by_shard[shard_num].keys() if p_id in shard_index]
+
+        # Each part of the shard is read by a different worker
+        index_entries = split_index_entries(index_entries, args.split_shards)[part_num]
+
+        pdf_parses_file = iter_shard_lines(
+            get_shard_path(args.shard_index_dir, 'pdf_parses', shard_num),
+            index_entries=index_entries, num_threads=args.reader_threads)
+    else:
+        pdf_parses_file = iter_shard_lines(
+            os.path.join(args.data_dir, 'pdf_parses', 'pdf_parses_{}.jsonl.gz'.format(shard_num)),
+            num_threads=args.reader_threads)
+
+    if title_store is not None:
+        # Only the titles of the papers needed from this shard
+        shard_titles = title_store.get_shard_titles(shard_num, all_paper_ids_by_shard[shard_num].keys())
+    else:
+        shard_titles = titles
 
-    pdf_parses_file = gzip.open(
-        os.path.join(args.data_dir, 'pdf_parses', 'pdf_parses_{}.jsonl.gz'.format(shard_num)), 'rt')
+    record_decoder = get_record_decoder(args.record_decoder, PDF_PARSES_FIELDS)
 
     for line in pdf_parses_file:
-        paper = json.loads(line)
+        # Lines of papers we don't need are dropped before decoding anything but paper_id
+        paper = record_decoder.decode(line, all_paper_ids_by_shard[shard_num])
+
+        counters['records'] += 1
+
+        if paper is None:
+            counters['filtered_not_needed'] += 1
+            continue
+
+        # Part 1 records the title of every safe paper, so this would
+        # otherwise drop the paper as if it had no abstract
+        if paper['paper_id'] not in shard_titles:
+            raise Exception("No title found for paper {} of shard {}. Check that part 1 finished writing its outputs.".format(
+                paper['paper_id'], shard_num))
 
         try:
             if all_paper_ids_by_shard[shard_num][paper['paper_id']]:
                 output_metadata[paper['paper_id']] = {
                     'paper_id': paper['paper_id'],
-                    'title': titles[paper['paper_id']],
+                    'title': shard_titles[paper['paper_id']],
                     'abstract': paper['abstract'][0]['text'],
                 }
         except:
-            pbar.update(1)
+            counters['filtered_no_abstract'] += 1
             continue
 
-        pbar.update(1)
-
     pdf_parses_file.close()
 
     return output_metadata
@@ -43,31 +86,113 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser()
 
-    parser.add_argument('paper_ids_json', help='path to paper_ids.json.')
-    parser.add_argument('safe_paper_ids_json', help='path to safe_paper_ids.json.')
-    parser.add_argument('titles_json', help='path to titles.json.')
+    parser.add_argument('paper_ids_json', nargs='?', help='path to paper_ids.json (leave out with --paper_table).')
+    parser.add_argument('safe_paper_ids_json', nargs='?', help='path to safe_paper_ids.json (leave out with --paper_table).')
+    parser.add_argument('titles_json', nargs='?', help='path to titles.json (leave out with --paper_table or --title_store).')
 
     parser.add_argument('data_dir', help='path to a directory containing `metadata` and `pdf_parses` subdirectories.')
     parser.add_argument('save_dir', help='path to a directory to save the processed files.')
 
     parser.add_argument('--num_processes', default=10, type=int, help='Number of processes to use.')
 
+    parser.add_argument(
+        '--paper_table',
+        help='path to the paper_table directory written by part 1 with --intermediate_format binary, to read instead of the three json files.')
+
+    parser.add_argument(
+        '--title_store',
+        help='path to the title_store directory written by part 1, to look up only the titles of the papers in paper_ids.json instead of loading titles.json.')
+
+    parser.add_argument(
+        '--record_decoder', default='ujson', choices=RECORD_DECODERS,
+        help='parse every shard line in full (ujson), or only decode the fields that are actually used (projected).')
+
+    parser.add_argument(
+        '--shard_index_dir',
+        help='path to a directory created by build_shard_index.py. If given, only the pdf_parses records of the papers in paper_ids.json are read.')
+
+    parser.add_argument(
+        '--reader_threads', default=0, type=int,
+        help='Number of threads decompressing each shard in the background. 0 decompresses on the worker itself.')
+
+    parser.add_argument(
+        '--split_shards', default=1, type=int,
+        help='Split each shard into this many parts read by different workers. Requires --shard_index_dir.')
+
+    parser.add_argument(
+        '--work_dir',
+        help='keep the results of every stage and shard in this directory, so that a failed run can be picked up again with --resume.')
+
+    parser.add_argument(
+        '--resume', default=False, action='store_true',
+        help='reuse the stages and shards already completed in --work_dir instead of computing them again.')
+
+    parser.add_argument(
+        '--profile', default=False, action='store_true',
+        help='profile every stage with cProfile, in the main process and in the workers, and write the merged profiles to save_dir/profile.')
+
+    parser.add_argument(
+        '--profile_memory', default=False, action='store_true',
+        help='with --profile, also trace the memory allocated by the workers with tracemalloc (slow).')
+
     args = parser.parse_args()
+
+    # Results of the stages completed so far, see s2orc_prep/checkpoint.py
+    checkpoint = open_checkpoint(args)
+
+    # cProfile/tracemalloc results of each stage, see s2orc_prep/profiling.py
+    if args.profile:
+        enable_profiling(os.path.join(args.save_dir, 'profile'), args.profile_memory)
+
+    # Time, record counts and memory use of each stage, written to part2_report.json
+    report = MetricsReport()
+
+    if not args.paper_table and not (args.paper_ids_json and args.safe_paper_ids_json and (args.titles_json or args.title_store)) and not in_pipeline():
+        raise Exception("Either pass paper_ids.json, safe_paper_ids.json and titles.json (or --title_store), or --paper_table.")
+
+    if args.split_shards > 1 and not args.shard_index_dir:
+        raise Exception("--split_shards needs --shard_index_dir, as plain gzip shards can only be read from the start.")
     
     # Total number of shards to process
     SHARDS_TOTAL_NUM = 100
 
-    # Load paper_ids.json
-    print("Loading paper_ids.json...")
-    all_paper_ids = json.load(open(args.paper_ids_json, 'r'))
+    # With a title store (see s2orc_prep/title_store.py), each worker looks
+    # up the titles of its shard's papers instead of using `titles`
+    title_store = TitleStore(args.title_store) if args.title_store else None
+    titles = None
 
-    # Load safe_paper_ids.json
-    print("Loading safe_paper_ids.json...")
-    safe_paper_ids = json.load(open(args.safe_paper_ids_json, 'r'))
-
-    # Read titles.json and get all the titles
-    print("Loading titles.json...")
-    titles = json.load(open(args.titles_json, 'r'))
+    # Load paper_ids.json
+    report.start_stage('load_inputs')
+    if in_pipeline():
+        # Handed over by part 1 when both are run by run_pipeline.py
+        print("Taking over paper ids and safe paper ids from part 1...")
+        all_paper_ids = take_over('paper_ids')
+        safe_paper_ids = take_over('safe_paper_ids')
+        title_store = TitleStore(take_over('title_store'))
+    elif args.paper_table:
+        # Only the papers of paper_ids.json are read from the table
+        print("Loading the paper table...")
+        paper_table = PaperTable(args.paper_table)
+
+        all_paper_ids = paper_table.get_selected_paper_ids()
+        safe_paper_ids = dict(zip(all_paper_ids, paper_table.shards[paper_table.selected_rows].tolist()))
+
+        if title_store is None:
+            titles = paper_table.get_selected_titles()
+
+        del paper_table
+    else:
+        print("Loading paper_ids.json...")
+        all_paper_ids = json.load(open(args.paper_ids_json, 'r'))
+
+        # Load safe_paper_ids.json
+        print("Loading safe_paper_ids.json...")
+        safe_paper_ids = json.load(open(args.safe_paper_ids_json, 'r'))
+
+        if title_store is None:
+            # Read titles.json and get all the titles
+            print("Loading titles.json...")
+            titles = json.load(open(args.titles_json, 'r'))
     
     print("Grouping all paper ids again by shard...")
     all_paper_ids_by_shard = []
@@ -88,33 +213,35 @@ if __name__ == '__main__':
 
     # Parse `pdf_parses` from s2orc to create `metadata.json` for SPECTER
     print("Parsing pdf_parses...")
+    stage = report.start_stage('pdf_parses')
     pdf_parses_read_pool = multiprocessing.Pool(processes=args.num_processes)
-    pdf_parses_read_results = []
 
-    for i in range(SHARDS_TOTAL_NUM):
-        pdf_parses_read_results.append(
-            pdf_parses_read_pool.apply_async(
-                parse_pdf_parses_shard, args=(i,)
-            )
-        )
+    pdf_parses_read_tasks = [(i, part_num) for i in range(SHARDS_TOTAL_NUM) for part_num in range(args.split_shards)]
 
-    pdf_parses_read_pool.close()
-    pdf_parses_read_pool.join()
+    # Each shard's titles/abstracts are written to metadata.json as soon as the
+    # shard is done, so they are never all held in memory at once. Every paper
+    # belongs to exactly one shard, so no paper id gets written twice.
+    print("Writing the metadata to metadata.json...")
+    pathlib.Path(args.save_dir).mkdir(exist_ok=True)
 
-    print("Combining all title/abstract from the shards...")
-    metadata = {}
+    metadata_path = os.path.join(args.save_dir, "metadata.json")
 
-    for r in tqdm.tqdm(pdf_parses_read_results):
-        metadata.update(r.get())
+    with DataJsonWriter(metadata_path + '.tmp', 'compact') as metadata_writer:
+        for _, result in stage.track(
+            checkpoint.imap_shards('pdf_parses', pdf_parses_read_pool, parse_pdf_parses_shard, pdf_parses_read_tasks),
+            total=len(pdf_parses_read_tasks)):
 
-    # All papers in all_paper_ids must not have their metadata included un `metadata`
-    assert len(metadata.keys()) == len(all_paper_ids)
+            for p_id, paper_metadata in result.items():
+                metadata_writer.write(p_id, paper_metadata)
 
-    # Write metadata to a file.
-    print("Writing the metadata to metadata.json...")
-    pathlib.Path(args.save_dir).mkdir(exist_ok=True)
-    output_file = open(os.path.join(args.save_dir, "metadata.json"), 'w+')
+            del result
+
+    pdf_parses_read_pool.close()
+    pdf_parses_read_pool.join()
+
+    # All papers in all_paper_ids must not have their metadata included un `metadata`
+    assert metadata_writer.num_written == len(all_paper_ids)
 
-    json.dump(metadata, output_file)
+    os.replace(metadata_path + '.tmp', metadata_path)
 
-    output_file.close()
+    report.write(os.path.join(args.save_dir, "part2_report.json"))